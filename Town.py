@@ -1,16 +1,29 @@
-from bisect import insort, bisect
 import platform
 import os
 import getpass  # for getting username in Windows
-from random import randint
-from typing import Any, Dict, Set, TextIO, Tuple, Union
-
-from PyQt5.Qt import QPoint, QPointF, QSize, QWheelEvent
-from PyQt5.QtGui import QPainter
-
+from contextlib import contextmanager
+from random import Random, randrange
+from threading import Lock, RLock, Thread
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+from PyQt5.Qt import QPoint, QPointF, QRectF, QSize, Qt, QWheelEvent
+from PyQt5.QtGui import QImage, QPainter
+
+from aggregates import TownAggregates
+from journal import JOURNAL_VERSION, Journal, JournalCompactor, journalFileName, journalVersion, readJournal
+from memory_report import trackDestroyed
+from profiling import frameProfiler, traced
+from save_format import BuildingRecord, RoadRecord, SaveFile, SaveHeader, isBinarySave, readSave, writeSave
+from simulation import CitizenPositions, RegionSimulation, citizenStep
+from terrain import GRASS, chunkGrounds
 from TownObjects import (ISOMETRIC_HEIGHT1, ISOMETRIC_HEIGHT2, ISOMETRIC_WIDTH,
                          Block, BuildingType, BuildingTypes, Grounds, BuildingGroups, getImage,
-                         RoadType, RoadTypes, Masks)
+                         Mask, RoadType, RoadTypes, Masks, turnMatrix)
+
+
+STREAMING_RADIUS = 32  # chunks with center nearer to camera (in cells) are loaded before the first frame
+GRASS_GROUNDS = bytes([GRASS]) * 256  # ground ids of chunk which terrain isn't generated yet
 
 
 def isometric(x: float, y: float) -> QPointF:
@@ -31,14 +44,6 @@ def isPointInRect(point: QPoint, rect: Tuple[QPoint, QSize]) -> bool:
     )
 
 
-def fromValues(value: Any, data: Dict[Any, Any]) -> Any:
-    for key in data:
-        if data[key] == value:
-            return key
-
-    raise ValueError(f"Value {value} is not in data.values().")
-
-
 class Chunk:
     """Store data of blocks in 16 by 16 square."""
 
@@ -47,52 +52,166 @@ class Chunk:
         self.y = y * 16
         # Generate a 16x16x3 matrix.
         self.is_empty = True
+        self.loaded = True  # False while chunk is waiting to be streamed from save
         self.blocks = tuple(tuple([None] * 5 for _ in range(16)) for _ in range(16))
-        self.grounds = tuple([Grounds.grass for _ in range(16)] for _ in range(16))
-        self.masks = tuple([None] * 16 for _ in range(16))
+        self.ground_ids = GRASS_GROUNDS  # ids of Grounds.by_id, cell i, j is at index i * 16 + j
+        self.masks = tuple([None] * 16 for _ in range(16))  # it's changed only by setMasks
+        self._mask_image = None  # (scale, image, rect) of masks, it's None if masks are changed
         self.roads = tuple([None for _ in range(16)] for _ in range(16))
-        self.citizens = tuple(tuple([] for _ in range(16)) for _ in range(16))
 
-    def draw(self, painter: QPainter, x: int, y: int, projecting_opacity: float, builded_opacity: float = 1) -> None:
-        """Draw chunk."""
+    def setMasks(self, masks: Dict[Tuple[int, int], Mask], area: Tuple[int, int, int, int] = (0, 0, 15, 15)) -> bool:
+        """Replace masks of cells in area (i1, j1, i2, j2) of chunk by {(x % 16, y % 16): mask}.
+            Return False if they are the same, then cached image of masks is kept."""
+
+        i1, j1, i2, j2 = area
+        new_masks = tuple([masks.get((i, j)) if i1 <= i <= i2 and j1 <= j <= j2 else self.masks[i][j]
+                           for j in range(16)] for i in range(16))
+        if new_masks == self.masks:
+            return False
+        self.masks = new_masks
+        self._mask_image = None
+        return True
+
+    def _maskImage(self, scale: float) -> Union[Tuple[float, QImage, QRectF], None]:
+        """Masks of chunk rendered in one image in scale, rect is its place relative to the chunk.
+            It's cached until masks or scale are changed."""
+
+        mask_image = self._mask_image
+        if mask_image is not None and mask_image[0] == scale:
+            return mask_image
+
+        cells = [(i, j, self.masks[i][j]) for i in range(16) for j in range(16) if self.masks[i][j] is not None]
+        if not cells:
+            return None
+        left = min((i - j - 1) * ISOMETRIC_WIDTH for i, j, _ in cells)
+        top = min((i + j) * ISOMETRIC_HEIGHT1 for i, j, _ in cells)
+        rect = QRectF(left, top,
+                      max((i - j - 1) * ISOMETRIC_WIDTH + mask.image.width() for i, j, mask in cells) - left,
+                      max((i + j) * ISOMETRIC_HEIGHT1 + mask.image.height() for i, j, mask in cells) - top)
+        image = QImage(max(1, round(rect.width() * scale)), max(1, round(rect.height() * scale)),
+                       QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.scale(scale, scale)
+        for i, j, mask in cells:
+            mask.draw((i - j) * ISOMETRIC_WIDTH - left, (i + j) * ISOMETRIC_HEIGHT1 - top, painter)
+        painter.end()
+        self._mask_image = (scale, image, rect)
+        return self._mask_image
+
+    def dropMaskImage(self) -> None:
+        """Free cached image of masks, it's rendered again when it's needed."""
+
+        self._mask_image = None
+
+    def maskImageSize(self) -> int:
+        """Bytes of cached image of masks."""
+
+        mask_image = self._mask_image
+        return mask_image[1].sizeInBytes() if mask_image is not None else 0
+
+    @traced("Chunk.draw")
+    def draw(self, painter: QPainter, x: int, y: int, projecting_opacity: float, builded_opacity: float = 1,
+             citizens: Dict[Tuple[int, int], Tuple['CitizenView']] = None, preview: 'ChunkPreview' = None) -> None:
+        """Draw chunk. citizens is the published view of citizens on the chunk, preview is the part of
+            projecting building or road on the chunk, it's drawn on empty places only.
+            Flat layers (grounds, roads and masks) are drawn first, then citizens and blocks cell by cell."""
 
         if not (0 <= projecting_opacity <= 1):
             raise AttributeError("Opacity must be between 0 and 1.")
 
+        profiler = frameProfiler if frameProfiler.enabled else None
+        start = perf_counter() if profiler else 0
+
+        painter.setOpacity(1)
+        grounds = Grounds.by_id
+        ground_ids = self.ground_ids
         for i in range(16):
             for j in range(16):
+                grounds[ground_ids[i * 16 + j]].draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x,
+                                                     (self.x + self.y + i + j) * ISOMETRIC_HEIGHT1 - y, painter)
+        if profiler:
+            start = profiler.lap("grounds", start, 256)
 
-                painter.setOpacity(1)
-                self.grounds[i][j].draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x, (self.x + self.y + i + j) *
-                                        ISOMETRIC_HEIGHT1 - y, painter)
-
-                # Draw road
-                painter.setOpacity(1)
-                if self.roads[i][j] is not None:
-                    if type(self.roads[i][j]) == ProjectedRoad:
-                        painter.setOpacity(projecting_opacity)
-                    self.roads[i][j].draw(painter, x, y)
+        if not self.loaded:  # ground is placeholder of chunk
+            return
 
-                # Draw mask
-                painter.setOpacity(builded_opacity)
-                if self.masks[i][j] is not None:
-                    self.masks[i][j].draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x, (self.x + self.y + i + j) *
-                                          ISOMETRIC_HEIGHT1 - y, painter)
+        roads = 0
+        preview_roads = preview.roads if preview is not None else {}
+        for i in range(16):
+            for j in range(16):
+                road = self.roads[i][j]
+                if road is not None:
+                    painter.setOpacity(1)
+                elif preview_roads and (i, j) in preview_roads and not isinstance(self.blocks[i][j][0], Building):
+                    road = preview_roads[(i, j)]
+                    painter.setOpacity(projecting_opacity)
+                else:
+                    continue
+                road.draw(painter, x, y)
+                roads += 1
+        if profiler:
+            start = profiler.lap("roads", start, roads)
+
+        # masks are drawn by one cached image, it's rendered in scale of painter but not bigger than textures
+        masks = 0
+        painter.setOpacity(builded_opacity)
+        scale = painter.transform().m11()
+        mask_image = self._maskImage(min(scale, 1))
+        if mask_image is not None:
+            _, image, rect = mask_image
+            rect = rect.translated((self.x - self.y) * ISOMETRIC_WIDTH - x, (self.x + self.y) * ISOMETRIC_HEIGHT1 - y)
+            if scale < 1:  # image is already scaled, so it's drawn pixel by pixel
+                position = painter.transform().map(rect.topLeft())
+                painter.save()
+                painter.resetTransform()
+                painter.drawImage(position, image)
+                painter.restore()
+            else:
+                painter.drawImage(rect, image)
+            masks += 1
+        if preview is not None:
+            for (i, j), mask in preview.masks.items():
+                mask.draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x, (self.x + self.y + i + j) *
+                          ISOMETRIC_HEIGHT1 - y, painter)
+                masks += 1
+        if profiler:
+            start = profiler.lap("masks", start, masks)
+
+        blocks = 0
+        citizens_count = 0
+        citizens_time = 0
+        preview_blocks = preview.blocks if preview is not None else {}
+        for i in range(16):
+            for j in range(16):
                 # Draw citizens
-                painter.setOpacity(1)
-                for citizen in self.citizens[i][j]:
-                    citizen.draw(painter, x, y)
+                if citizens is not None and (i, j) in citizens:
+                    citizens_start = perf_counter() if profiler else 0
+                    painter.setOpacity(1)
+                    for citizen in citizens[(i, j)]:
+                        citizen.draw(painter, x, y)
+                        citizens_count += 1
+                    if profiler:
+                        citizens_time += perf_counter() - citizens_start
 
                 # Draw blocks
+                projected = preview_blocks.get((i, j))
                 for z in range(5):
-                    painter.setOpacity(builded_opacity)
                     building = self.blocks[i][j][z]
                     if building is not None:
-                        if type(building) == ProjectedBuilding:
-                            painter.setOpacity(projecting_opacity)
+                        painter.setOpacity(builded_opacity)
                         block, angle, variant = building.getBlock(i + self.x, j + self.y, z)
-                        block.draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x, (self.x + self.y + i + j) *
-                                   ISOMETRIC_HEIGHT1 - z * ISOMETRIC_HEIGHT2 - y, angle, painter, variant)
+                    elif projected is not None and projected[z] is not None:
+                        painter.setOpacity(projecting_opacity)
+                        block, angle, variant = projected[z]
+                    else:
+                        continue
+                    block.draw((self.x + i - self.y - j) * ISOMETRIC_WIDTH - x, (self.x + self.y + i + j) *
+                               ISOMETRIC_HEIGHT1 - z * ISOMETRIC_HEIGHT2 - y, angle, painter, variant)
+                    blocks += 1
+        if profiler:
+            profiler.add("citizens", citizens_time, citizens_count)
+            profiler.lap("blocks", start + citizens_time, blocks)
 
 
 class TownObjectType:
@@ -102,23 +221,6 @@ class TownObjectType:
         pass
 
 
-def turnMatrix(blocks: Tuple[Tuple[Any]], angle: int) -> Tuple[Tuple[Any]]:
-    """Turn matrix of Blocks on changed angle (in degrees)"""
-
-    # blocks is a matrix, so its height is the length of blocks[0]
-    height = len(blocks[0])
-
-    if angle == 0:
-        return blocks
-    elif angle == 90:
-        return tuple(tuple(blocks[-j - 1][i] for j in range(len(blocks))) for i in range(height))
-    elif angle == 180:
-        return tuple(tuple(blocks[-i - 1][-j - 1] for j in range(height))
-                     for i in range(len(blocks)))
-    else:
-        return tuple(tuple(blocks[j][-i - 1] for j in range(len(blocks))) for i in range(height))
-
-
 class TownObject:
     """Object of Town."""
 
@@ -138,63 +240,124 @@ class Road(TownObject):
     def __init__(self, town: 'Town', x: int, y: int, road_type: RoadType):
         super().__init__(x, y, 0, town)
         self.road_type = road_type
-        town.chunks[x // 16][y // 16].roads[x % 16][y % 16] = self
+        with town._lock:
+            town.chunks[x // 16][y // 16].roads[x % 16][y % 16] = self
+            town.roads[(x, y)] = self
+            town.aggregates.addRoad(x, y, RoadTypes.names[road_type])
+            town.revision += 1
+            town.markChanged(x, y, x, y)
+        if town.journal is not None:
+            town.journal.road(self.record())
+
+    @classmethod
+    def detached(cls, town: 'Town', x: int, y: int, road_type: RoadType) -> 'Road':
+        """Road which isn't added to town, for example a part of preview."""
+
+        road = cls.__new__(cls)
+        road.x, road.y, road.angle, road.town, road.road_type = x, y, 0, town, road_type
+        return road
+
+    def record(self) -> RoadRecord:
+        return RoadRecord(self.x, self.y, RoadTypes.names[self.road_type])
 
     def draw(self, painter: QPainter, x: int, y: int) -> None:
         textures = self.road_type.textures
 
-        painter.drawImage((self.x - self.y - .5) * ISOMETRIC_WIDTH - x,
-                          (self.x + self.y + .5) * ISOMETRIC_HEIGHT1 - y, textures['center'])
+        painter.drawImage(QPointF((self.x - self.y - .5) * ISOMETRIC_WIDTH - x,
+                                  (self.x + self.y + .5) * ISOMETRIC_HEIGHT1 - y), textures['center'])
 
-        if self.town.getRoad(self.x, self.y - 1) is not None:
-            painter.drawImage((self.x - self.y) * ISOMETRIC_WIDTH - x,
-                              (self.x + self.y + .25) * ISOMETRIC_HEIGHT1 - y, textures['right-up'])
+        if self.town.getRoad(self.x, self.y - 1, True) is not None:
+            painter.drawImage(QPointF((self.x - self.y) * ISOMETRIC_WIDTH - x,
+                                      (self.x + self.y + .25) * ISOMETRIC_HEIGHT1 - y), textures['right-up'])
 
-        if self.town.getRoad(self.x, self.y + 1) is not None:
-            painter.drawImage((self.x - self.y - .75) * ISOMETRIC_WIDTH - x,
-                              (self.x + self.y + 1) * ISOMETRIC_HEIGHT1 - y, textures['left-down'])
+        if self.town.getRoad(self.x, self.y + 1, True) is not None:
+            painter.drawImage(QPointF((self.x - self.y - .75) * ISOMETRIC_WIDTH - x,
+                                      (self.x + self.y + 1) * ISOMETRIC_HEIGHT1 - y), textures['left-down'])
 
-        if self.town.getRoad(self.x - 1, self.y) is not None:
-            painter.drawImage((self.x - self.y - .75) * ISOMETRIC_WIDTH - x,
-                              (self.x + self.y + .25) * ISOMETRIC_HEIGHT1 - y, textures['left-up'])
+        if self.town.getRoad(self.x - 1, self.y, True) is not None:
+            painter.drawImage(QPointF((self.x - self.y - .75) * ISOMETRIC_WIDTH - x,
+                                      (self.x + self.y + .25) * ISOMETRIC_HEIGHT1 - y), textures['left-up'])
 
-        if self.town.getRoad(self.x + 1, self.y) is not None:
-            painter.drawImage((self.x - self.y) * ISOMETRIC_WIDTH - x,
-                              (self.x + self.y + 1) * ISOMETRIC_HEIGHT1 - y, textures['right-down'])
+        if self.town.getRoad(self.x + 1, self.y, True) is not None:
+            painter.drawImage(QPointF((self.x - self.y) * ISOMETRIC_WIDTH - x,
+                                      (self.x + self.y + 1) * ISOMETRIC_HEIGHT1 - y), textures['right-down'])
 
 
 class ProjectedRoad(Road):
+    """Road which player's projecting to build. It's shown by preview of town and isn't added to chunks.
+        If path is started, roads are projected from its start to the current cell by shape:
+        "line" goes along x and then along y, "rectangle" fills the rectangle between them."""
+
+    SHAPES = ("line", "rectangle")
+
     def __init__(self, town: 'Town', road_type: RoadType = RoadTypes.road):
         self.town = town
         self.road_type = RoadTypes.getByNumber(town.chosen_btype)
         self.x = self.y = 0
-        self._addToMap()
+        self.start = None  # cell where path was started
+        self.shape = "line"
+        self._publishPreview()
+
+    def cells(self) -> List[Tuple[int, int]]:
+        """Cells of projecting path."""
+
+        if self.start is None:
+            return [(self.x, self.y)]
+        start_x, start_y = self.start
+        step_x = 1 if self.x >= start_x else -1
+        step_y = 1 if self.y >= start_y else -1
+        if self.shape == "rectangle":
+            return [(x, y) for x in range(start_x, self.x + step_x, step_x)
+                    for y in range(start_y, self.y + step_y, step_y)]
+        return [(x, start_y) for x in range(start_x, self.x + step_x, step_x)] + \
+            [(self.x, y) for y in range(start_y + step_y, self.y + step_y, step_y)]
+
+    def _publishPreview(self) -> None:
+        roads = {}
+        chunks = {}
+        for x, y in self.cells():
+            if 0 <= x <= 255 and 0 <= y <= 255:
+                road = self if (x, y) == (self.x, self.y) else Road.detached(self.town, x, y, self.road_type)
+                roads[(x, y)] = road
+                chunk = chunks.setdefault((x // 16, y // 16), ChunkPreview({}, {}, {}))
+                chunk.roads[(x % 16, y % 16)] = road
+                chunk.masks[(x % 16, y % 16)] = Masks.yellow
+        self.town.preview = PreviewOverlay(self, chunks, roads)
 
-    def _delFromMap(self) -> None:
-        self.town.chunks[self.x // 16][self.y // 16].masks[self.x % 16][self.y % 16] = None
-        if self.town.chunks[self.x // 16][self.y // 16].roads[self.x % 16][self.y % 16] is self:
-            self.town.chunks[self.x // 16][self.y // 16].roads[self.x % 16][self.y % 16] = None
+    def addToMap(self, iso: QPointF) -> None:
+        """Move road or end of path to isometric position. Preview is recomputed only if cell is changed."""
 
-    def _addToMap(self) -> None:
-        self.town.chunks[self.x // 16][self.y // 16].masks[self.x % 16][self.y % 16] = Masks.yellow
-        if self.town.isBlockEmpty(self.x, self.y, 0, False):
-            self.town.chunks[self.x // 16][self.y // 16].roads[self.x % 16][self.y % 16] = self
+        x, y = round(iso.x()), round(iso.y())
+        if (x, y) != (self.x, self.y) or self.town.preview.source is not self:
+            self.x, self.y = x, y
+            self._publishPreview()
 
-    def addToMap(self, iso: QPointF) -> None:
-        self._delFromMap()
-        self.x = round(iso.x())
-        self.y = round(iso.y())
-        self._addToMap()
+    def startPath(self) -> None:
+        """Start path on the current cell."""
 
+        self.start = (self.x, self.y)
+        self._publishPreview()
+
+    def setShape(self, shape: str) -> None:
+        if shape not in self.SHAPES:
+            raise AttributeError(f"Shape of roads must be one of {', '.join(self.SHAPES)}, not {shape}.")
+        if shape != self.shape:
+            self.shape = shape
+            self._publishPreview()
+
+    @traced("ProjectedRoad.build")
     def build(self) -> bool:
-        self._delFromMap()
-        if self.town.isBlockEmpty(self.x, self.y, 0, False):
-            Road(self.town, self.x, self.y, self.road_type)
-            return True
-        return False
+        """Build roads on empty cells of path by one batch, path is finished."""
+
+        roads = self.town.buildRoads(self.cells(), self.road_type)
+        if self.start is not None:
+            self.start = None
+            self._publishPreview()
+        return bool(roads)
 
     def destroy(self) -> None:
-        self._delFromMap()
+        self.town.hidePreview(self)
+        trackDestroyed(self)
         del self
 
     def draw(self, painter: QPainter, x: int, y: int) -> None:
@@ -210,25 +373,32 @@ class Building(TownObject):
         self.building_type = building_type
         self.btype_variant = btype_variant
 
-        self.blocks = turnMatrix(building_type.blocks[btype_variant], angle)
+        self.blocks = building_type.rotatedBlocks(btype_variant, angle)
         self.blocks_variants = blocks_variants
 
-        town.buildings.append(self)
-        for block_x in range(len(self.blocks)):
-            for block_y in range(len(self.blocks[block_x])):
-                for block_z in range(len(self.blocks[block_x][block_y])):
-                    if self.blocks[block_x][block_y][block_z] is not None:
-                        town.addBlock(x + block_x, y + block_y, block_z, self)
+        with town._lock:
+            town.buildings.add(self)
+            for block_x in range(len(self.blocks)):
+                for block_y in range(len(self.blocks[block_x])):
+                    for block_z in range(len(self.blocks[block_x][block_y])):
+                        if self.blocks[block_x][block_y][block_z] is not None:
+                            town.addBlock(x + block_x, y + block_y, block_z, self)
+        if town.journal is not None:
+            town.journal.build(self.record())
 
     def destroy(self) -> None:
         """Destroy building."""
 
-        for block_x in range(len(self.blocks)):
-            for block_y in range(len(self.blocks[block_x])):
-                for block_z in range(len(self.blocks[block_x][block_y])):
-                    if self.blocks[block_x][block_y][block_z] is not None:
-                        self.town.removeBlock(self.x + block_x, self.y + block_y, block_z)
-        self.town.buildings.remove(self)
+        with self.town._lock:
+            for block_x in range(len(self.blocks)):
+                for block_y in range(len(self.blocks[block_x])):
+                    for block_z in range(len(self.blocks[block_x][block_y])):
+                        if self.blocks[block_x][block_y][block_z] is not None:
+                            self.town.removeBlock(self.x + block_x, self.y + block_y, block_z)
+            self.town.buildings.remove(self)
+        if self.town.journal is not None:
+            self.town.journal.destroy(self.record())
+        trackDestroyed(self)
         del self
 
     def getBlock(self, x: int, y: int, z: int) -> Tuple[Union[Block, None], int, str]:
@@ -240,19 +410,18 @@ class Building(TownObject):
             self.blocks_variants[x - self.x][y - self.y][z],
         )
 
-    def save(self, file: TextIO) -> None:
-        file.write(f'{self.x} {self.y} {self.angle // 90} {fromValues(self.building_type, BuildingTypes.building_types)} ' +
-                   f'{self.btype_variant} ')
-        for x in range(len(self.blocks_variants)):
-            for y in range(len(self.blocks_variants[0])):
-                for var in self.blocks_variants[x][y]:
-                    if var is not None:
-                        file.write(f'{var} ')
-        file.write('\n')
+    def record(self) -> BuildingRecord:
+        return BuildingRecord(
+            self.x, self.y, self.angle, BuildingTypes.names[self.building_type],
+            self.btype_variant,
+            tuple(self.blocks_variants[x][y][z]
+                  for x, y, z in self.building_type.blockPositions(self.btype_variant, self.angle)),
+            self.id
+        )
 
 
 class ProjectedBuilding:
-    """Building which player's projecting to build."""
+    """Building which player's projecting to build. It's shown by preview of town and isn't added to chunks."""
 
     def __init__(self, town: 'Town'):
         self._building_type = BuildingTypes.getByNumber(town.chosen_btype)
@@ -260,46 +429,72 @@ class ProjectedBuilding:
         self.blocks = None
         self._btype_variant = None
         self.blocks_variants = None
-        self.generateVariants()
         self.town = town
+        self.generateVariants()
         coords = isometric(town.cam_x, town.cam_y)
         self.x = round(coords.x())
         self.y = round(coords.y())
         self.town.setBuildingMaskForGroup(self)
 
-    def _addNewBlocks(self):
+    def _publishPreview(self) -> None:
+        chunks = {}
         for x in range(len(self.blocks)):
             for y in range(len(self.blocks[0])):
-                for z in range(len(self.blocks[x][y])):
-                    if self.town.isBlockEmpty(x + self.x, y + self.y, z) and self.blocks[x][y][z] is not None:
-                        self.town.addBlock(x + self.x, y + self.y, z, self)
-
+                if not (0 <= x + self.x <= 255 and 0 <= y + self.y <= 255):
+                    continue
+                cell = tuple(
+                    (self.blocks[x][y][z], self._angle, self.blocks_variants[x][y][z])
+                    if z < len(self.blocks[x][y]) and self.blocks[x][y][z] is not None else None
+                    for z in range(5)
+                )
+                if any(cell):
+                    chunk = ((x + self.x) // 16, (y + self.y) // 16)
+                    chunks.setdefault(chunk, ChunkPreview({}, {}, {})).blocks[(x + self.x) % 16, (y + self.y) % 16] = \
+                        cell
+        self.town.preview = PreviewOverlay(self, chunks, {})
+
+    def _buildingOn(self, x: int, y: int) -> Union['Building', 'ProjectedBuilding', None]:
+        """Building on position x, y, 0 as if projecting building was built on empty places."""
+
+        building = self.town.getBuilding(x, y)
+        if building is None and 0 <= x - self.x < len(self.blocks) and 0 <= y - self.y < len(self.blocks[0]) and \
+                0 <= x <= 255 and 0 <= y <= 255:
+            blocks = self.blocks[x - self.x][y - self.y]
+            if blocks and blocks[0] is not None:
+                return self
+        return building
+
+    @traced("ProjectedBuilding.allOnGreen")
     def allOnGreen(self) -> bool:
         for x in range(len(self.blocks)):
             x += self.x
             for y in range(len(self.blocks[0])):
                 y += self.y
                 if self.town.chunks[x // 16][y // 16].masks[x % 16][y % 16] != Masks.green and \
-                        self.town.getBuilding(x, y, 0) is not None:
+                        self._buildingOn(x, y) is not None:
                     return False
         return True
 
     def addToMap(self, iso: QPointF) -> None:
-        self._delOldBlocks()
-        self.x = round(iso.x())
-        self.y = round(iso.y())
-        self._addNewBlocks()
+        """Move building to isometric position. Preview is recomputed only if cell is changed."""
+
+        x, y = round(iso.x()), round(iso.y())
+        if (x, y) != (self.x, self.y) or self.town.preview.source is not self:
+            self.x, self.y = x, y
+            self._publishPreview()
 
     def group(self):
         return self._building_type.group
 
+    @traced("ProjectedBuilding.doorCheck")
     def doorCheck(self) -> bool:
         for x in range(self.x - 1, self.x + len(self.blocks) + 1):
             for y in range(self.y - 1, self.y + len(self.blocks[0]) + 1):
-                if self.town.getBuilding(x, y) is not None:
-                    block, angle, variant = self.town.getBuilding(x, y).getBlock(x, y, 0)
+                building = self._buildingOn(x, y)
+                if building is not None:
+                    block, angle, variant = building.getBlock(x, y, 0)
                     for mx, my in block.placesThatMustBeEmpty(angle, x, y, variant):
-                        if self.town.getBuilding(mx, my) is not None:
+                        if self._buildingOn(mx, my) is not None:
                             return False
         return True
 
@@ -312,12 +507,17 @@ class ProjectedBuilding:
             self.blocks_variants[x - self.x][y - self.y][z],
         )
 
+    def canBuild(self) -> bool:
+        """Check that projecting building can be built on its place."""
+
+        return self.town.isBlocksEmpty(self.x, self.y, self.blocks, False) and self.doorCheck() and \
+            self.allOnGreen()
+
+    @traced("ProjectedBuilding.build")
     def build(self) -> bool:
         """Build projecting building."""
 
-        if self.town.isBlocksEmpty(self.x, self.y, self.blocks, False) and self.doorCheck() and \
-                self.allOnGreen():
-            self._delOldBlocks()
+        if self.canBuild():
             Building(
                 self.x,
                 self.y,
@@ -328,6 +528,7 @@ class ProjectedBuilding:
                 self._btype_variant
             )
             self.generateVariants()
+            self._publishPreview()
             self.town.setBuildingMaskForGroup(self)
             return True
         return False
@@ -335,41 +536,370 @@ class ProjectedBuilding:
     def destroy(self) -> None:
         """Destroy projecting building."""
 
-        self._delOldBlocks()
+        self.town.hidePreview(self)
         self.town.setBuildingMaskForGroup()
+        trackDestroyed(self)
         del self
 
-    def _delOldBlocks(self) -> None:
-        for x in range(len(self.blocks)):
-            for y in range(len(self.blocks[0])):
-                for z in range(len(self.blocks[x][y])):
-                    if self.town.isBlockEmpty(x + self.x, y + self.y, z) and self.blocks[x][y][z] is not None:
-                        self.town.removeBlock(x + self.x, y + self.y, z)
-
     def generateVariants(self) -> None:
         """Generate appearance of projecting building."""
 
-        self._btype_variant, self.blocks_variants = self._building_type.generateVariant()
+        self._btype_variant, self.blocks_variants = self._building_type.generateVariant(
+            self.town.random("variants")
+        )
         self.blocks_variants = turnMatrix(self.blocks_variants, self._angle)
         self.blocks = turnMatrix(self._building_type.blocks[self._btype_variant], self._angle)
 
+    def variant(self) -> Tuple[str, Tuple[Tuple[Tuple[Optional[str]]]], int]:
+        """Variant of building type, variants of blocks turned on angle and angle, see setVariant."""
+
+        return self._btype_variant, self.blocks_variants, self._angle
+
+    def setVariant(self, btype_variant: str, blocks_variants: Tuple[Tuple[Tuple[Optional[str]]]], angle: int) -> None:
+        """Give projecting building variant of building type and variants of blocks turned on angle."""
+
+        self._btype_variant, self.blocks_variants, self._angle = btype_variant, blocks_variants, angle
+        self.blocks = turnMatrix(self._building_type.blocks[btype_variant], angle)
+        self._publishPreview()
+
     def turn(self, delta_angle: int) -> None:
         """Turn projecting building on changed angle"""
 
         if delta_angle not in {90, -90}:
             raise AttributeError(f"Buildings can turn on 90 or -90 degrees, not {delta_angle}")
 
-        self._delOldBlocks()
         self._angle = (self._angle + delta_angle) % 360
         self.blocks = turnMatrix(self.blocks, delta_angle % 360)
         self.blocks_variants = turnMatrix(self.blocks_variants, delta_angle % 360)
-        self._addNewBlocks()
+        self._publishPreview()
+
+
+class AreaSelection:
+    """Rectangle which player's selecting from start cell to the current one. It's shown by preview of town."""
+
+    def __init__(self, town: 'Town', iso: QPointF):
+        self.town = town
+        self.start = (round(iso.x()), round(iso.y()))
+        self.x, self.y = self.start
+        self._publishPreview()
+
+    def area(self) -> Tuple[int, int, int, int]:
+        return (*self.start, self.x, self.y)
+
+    def _publishPreview(self) -> None:
+        chunks = {}
+        for x, y in self.town.areaCells(*self.area()):
+            chunks.setdefault((x // 16, y // 16), ChunkPreview({}, {}, {})).masks[(x % 16, y % 16)] = Masks.yellow
+        self.town.preview = PreviewOverlay(self, chunks, {})
+
+    def addToMap(self, iso: QPointF) -> None:
+        """Move the current corner to isometric position."""
+
+        x, y = round(iso.x()), round(iso.y())
+        if (x, y) != (self.x, self.y) or self.town.preview.source is not self:
+            self.x, self.y = x, y
+            self._publishPreview()
+
+    def destroy(self) -> None:
+        self.town.hidePreview(self)
+        trackDestroyed(self)
+        del self
+
+
+class ChunkPreview(NamedTuple):
+    """Part of preview on chunk, places are (x % 16, y % 16)."""
+
+    blocks: Dict[Tuple[int, int], Tuple[Optional[Tuple[Block, int, str]], ...]]  # (block, angle, variant) on every z
+    roads: Dict[Tuple[int, int], ProjectedRoad]
+    masks: Dict[Tuple[int, int], Mask]
+
+
+class PreviewOverlay(NamedTuple):
+    """Published immutable view of projecting building or road, it's drawn over town without changing chunks.
+        It's replaced by one assignment when projecting object is moved, turned or changed."""
+
+    source: Union[ProjectedBuilding, ProjectedRoad, AreaSelection, None]
+    chunks: Dict[Tuple[int, int], ChunkPreview]
+    roads: Dict[Tuple[int, int], Road]  # projecting roads by their positions
+
+
+NO_PREVIEW = PreviewOverlay(None, {}, {})
+
+
+class TownSnapshot(NamedTuple):
+    """Published immutable view of town. Roads and buildings aren't changed after creation."""
+
+    version: int
+    name: str
+    cam_x: float
+    cam_y: float
+    cam_z: float
+    seed: int
+    roads: Tuple[Road]
+    buildings: Tuple[Building]
+    next_building_id: int
+
+
+class BuildingRegistry:
+    """Buildings of town by their ids. Id of building is given once and isn't reused, so saves and journals
+        refer to buildings by ids. Adding, removing and finding buildings by id or group take O(1).
+        It can be changed by thread streaming chunks, so it's iterated over a copy.
+        Every added and removed building is counted by aggregates."""
+
+    def __init__(self, aggregates: TownAggregates):
+        self._aggregates = aggregates
+        self._buildings: Dict[int, Building] = {}  # {id: building} in order of adding
+        self._groups: Dict[str, Dict[int, Building]] = {}  # {group: {id: building}}
+        self._next_id = 0
+        self._lock = RLock()
+
+    def add(self, building: Building, building_id: int = None) -> int:
+        """Add building with building_id or with a new id. Return its id."""
+
+        with self._lock:
+            if building_id is None:
+                building_id = self._next_id
+            elif building_id in self._buildings:
+                raise ValueError(f"Building id {building_id} is already used.")
+            self._next_id = max(self._next_id, building_id + 1)
+            building.id = building_id
+            self._buildings[building_id] = building
+            self._groups.setdefault(building.building_type.group, {})[building_id] = building
+            self._aggregates.addBuilding(building.x, building.y, BuildingTypes.names[building.building_type])
+        return building_id
+
+    def addMany(self, buildings: List[Building], building_ids: Iterable[Optional[int]]) -> None:
+        """Add buildings with building_ids, None is a new id. Aggregates are changed once."""
+
+        with self._lock:
+            registered = self._buildings
+            next_id = self._next_id
+            type_groups = {}  # {building type: buildings of its group}
+            for building, building_id in zip(buildings, building_ids):
+                if building_id is None:
+                    building_id = next_id
+                    next_id += 1
+                elif building_id in registered:
+                    raise ValueError(f"Building id {building_id} is already used.")
+                elif building_id >= next_id:
+                    next_id = building_id + 1
+                building.id = building_id
+                registered[building_id] = building
+                group = type_groups.get(building.building_type)
+                if group is None:
+                    group = type_groups[building.building_type] = \
+                        self._groups.setdefault(building.building_type.group, {})
+                group[building_id] = building
+            self._next_id = next_id
+            names = BuildingTypes.names
+            self._aggregates.addBuildings((building.x, building.y, names[building.building_type])
+                                          for building in buildings)
+
+    def remove(self, building: Building) -> None:
+        with self._lock:
+            del self._buildings[building.id]
+            del self._groups[building.building_type.group][building.id]
+            self._aggregates.removeBuilding(building.x, building.y, BuildingTypes.names[building.building_type])
+
+    def get(self, building_id: int) -> Optional[Building]:
+        return self._buildings.get(building_id)
+
+    def reserve(self, next_id: int) -> None:
+        """Don't give ids less than next_id to new buildings, they are used by buildings which aren't loaded yet."""
+
+        with self._lock:
+            self._next_id = max(self._next_id, next_id)
+
+    @property
+    def next_id(self) -> int:
+        return self._next_id
+
+    def groupCount(self, group: str) -> int:
+        return len(self._groups.get(group, ()))
+
+    def inGroup(self, group: str) -> Tuple[Building, ...]:
+        with self._lock:
+            return tuple(self._groups.get(group, {}).values())
+
+    def __contains__(self, building: Building) -> bool:
+        return self._buildings.get(getattr(building, "id", None)) is building
+
+    def __len__(self) -> int:
+        return len(self._buildings)
+
+    def __iter__(self) -> Iterator[Building]:
+        with self._lock:
+            return iter(tuple(self._buildings.values()))
+
+
+class District(NamedTuple):
+    """Copied roads and buildings of area, their positions are relative to corner of area."""
+
+    roads: Tuple[RoadRecord, ...]
+    buildings: Tuple[BuildingRecord, ...]
+
+
+class TownBatch:
+    """Changes of town which are buffered and applied together by commit, see Town.batch.
+        All of them are checked before town is changed, so batch is applied wholly or isn't applied at all.
+        Buildings of batch are placed only on empty cells inside town. They are checked by rules of player
+        (doors and distances of groups, see ProjectedBuilding.canBuild) only if player_rules is set."""
+
+    def __init__(self, town: 'Town', player_rules: bool = False):
+        self.town = town
+        self.player_rules = player_rules
+        self.roads: List[RoadRecord] = []
+        self.buildings: List[BuildingRecord] = []
+        self.destroyed: Dict[int, Building] = {}  # {id(building): building}, it keeps order of destroy
+        self.added_roads: List[Road] = []  # roads and buildings added by commit
+        self.added_buildings: List[Building] = []
+
+    def addRoad(self, record: RoadRecord) -> None:
+        self.roads.append(record)
+
+    def addBuilding(self, record: BuildingRecord) -> None:
+        self.buildings.append(record)
+
+    def destroy(self, building: Building) -> None:
+        self.destroyed[id(building)] = building
+
+    @staticmethod
+    def _cells(record: BuildingRecord) -> Iterator[Tuple[int, int, int]]:
+        positions = BuildingTypes.building_types[record.building_type].blockPositions(record.btype_variant,
+                                                                                      record.angle)
+        return ((record.x + x, record.y + y, z) for x, y, z in positions)
+
+    def errors(self) -> List[str]:
+        """Problems which don't let to commit batch."""
+
+        town = self.town
+        errors = town.recordErrors(self.roads, self.buildings)
+        if errors:
+            return errors
+
+        freed = set()
+        for building in self.destroyed.values():
+            if building not in town.buildings:
+                errors.append(f"building ({building.x}, {building.y}) is not in town")
+            freed.update(self._cells(building.record()))
+
+        taken = set()  # cells taken by batch
+
+        def take(x: int, y: int, z: int, name: str) -> None:
+            if not (0 <= x <= 255 and 0 <= y <= 255):
+                errors.append(f"{name} is out of town on ({x}, {y})")
+            elif (x, y, z) in taken or (x, y, z) not in freed and not town.isBlockEmpty(x, y, z, False):
+                errors.append(f"{name} is on not empty cell ({x}, {y}, {z})")
+            taken.add((x, y, z))
+
+        for record in self.roads:
+            take(record.x, record.y, 0, f"road ({record.x}, {record.y})")
+        for record in self.buildings:
+            for x, y, z in self._cells(record):
+                take(x, y, z, f"building ({record.x}, {record.y})")
+        if self.player_rules and not errors:
+            errors.extend(self._ruleErrors())
+        return errors
+
+    def _ruleErrors(self) -> List[str]:
+        """Problems of buildings of batch by rules of player, they are checked on town as it would be after commit.
+            Building of group must be near buildings of group built before it, buildings of batch are taken in any
+            order which lets to build them one by one."""
+
+        town = self.town
+        templates = [town._recordTemplate(record.building_type, record.btype_variant, record.angle)
+                     for record in self.buildings]
+        ground = {}  # {(x, y): (block, angle, variant)} of blocks of batch on z = 0
+        cells = []  # cells of blocks on z = 0 of every building of batch
+        for record, (_, blocks, _, width, height, indexes, _) in zip(self.buildings, templates):
+            variants = tuple(record.blocks_variants) + (None,)
+            cells.append([])
+            for x in range(width):
+                for y in range(height):
+                    if blocks[x][y] and blocks[x][y][0] is not None:
+                        ground[(record.x + x, record.y + y)] = \
+                            (blocks[x][y][0], record.angle, variants[indexes[x][y][0]])
+                        cells[-1].append((record.x + x, record.y + y))
+
+        def isTaken(x: int, y: int) -> bool:
+            building = town.getBuilding(x, y)
+            return (x, y) in ground or isinstance(building, Building) and id(building) not in self.destroyed
+
+        errors = []
+        for record, template in zip(self.buildings, templates):
+            for x in range(record.x - 1, record.x + template[3] + 1):
+                for y in range(record.y - 1, record.y + template[4] + 1):
+                    block = ground.get((x, y))
+                    if block is None and isTaken(x, y):
+                        block = town.getBuilding(x, y).getBlock(x, y, 0)
+                    if block is not None and any(isTaken(*place) for place in
+                                                 block[0].placesThatMustBeEmpty(block[1], x, y, block[2])):
+                        errors.append(f"door of ({x}, {y}) is closed by building ({record.x}, {record.y})")
+
+        groups = {}  # {group: numbers of buildings of batch}
+        for number, template in enumerate(templates):
+            groups.setdefault(template[0].group, []).append(number)
+        for group, waiting in groups.items():
+            built = set()  # cells of buildings of group on z = 0
+            for building in town.buildings.inGroup(group):
+                if id(building) not in self.destroyed:
+                    built.update((building.x + x, building.y + y) for x, y, z in
+                                 building.building_type.blockPositions(building.btype_variant, building.angle)
+                                 if z == 0)
+            if not built:  # the first building of group can be anywhere
+                built.update(cells[waiting.pop(0)])
+            added = True
+            while waiting and added:
+                added = False
+                for number in list(waiting):
+                    radius = BuildingGroups.distances[group] + max(templates[number][3:5])
+                    circle = town.manhattanCircle((0, 0), radius)
+                    if all(any((x + dx, y + dy) in built for dx, dy in circle) for x, y in cells[number]):
+                        built.update(cells[number])
+                        waiting.remove(number)
+                        added = True
+            errors.extend(f"building ({self.buildings[number].x}, {self.buildings[number].y}) is far from "
+                          f"buildings of group {group}" for number in waiting)
+        return errors
+
+    @traced("TownBatch.commit")
+    def commit(self) -> None:
+        """Check and apply all changes in one pass. Masks, journal and revision of town are updated once."""
+
+        town = self.town
+        # cells checked by errors mustn't be taken by streamed chunks before changes are applied
+        with town._lock:
+            errors = self.errors()
+            if errors:
+                raise ValueError(f"Bad batch: {'; '.join(errors)}.")
+
+            destroyed = list(self.destroyed.values())
+            for building in destroyed:
+                for x, y, z in self._cells(building.record()):
+                    if town.getBuilding(x, y, z) is building:
+                        town.chunks[x // 16][y // 16].blocks[x % 16][y % 16][z] = None
+                town.markChanged(building.x, building.y, building.x + len(building.blocks) - 1,
+                             building.y + len(building.blocks[0]) - 1)
+                town.buildings.remove(building)
+
+            self.added_roads, self.added_buildings = town.addRecords(self.roads, self.buildings)
+        if town.journal is not None:
+            town.journal.changes((building.record() for building in destroyed), self.roads,
+                                 (building.record() for building in self.added_buildings))
+        if town.chosen_building is not None and (destroyed or self.buildings or self.roads):
+            town.setBuildingMaskForGroup(town.chosen_building)
+        for building in destroyed:
+            trackDestroyed(building)
 
 
 class Town:
-    def __init__(self):
+    def __init__(self, seed: int = None):
         self.version = 0
         self.name = "Carcassonne"
+        self.seed = randrange(2 ** 32) if seed is None else seed
+        self._random_streams = {}
+        self.ticks = 0
+        self.revision = 0  # it's increased by every change of buildings and roads
 
         self.cam_x = 0.0  # |
         self.cam_y = 0.0  # | - position of camera.
@@ -379,15 +909,40 @@ class Town:
         self.chosen_building = None
         self.projecting_road = None
         self.chosen_btype = 0
-
-        self.buildings = []
+        self.preview = NO_PREVIEW
+
+        self.aggregates = TownAggregates()  # statistics of buildings, roads and citizens
+        self.buildings = BuildingRegistry(self.aggregates)
+        self.roads = {}
+        self.citizens = []  # simulation state, it's changed only by tick
+        self.citizen_positions = CitizenPositions()  # positions of citizens, see Citizen.x
+        # published immutable view of citizens: {(chunk_x, chunk_y): {(x % 16, y % 16): (CitizenView, ...)}}
+        self.citizens_view = {}
+        self.simulation = None
+        self.journal = None
+        self._compactor = None
+        self._save_lock = RLock()
+        self._snapshots = 0  # count of snapshots taken to save, see _saveSnapshot
+        self._saved_snapshot = 0  # number of the last saved snapshot
+        # changes of roads, buildings and masks, they are made by GUI thread and by thread streaming chunks
+        self._lock = RLock()
+        self._loader = None
+        self._unloaded_chunks = set()  # positions of chunks waiting to be streamed
+        self._changed_area = None  # (x1, y1, x2, y2) of cells changed since masks were computed, see markChanged
+        self._masks_key = None  # project data which masks were computed for, see setBuildingMaskForGroup
+        self._terrain = None  # thread generating ground of far chunks
+        self._terrain_lock = Lock()
         # Generate 256 initial chunks.
         self.chunks = [[Chunk(i, j) for j in range(16)] for i in range(16)]
+        self._startTerrain()
 
-    def addBlock(self, x: int, y: int, z: int, building: Union[Building, ProjectedBuilding]) -> None:
+    def addBlock(self, x: int, y: int, z: int, building: Building) -> None:
         if 0 <= x <= 255 and 0 <= y <= 255:
             self.chunks[x // 16][y // 16].blocks[x % 16][y % 16][z] = building
+            self.revision += 1
+            self.markChanged(x, y, x, y)
 
+    @traced("Town.draw")
     def draw(self, painter: QPainter, size: QSize, projecting_opacity: float, builded_opacity: float = 1) -> None:
         """Draw town on screen with changed size."""
 
@@ -397,15 +952,27 @@ class Town:
         x = int(self.cam_x - (self.cam_z * size.width()) / 2)
         y = int(self.cam_y - (self.cam_z * size.height()) / 2)
 
+        start = perf_counter()
+        citizens = self.citizens_view
+        preview = self.preview.chunks
+        chunks_count = 0
         painter.save()
         painter.scale(self.scale, self.scale)
         for chunks in self.chunks:
             for chunk in chunks:
-                if self._isChunkVisible(chunk, size):
-                    chunk.draw(painter, x, y, projecting_opacity, builded_opacity)
+                if self.isChunkVisible(chunk, size):
+                    position = (chunk.x // 16, chunk.y // 16)
+                    chunk.draw(painter, x, y, projecting_opacity, builded_opacity, citizens.get(position),
+                               preview.get(position))
+                    chunks_count += 1
+                else:
+                    chunk.dropMaskImage()  # only images of visible chunks are kept
 
         painter.restore()
+        if frameProfiler.enabled:
+            frameProfiler.lap("Town.draw", start, chunks_count)
 
+    @traced("Town.isBlocksEmpty")
     def isBlocksEmpty(self, iso_x: int, iso_y: int, blocks: Tuple[Tuple[Tuple[Block]]],
                       road_is_not_block: bool = True) -> bool:
         for y in range(len(blocks[0])):
@@ -424,11 +991,27 @@ class Town:
         """Check for buildings on position x, y, z."""
 
         if 0 <= x <= 255 and 0 <= y <= 255 and 0 <= z <= 4:
-            return (not isinstance(self.getBuilding(x, y, z), Building)) and \
+            return self.isCellLoaded(x, y) and \
+                   (not isinstance(self.getBuilding(x, y, z), Building)) and \
                    (road_is_not_block or z != 0 or not isinstance(self.getRoad(x, y), Road))
         return True
 
-    def _isChunkVisible(self, chunk: Chunk, size: QSize) -> bool:
+    def isCellLoaded(self, x: int, y: int) -> bool:
+        """Check that chunks which buildings can reach cell x, y from are loaded.
+            Building is saved in chunk of its origin and covers cells to the bigger x and y from it, so while
+            chunk is streamed, cells near it are taken by its buildings, which aren't known yet."""
+
+        unloaded = self._unloaded_chunks
+        if not unloaded:
+            return True
+        reach = BuildingTypes.max_size - 1
+        for chunk_x in range(max(x - reach, 0) // 16, x // 16 + 1):
+            for chunk_y in range(max(y - reach, 0) // 16, y // 16 + 1):
+                if (chunk_x, chunk_y) in unloaded:
+                    return False
+        return True
+
+    def isChunkVisible(self, chunk: Chunk, size: QSize) -> bool:
         x = int(self.cam_x - (self.cam_z * size.width()) / 2)
         y = int(self.cam_y - (self.cam_z * size.height()) / 2)
         return (-16 * ISOMETRIC_WIDTH <= ((chunk.x - chunk.y) * ISOMETRIC_WIDTH - x) <=
@@ -439,16 +1022,13 @@ class Town:
     def isNearBuildingWithGroup(self, group: int, point: Tuple[int, int]) -> bool:
         """Check for buildings in radius equal group max distance."""
 
-        is_group_exist = False
-        for building in self.buildings:
-            if building.building_type.group == group:
-                is_group_exist = True
-        if not is_group_exist:
+        if not self.buildings.groupCount(group):
             return True
 
         radius = BuildingGroups.distances[group]
         for x, y in self.manhattanCircle(point, radius):
-            if not self.isBlockEmpty(x, y, 0) and self.getBuilding(x, y).building_type.group == group:
+            building = self.getBuilding(x, y)
+            if isinstance(building, Building) and building.building_type.group == group:
                 return True
         return False
 
@@ -469,61 +1049,210 @@ class Town:
         if 0 <= x <= 255 and 0 <= y <= 255 and 0 <= z <= 4:
             return self.chunks[x // 16][y // 16].blocks[x % 16][y % 16][z]
 
-    def getRoad(self, x: int, y: int) -> Road:
-        """Road on position x, y."""
+    def getRoad(self, x: int, y: int, with_preview: bool = False) -> Road:
+        """Road on position x, y. If with_preview, projecting road is returned on its empty place."""
 
         if 0 <= x <= 255 and 0 <= y <= 255:
-            return self.chunks[x // 16][y // 16].roads[x % 16][y % 16]
+            road = self.chunks[x // 16][y // 16].roads[x % 16][y % 16]
+            if road is None and with_preview and not isinstance(self.getBuilding(x, y), Building):
+                return self.preview.roads.get((x, y))
+            return road
+
+    @contextmanager
+    def batch(self, player_rules: bool = False) -> Iterator[TownBatch]:
+        """Buffer changes made by batch in with block and commit them together at its end.
+            Nothing is changed if block raises exception or changes can't be applied."""
+
+        batch = TownBatch(self, player_rules)
+        yield batch
+        batch.commit()
+
+    @traced("Town.buildRoads")
+    def buildRoads(self, cells: Iterable[Tuple[int, int]], road_type: RoadType) -> List[Road]:
+        """Build roads on cells which are empty by one batch. Return built roads."""
+
+        with self.batch() as batch:
+            for x, y in dict.fromkeys(cells):
+                if 0 <= x <= 255 and 0 <= y <= 255 and self.isBlockEmpty(x, y, 0, False):
+                    batch.addRoad(RoadRecord(x, y, RoadTypes.names[road_type]))
+        return batch.added_roads
+
+    @staticmethod
+    def areaCells(x1: int, y1: int, x2: int, y2: int) -> Iterator[Tuple[int, int]]:
+        """Cells of rectangle with corners x1, y1 and x2, y2 which are inside town."""
+
+        for x in range(max(min(x1, x2), 0), min(max(x1, x2), 255) + 1):
+            for y in range(max(min(y1, y2), 0), min(max(y1, y2), 255) + 1):
+                yield x, y
+
+    def buildingsInArea(self, x1: int, y1: int, x2: int, y2: int) -> List[Building]:
+        """Buildings which have some blocks in rectangle with corners x1, y1 and x2, y2."""
+
+        buildings = {}
+        for x, y in self.areaCells(x1, y1, x2, y2):
+            for building in self.chunks[x // 16][y // 16].blocks[x % 16][y % 16]:
+                if isinstance(building, Building):
+                    buildings.setdefault(id(building), building)
+        return list(buildings.values())
+
+    @traced("Town.destroyArea")
+    def destroyArea(self, x1: int, y1: int, x2: int, y2: int) -> List[Building]:
+        """Destroy buildings in rectangle with corners x1, y1 and x2, y2 by one batch. Return destroyed buildings."""
+
+        with self.batch() as batch:
+            for building in self.buildingsInArea(x1, y1, x2, y2):
+                batch.destroy(building)
+        return list(batch.destroyed.values())
+
+    def copyDistrict(self, x1: int, y1: int, x2: int, y2: int) -> District:
+        """Roads and buildings in rectangle with corners x1, y1 and x2, y2."""
+
+        left, top = min(x1, x2), min(y1, y2)
+        return District(
+            tuple(self.roads[cell].record()._replace(x=cell[0] - left, y=cell[1] - top)
+                  for cell in self.areaCells(x1, y1, x2, y2) if cell in self.roads),
+            tuple(building.record()._replace(x=building.x - left, y=building.y - top, id=None)
+                  for building in self.buildingsInArea(x1, y1, x2, y2))
+        )
+
+    @traced("Town.pasteDistrict")
+    def pasteDistrict(self, district: District, x: int, y: int) -> bool:
+        """Build copy of district with corner on x, y by one batch. Nothing is built if some place isn't empty
+            or some building can't be built by rules of player."""
+
+        try:
+            with self.batch(player_rules=True) as batch:
+                for record in district.roads:
+                    batch.addRoad(record._replace(x=record.x + x, y=record.y + y))
+                for record in district.buildings:
+                    batch.addBuilding(record._replace(x=record.x + x, y=record.y + y))
+        except ValueError:
+            return False
+        return True
+
+    def hidePreview(self, source: Union[ProjectedBuilding, ProjectedRoad, AreaSelection]) -> None:
+        """Remove preview of source if it's shown."""
+
+        if self.preview.source is source:
+            self.preview = NO_PREVIEW
 
     def removeBlock(self, x: int, y: int, z: int) -> None:
         """Remove Building from position x, y, z."""
 
         if 0 <= x <= 255 and 0 <= y <= 255 and 0 <= z <= 4:
             self.chunks[x // 16][y // 16].blocks[x % 16][y % 16][z] = None
+            self.revision += 1
+            self.markChanged(x, y, x, y)
+
+    def markChanged(self, x1: int, y1: int, x2: int, y2: int) -> None:
+        """Add rectangle of cells where buildings or roads are changed to area whose masks are computed again."""
+
+        with self._lock:
+            area = self._changed_area
+            if area is not None:
+                x1, y1, x2, y2 = min(x1, area[0]), min(y1, area[1]), max(x2, area[2]), max(y2, area[3])
+            self._changed_area = (x1, y1, x2, y2)
 
     def scaleByEvent(self, event: QWheelEvent) -> None:
         """Change zoom."""
 
-        delta = -event.angleDelta().y() / (self.scale * 480)
+        self.zoom(-event.angleDelta().y() / (self.scale * 480))
+
+    def zoom(self, delta: float) -> None:
         if 0.5 <= self.cam_z + delta <= 3:
             self.cam_z += delta
             self.scale = 1 / self.cam_z
 
-    def setBuildingMaskForGroup(self, project: ProjectedBuilding = None) -> None:
-        """Add green front light on places where building could be builded."""
-
-        for chunks in self.chunks:
-            for chunk in chunks:
-                chunk.masks = tuple([None] * 16 for _ in range(16))
-
-        if project is None:
-            return
-
-        if all(building.building_type.group != project.group() for building in self.buildings):
-            for chunks in self.chunks:
-                for chunk in chunks:
-                    chunk.masks = tuple([Masks.green if self.isBlockEmpty(x + chunk.x, y + chunk.y, 0, False)
-                                         else None for y in range(16)] for x in range(16))
-            for building in self.buildings:
-                for i in range(building.x, building.x + len(building.blocks)):
-                    for j in range(building.y, building.y + len(building.blocks[0])):
-                        if self.getBuilding(i, j) is not None:
-                            for x, y in self.getBlock(i, j)[0].placesThatMustBeEmpty(*self.getBlock(i, j)[1:]):
-                                self.chunks[x // 16][y // 16].masks[x % 16][y % 16] = None
-            return
+    def random(self, stream: str) -> Random:
+        """Random numbers generator of subsystem called stream. It's seeded by seed of town and name of stream,
+            so streams don't depend on each other and are the same in every session with the same seed."""
+
+        if stream not in self._random_streams:
+            self._random_streams[stream] = Random(f"{self.seed}/{stream}")
+        return self._random_streams[stream]
+
+    def randomStates(self) -> Dict[str, list]:
+        """States of used random streams as lists which can be written as JSON, see setRandomStates."""
+
+        states = {}
+        for stream, rnd in list(self._random_streams.items()):
+            version, internal, gauss = rnd.getstate()
+            states[stream] = [version, list(internal), gauss]
+        return states
+
+    def setRandomStates(self, states: Dict[str, list]) -> None:
+        for stream, (version, internal, gauss) in states.items():
+            self.random(stream).setstate((version, tuple(internal), gauss))
+
+    @traced("Town.setBuildingMaskForGroup")
+    def setBuildingMaskForGroup(self, project: ProjectedBuilding = None) -> int:
+        """Add green front light on places where building could be builded.
+            If masks were computed for project of the same group and size, only masks around cells changed since it
+            are computed again. Only chunks with changed masks render them again, return count of such chunks."""
+
+        with self._lock:
+            key = None
+            if project is not None:
+                size = max(len(project.blocks), len(project.blocks[0]))
+                key = (project.group(), size, bool(self.buildings.groupCount(project.group())))
+            changed_area, self._changed_area = self._changed_area, None
+            area = (0, 0, 255, 255)
+            if key is not None and key == self._masks_key:
+                if changed_area is None:
+                    return 0
+                # mask of cell depends on buildings of group in radius and on doors of its neighbours
+                reach = BuildingGroups.distances[key[0]] + key[1] + 1
+                area = (max(changed_area[0] - reach, 0), max(changed_area[1] - reach, 0),
+                        min(changed_area[2] + reach, 255), min(changed_area[3] + reach, 255))
+            self._masks_key = key
+            masks = self._groupMasks(project, area) if project is not None else {}
+
+            x1, y1, x2, y2 = area
+            changed = 0
+            for chunk_x in range(x1 // 16, x2 // 16 + 1):
+                for chunk_y in range(y1 // 16, y2 // 16 + 1):
+                    chunk = self.chunks[chunk_x][chunk_y]
+                    changed += chunk.setMasks(masks.get((chunk_x, chunk_y), {}), (
+                        max(x1 - chunk.x, 0), max(y1 - chunk.y, 0), min(x2 - chunk.x, 15), min(y2 - chunk.y, 15)
+                    ))
+        return changed
+
+    def _groupMasks(self, project: ProjectedBuilding, area: Tuple[int, int, int, int] = (0, 0, 255, 255)
+                    ) -> Dict[Tuple[int, int], Dict[Tuple[int, int], Mask]]:
+        """Masks of cells in area (x1, y1, x2, y2) for project as {(chunk_x, chunk_y): {(x % 16, y % 16): mask}}."""
+
+        x1, y1, x2, y2 = area
+        masks = {}
+        if not self.buildings.groupCount(project.group()):
+            for x, y in self.areaCells(*area):
+                if self.isBlockEmpty(x, y, 0, False):
+                    masks.setdefault((x // 16, y // 16), {})[(x % 16, y % 16)] = Masks.green
+            # doors of blocks near area
+            for i, j in self.areaCells(x1 - 1, y1 - 1, x2 + 1, y2 + 1):
+                if self.getBuilding(i, j) is not None:
+                    for x, y in self.getBlock(i, j)[0].placesThatMustBeEmpty(*self.getBlock(i, j)[1:]):
+                        if x1 <= x <= x2 and y1 <= y <= y2:
+                            masks.get((x // 16, y // 16), {}).pop((x % 16, y % 16), None)
+            return masks
 
         radius = BuildingGroups.distances[project.group()] + max(len(project.blocks), len(project.blocks[0]))
-        for building in self.buildings:
-            if building.building_type.group == project.group():
-                for i in range(building.x, building.x + len(building.blocks)):
-                    for j in range(building.y, building.y + len(building.blocks[0])):
-                        if self.getBuilding(i, j) is not None:
-                            for x, y in self.manhattanCircle((i, j), radius):
-                                if (all((self.getBlock(xx, yy) is None or not (x, y) in
-                                         self.getBlock(xx, yy)[0].placesThatMustBeEmpty(*self.getBlock(xx, yy)[1:]))
-                                        for xx, yy in ((x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y)))
-                                        and self.getRoad(x, y) is None):
-                                    self.chunks[x // 16][y // 16].masks[x % 16][y % 16] = Masks.green
+        for building in self.buildings.inGroup(project.group()):
+            if (building.x - radius > x2 or building.x + len(building.blocks) - 1 + radius < x1
+                    or building.y - radius > y2 or building.y + len(building.blocks[0]) - 1 + radius < y1):
+                continue
+            for i in range(building.x, building.x + len(building.blocks)):
+                for j in range(building.y, building.y + len(building.blocks[0])):
+                    if self.getBuilding(i, j) is not None:
+                        for x, y in self.manhattanCircle((i, j), radius):
+                            if (x1 <= x <= x2 and y1 <= y <= y2
+                                    and (x % 16, y % 16) not in masks.get((x // 16, y // 16), ())
+                                    and all((self.getBlock(xx, yy) is None or not (x, y) in
+                                             self.getBlock(xx, yy)[0].placesThatMustBeEmpty(
+                                                 *self.getBlock(xx, yy)[1:]))
+                                            for xx, yy in ((x, y - 1), (x, y + 1), (x + 1, y), (x - 1, y)))
+                                    and self.getRoad(x, y) is None):
+                                masks.setdefault((x // 16, y // 16), {})[(x % 16, y % 16)] = Masks.green
+        return masks
 
     @staticmethod
     def _saveFileName():
@@ -534,29 +1263,174 @@ class Town:
         else:
             return f"{os.path.expanduser('~')}/.medieval-rise/save.dat"
 
-    def save(self):
-        with open(self._saveFileName(), 'w') as file:
-            file.write(f'{self.version}\n')
-            file.write(f'{self.name} {int(self.cam_x)} {int(self.cam_y)} {self.cam_z}\n')
-            for x in range(256):
-                for y in range(256):
-                    road = self.chunks[x // 16][y // 16].roads[x % 16][y % 16]
-                    if road is not None:
-                        file.write(f'{x} {y} {fromValues(road.road_type, RoadTypes.road_types)} ')
-            file.write('\n')
-            for building in self.buildings:
-                building.save(file)
-
+    def snapshot(self) -> 'TownSnapshot':
+        """Immutable copy of town data which is saved."""
+
+        self.waitLoaded()
+        with self._lock:
+            return TownSnapshot(self.version, self.name, self.cam_x, self.cam_y, self.cam_z, self.seed,
+                                tuple(self.roads.values()), tuple(self.buildings), self.buildings.next_id)
+
+    @traced("Town.save")
+    def save(self, snapshot: 'TownSnapshot' = None, file_name: str = None,
+             progress: Callable[[float], None] = None) -> None:
+        """Save snapshot of town, the current one by default.
+            progress is called with the done part of work."""
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+        file_name = file_name or self._saveFileName()
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+
+        buildings = []
+        for i, building in enumerate(snapshot.buildings):
+            buildings.append(building.record())
+            if progress is not None and i % 256 == 0:
+                progress(.9 * i / len(snapshot.buildings))
+
+        with self._save_lock:
+            # the old save is replaced only by a completely written new one
+            with open(file_name + '.tmp', 'wb') as file:
+                writeSave(file,
+                          SaveHeader(snapshot.version, snapshot.name, snapshot.cam_x, snapshot.cam_y, snapshot.cam_z,
+                                     snapshot.seed, snapshot.next_building_id),
+                          [road.record() for road in snapshot.roads],
+                          buildings)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(file_name + '.tmp', file_name)
+        if progress is not None:
+            progress(1)
+
+    def saveInBackground(self, progress: Callable[[float], None] = None,
+                         done: Callable[[], None] = None) -> Thread:
+        """Save town on a worker thread. Snapshot of town is taken on the current thread and only it is given to
+            the worker thread. progress and done are called from the worker thread."""
+
+        with self._save_lock:
+            number, snapshot = self._saveSnapshot()
+
+        def work():
+            self._saveNumbered(number, snapshot, progress)
+            if done is not None:
+                done()
+
+        thread = Thread(target=work, name="save")
+        thread.start()
+        return thread
+
+    def startJournal(self, interval: float = 60, file_name: str = None) -> None:
+        """Write every change to journal and compact it into save every interval seconds."""
+
+        file_name = file_name or self._saveFileName()
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        journal_file_name = journalFileName(file_name)
+        if journalVersion(journal_file_name) not in (None, JOURNAL_VERSION):
+            # town is loaded with changes of old journals, so they are saved and new journal is started
+            self.save(file_name=file_name)
+            for name in (journal_file_name, journal_file_name + ".old"):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.journal = Journal(file_name)
+        self._compactor = JournalCompactor(interval, self.compactJournal)
+        self._compactor.start()
+
+    def stopJournal(self) -> None:
+        """Save town and stop journaling."""
+
+        if self.journal is not None:
+            self._compactor.cancel()
+            self._compactor.join()
+            self.compactJournal()
+            self.journal.close()
+            os.remove(self.journal.file_name)
+            self.journal = self._compactor = None
+
+    @traced("Town.compactJournal")
+    def compactJournal(self, progress: Callable[[float], None] = None) -> None:
+        """Save full snapshot of town and clear journal."""
+
+        with self._save_lock:
+            self._saveNumbered(*self._saveSnapshot(), progress)
+
+    def _saveSnapshot(self) -> Tuple[int, TownSnapshot]:
+        """Number and snapshot of town which is saved. It's called under save lock."""
+
+        self._snapshots += 1
+        if self.journal is not None:
+            # changes made before rotation are in town before the snapshot, changes after it are in the new journal
+            self.journal.rotate()
+        return self._snapshots, self.snapshot()
+
+    def _saveNumbered(self, number: int, snapshot: TownSnapshot, progress: Callable[[float], None] = None) -> None:
+        """Save snapshot taken by _saveSnapshot if a newer one isn't saved yet. Rotated journal is removed only
+            if no snapshot was taken after it, else it has changes which aren't in this snapshot."""
+
+        with self._save_lock:
+            if number < self._saved_snapshot:
+                return
+            self.save(snapshot, None if self.journal is None else self.journal.save_file_name, progress)
+            self._saved_snapshot = number
+            if self.journal is not None and number == self._snapshots:
+                self.journal.removeRotated()
+
+    def startRegionSimulation(self, regions: int = 4) -> None:
+        """Simulate citizens in worker processes, a process per region of chunks."""
+
+        self.stopRegionSimulation()
+        self.simulation = RegionSimulation(self.citizen_positions, regions)
+
+    def stopRegionSimulation(self) -> None:
+        """Return to simulation in the current thread."""
+
+        if self.simulation is not None:
+            self.simulation.close()
+            self.simulation = None
+
+    @traced("Town.tick")
     def tick(self, screen: QSize) -> None:
         """Game tick."""
 
-        for chunks in self.chunks:
-            for chunk in chunks:
-                if self._isChunkVisible(chunk, screen):
-                    for x in range(16):
-                        for y in range(16):
-                            for citizen in chunk.citizens[x][y]:
-                                citizen.step()
+        start = perf_counter()
+        aggregates = self.aggregates
+        if self.simulation is None:
+            citizens = []
+            for citizen in self.citizens:
+                if citizen.isOnMap():
+                    chunk = self.chunks[int(citizen.x // 16)][int(citizen.y // 16)]
+                    if chunk.loaded and self.isChunkVisible(chunk, screen):
+                        citizens.append(citizen)
+            for citizen in citizens:
+                x, y = citizen.x, citizen.y
+                citizen.step()
+                aggregates.moveCitizen(x, y, citizen.x, citizen.y)
+            stepped = len(citizens)
+        else:
+            # workers step citizens in shared memory, only citizens which went to another chunk are returned
+            chunks = bytes(chunk.loaded and self.isChunkVisible(chunk, screen)
+                           for column in self.chunks for chunk in column)
+            stepped, moves = self.simulation.step(chunks, self.seed, self.ticks)
+            for move in moves:
+                aggregates.moveCitizen(*move)
+        self.ticks += 1
+        self.publishCitizens()
+        if aggregates.checking:
+            aggregates.check(self)
+        if frameProfiler.enabled:
+            frameProfiler.addTick(perf_counter() - start, stepped)
+
+    def publishCitizens(self) -> None:
+        """Replace published view of citizens by the current state of simulation.
+            The view is swapped by one assignment and never changed after it, so drawing doesn't need locks."""
+
+        view = {}
+        for citizen in sorted(self.citizens, key=lambda citizen: (citizen.y, citizen.x)):
+            if citizen.isOnMap():
+                x, y = int(citizen.x), int(citizen.y)
+                view.setdefault((x // 16, y // 16), {}).setdefault((x % 16, y % 16), []).append(citizen.view())
+        self.citizens_view = {
+            chunk: {cell: tuple(citizens) for cell, citizens in cells.items()} for chunk, cells in view.items()
+        }
 
     def translate(self, delta: QPoint) -> None:
         """Translate camera."""
@@ -577,75 +1451,340 @@ class Town:
                 })
         return answer
 
-    def load(self) -> None:
-        """Load town data from file."""
+    def recordErrors(self, roads: Iterable[RoadRecord], buildings: Iterable[BuildingRecord]) -> List[str]:
+        """Problems of records which can't be added to town."""
+
+        errors = []
+        ids = set()
+        for road in roads:
+            if road.road_type not in RoadTypes.road_types:
+                errors.append(f'road type "{road.road_type}" does not exist')
+            if not (0 <= road.x <= 255 and 0 <= road.y <= 255):
+                errors.append(f"road ({road.x}, {road.y}) is out of town")
+        counts = {}  # {(building type, variant, angle): count of blocks or None if they are wrong}
+        for record in buildings:
+            key = (record.building_type, record.btype_variant, record.angle)
+            if key not in counts:
+                building_type = BuildingTypes.building_types.get(record.building_type)
+                counts[key] = len(building_type.blockPositions(record.btype_variant, record.angle)) \
+                    if building_type is not None and record.btype_variant in building_type.blocks and \
+                    record.angle in {0, 90, 180, 270} else None
+            count = counts[key]
+            if count is None:
+                building_type = BuildingTypes.building_types.get(record.building_type)
+                if building_type is None:
+                    errors.append(f'building type "{record.building_type}" does not exist')
+                elif record.btype_variant not in building_type.blocks:
+                    errors.append(f'building type "{record.building_type}" has not variant "{record.btype_variant}"')
+                else:
+                    errors.append(f"angle of building ({record.x}, {record.y}) is {record.angle}")
+            elif count != len(record.blocks_variants):
+                errors.append(f"building ({record.x}, {record.y}) has wrong count of blocks variants")
+            if record.id is not None:
+                if record.id in ids or self.buildings.get(record.id) is not None:
+                    errors.append(f"building ({record.x}, {record.y}) has used id {record.id}")
+                ids.add(record.id)
+        return errors
+
+    @staticmethod
+    def _recordTemplate(building_type_name: str, btype_variant: str, angle: int) -> tuple:
+        """Data which are the same for all buildings of type, variant and angle: building type, blocks,
+            columns of blocks (x, y, heights of blocks), size, indexes of variants of blocks in matrix of blocks
+            and cache of matrices of variants. Index of empty block is count of positions, so variants of record with
+            None at end are indexed."""
+
+        building_type = BuildingTypes.building_types[building_type_name]
+        blocks = building_type.rotatedBlocks(btype_variant, angle)
+        positions = building_type.blockPositions(btype_variant, angle)
+        numbers = {position: number for number, position in enumerate(positions)}
+        indexes = tuple(
+            tuple(tuple(numbers.get((x, y, z), len(positions)) for z in range(len(blocks_xy)))
+                  for y, blocks_xy in enumerate(blocks_x))
+            for x, blocks_x in enumerate(blocks)
+        )
+        columns = {}
+        for x, y, z in positions:
+            columns.setdefault((x, y), []).append(z)
+        # column filled from the ground is one slice, its heights are the count of blocks
+        columns = tuple((x, y, len(heights) if heights == list(range(len(heights))) else tuple(heights))
+                        for (x, y), heights in columns.items())
+        return building_type, blocks, columns, len(blocks), len(blocks[0]), indexes, {}
+
+    @traced("Town.addRecords")
+    def addRecords(self, roads: Iterable[RoadRecord],
+                   buildings: Iterable[BuildingRecord]) -> Tuple[List[Road], List[Building]]:
+        """Add saved roads and buildings to town in one pass without constructors of Road and Building.
+            All records are checked before town is changed. Added objects aren't journaled, they are returned.
+            Data of buildings of the same type, variant and angle are computed once, the same variants of blocks
+            are shared, registry and aggregates are changed once."""
+
+        roads = list(roads)
+        buildings = list(buildings)
+
+        # GUI thread and thread streaming chunks add objects, ids are checked and given under the same lock
+        with self._lock:
+            errors = self.recordErrors(roads, buildings)
+            if errors:
+                raise ValueError(f"Bad records: {'; '.join(errors)}.")
+
+            chunks = self.chunks
+            road_types = RoadTypes.road_types
+            town_roads = self.roads
+            added_roads = []
+            for record in roads:
+                x, y = record.x, record.y
+                road = Road.__new__(Road)
+                road.__dict__ = {"x": x, "y": y, "angle": 0, "town": self, "road_type": road_types[record.road_type]}
+                chunks[x // 16][y // 16].roads[x % 16][y % 16] = road
+                town_roads[(x, y)] = road
+                added_roads.append(road)
+            self.aggregates.addRoads(roads)
+            if roads:
+                self.markChanged(min(record.x for record in roads), min(record.y for record in roads),
+                                 max(record.x for record in roads), max(record.y for record in roads))
+
+            templates = {}  # {(building type, variant, angle): _recordTemplate}
+            added_buildings = []
+            placements = []  # (building, columns of its blocks, is it inside town)
+            for record in buildings:
+                key = (record.building_type, record.btype_variant, record.angle)
+                template = templates.get(key)
+                if template is None:
+                    template = templates[key] = self._recordTemplate(*key)
+                building_type, blocks, columns, width, height, indexes, variants = template
+
+                # the same variants of blocks are shared by buildings
+                record_variants = tuple(record.blocks_variants)
+                blocks_variants = variants.get(record_variants)
+                if blocks_variants is None:
+                    record_variants += (None,)
+                    blocks_variants = variants[record_variants[:-1]] = tuple(
+                        tuple(tuple(map(record_variants.__getitem__, indexes_xy)) for indexes_xy in indexes_x)
+                        for indexes_x in indexes
+                    )
+                x0, y0 = record.x, record.y
+                building = Building.__new__(Building)
+                # attributes of Building.__init__ by one assignment
+                building.__dict__ = {"x": x0, "y": y0, "angle": record.angle, "town": self,
+                                     "building_type": building_type, "btype_variant": record.btype_variant,
+                                     "blocks": blocks, "blocks_variants": blocks_variants}
+                added_buildings.append(building)
+                inside = 0 <= x0 and x0 + width <= 256 and 0 <= y0 and y0 + height <= 256
+                placements.append((building, columns, inside))
+            # buildings have ids before they can be found in chunks
+            self.buildings.addMany(added_buildings, [record.id for record in buildings])
+            for building, columns, inside in placements:
+                x0, y0 = building.x, building.y
+                for x, y, heights in columns:
+                    x += x0
+                    y += y0
+                    if inside or 0 <= x <= 255 and 0 <= y <= 255:
+                        column = chunks[x // 16][y // 16].blocks[x % 16][y % 16]
+                        if isinstance(heights, int):
+                            column[:heights] = (building,) * heights
+                        else:
+                            for z in heights:
+                                column[z] = building
+            if buildings:
+                size = BuildingTypes.max_size - 1
+                self.markChanged(min(record.x for record in buildings), min(record.y for record in buildings),
+                                 max(record.x for record in buildings) + size,
+                                 max(record.y for record in buildings) + size)
+            self.revision += 1
+        return added_roads, added_buildings
+
+    def _setHeader(self, header: SaveHeader) -> None:
+        self.version = header.version
+        self.name = header.name
+        self.cam_x, self.cam_y, self.cam_z = header.cam_x, header.cam_y, header.cam_z
+        self.scale = 1 / self.cam_z
+        self.buildings.reserve(header.next_building_id)
+        self._random_streams = {}  # they depend on seed
+        if header.seed != self.seed:
+            with self._terrain_lock:
+                self.seed = header.seed
+            self._startTerrain()
+
+    @traced("Town.load")
+    def load(self, file_name: str = None, stream: bool = False) -> None:
+        """Load town data from file in binary or old text format.
+            If stream, only chunks near camera are loaded now and others are loaded in background."""
+
+        file_name = file_name or self._saveFileName()
+        journal_file_name = journalFileName(file_name)
 
         try:
-            with open(self._saveFileName()) as file:
-                self.version = int(file.readline()[:-1])
-                town_data = file.readline().split()
-                self.name = town_data[0]
-                self.cam_x, self.cam_y, self.cam_z = map(float, town_data[1:])
-                self.scale = 1 / self.cam_z
-                roads_data = file.readline().split()
-                for i in range(0, len(roads_data), 3):
-                    Road(self, int(roads_data[i]), int(roads_data[i + 1]), RoadTypes.__getattr__(roads_data[i + 2]))
-                for building_data in file.readlines():
-                    data = building_data.split()
-                    building_type = BuildingTypes.__getattr__(data[3])
-                    variant = data[4]
-                    blocks = turnMatrix(building_type.blocks[variant], int(data[2]) * 90)
-                    blocks_variants = [[[None] * len(blocks_xy) for blocks_xy in blocks_x]
-                                    for blocks_x in blocks]
-                    count = 0
-                    for x in range(len(blocks_variants)):
-                        for y in range(len(blocks_variants[x])):
-                            for z in range(len(blocks_variants[x][y])):
-                                if blocks[x][y][z] is not None:
-                                    blocks_variants[x][y][z] = data[count + 5]
-                                    count += 1
-                            blocks_variants[x][y] = tuple(blocks_variants[x][y])
-                        blocks_variants[x] = tuple(blocks_variants[x])
-                    Building(int(data[0]),
-                            int(data[1]),
-                            int(data[2]) * 90,
-                            self,
-                            building_type,
-                            tuple(blocks_variants),
-                            data[4])
-        except:
-            pass
+            # journals are replayed on the whole town, so town with them isn't streamed
+            if stream and isBinarySave(file_name) and not os.path.exists(journal_file_name) and \
+                    not os.path.exists(journal_file_name + ".old"):
+                save = SaveFile(file_name)
+                self._setHeader(save.header)
+                self._startStreaming(save)
+                return
+            header, chunks = readSave(file_name)
+        except (OSError, ValueError, IndexError):
+            header, chunks = None, {}
+
+        if header is not None:
+            self._setHeader(header)
+        for roads, buildings in chunks.values():
+            self.addRecords(roads, buildings)
+
+        # journals of session which wasn't saved
+        self.replayJournal(journal_file_name + ".old")
+        self.replayJournal(journal_file_name)
+
+    def _cameraDistance(self, chunk_x: int, chunk_y: int) -> float:
+        """Distance from center of chunk to the point camera looks at."""
+
+        center = isometric(self.cam_x, self.cam_y)
+        return max(abs(chunk_x * 16 + 8 - center.x()), abs(chunk_y * 16 + 8 - center.y()))
+
+    @traced("Town._loadChunk")
+    def _loadChunk(self, save: SaveFile, chunk_x: int, chunk_y: int) -> None:
+        roads, buildings = save.roads(chunk_x, chunk_y), save.buildings(chunk_x, chunk_y)
+        with self._lock:
+            self.addRecords(roads, buildings)
+            self.chunks[chunk_x][chunk_y].loaded = True
+            self._unloaded_chunks.discard((chunk_x, chunk_y))
+            # cells which buildings of chunk can reach are loaded now, so their masks are computed again
+            reach = BuildingTypes.max_size - 1
+            self.markChanged(chunk_x * 16, chunk_y * 16, min(chunk_x * 16 + 15 + reach, 255),
+                             min(chunk_y * 16 + 15 + reach, 255))
+            self.revision += 1
+
+    def _startStreaming(self, save: SaveFile) -> None:
+        chunks = list(save.chunks())
+        for chunk_x, chunk_y in chunks:
+            self.chunks[chunk_x][chunk_y].loaded = False
+        self._unloaded_chunks = set(chunks)
+
+        far = []
+        for chunk in chunks:
+            if self._cameraDistance(*chunk) <= STREAMING_RADIUS:
+                self._loadChunk(save, *chunk)
+            else:
+                far.append(chunk)
+
+        self._loader = Thread(target=self._streamChunks, args=(save, far), name="stream", daemon=True)
+        self._loader.start()
+
+    def _streamChunks(self, save: SaveFile, chunks: List[Tuple[int, int]]) -> None:
+        """Load chunks, the nearest to the current camera position first."""
+
+        with save:
+            while chunks:
+                chunk = min(chunks, key=lambda chunk: self._cameraDistance(*chunk))
+                chunks.remove(chunk)
+                self._loadChunk(save, *chunk)
+
+    def waitLoaded(self) -> None:
+        """Wait until all chunks are streamed."""
+
+        if self._loader is not None:
+            self._loader.join()
+
+    def waitTerrain(self) -> None:
+        """Wait until ground of all chunks is generated."""
+
+        terrain = self._terrain
+        if terrain is not None:
+            terrain.join()
+
+    def _startTerrain(self) -> None:
+        """Generate ground of chunks near camera now and ground of others in background.
+            Ground depends only on seed, so it isn't saved and it's generated again for a new seed."""
+
+        chunks = [(chunk_x, chunk_y) for chunk_x in range(16) for chunk_y in range(16)]
+        near = [chunk for chunk in chunks if self._cameraDistance(*chunk) <= STREAMING_RADIUS]
+        self._generateTerrain(self.seed, near)
+        far = [chunk for chunk in chunks if chunk not in near]
+        self._terrain = Thread(target=self._generateTerrain, args=(self.seed, far), name="terrain", daemon=True)
+        self._terrain.start()
+
+    def _generateTerrain(self, seed: int, chunks: List[Tuple[int, int]]) -> None:
+        """Generate ground of chunks, the nearest to the current camera position first.
+            It stops if seed of town is changed, because generation for the new seed is started."""
+
+        while chunks:
+            chunk = min(chunks, key=lambda chunk: self._cameraDistance(*chunk))
+            chunks.remove(chunk)
+            ground_ids = chunkGrounds(seed, *chunk)
+            with self._terrain_lock:
+                if seed != self.seed:
+                    return
+                self.chunks[chunk[0]][chunk[1]].ground_ids = ground_ids
+
+    def _findBuilding(self, record: BuildingRecord) -> Union['Building', None]:
+        for building in self.buildings:
+            if (building.x, building.y, building.angle) == (record.x, record.y, record.angle) and \
+                    building.record().building_type == record.building_type:
+                return building
+
+    def replayJournal(self, file_name: str) -> None:
+        """Repeat operations from journal. Operations which were already done are skipped."""
+
+        for kind, record in readJournal(file_name):
+            if kind == "R":
+                if (record.x, record.y) not in self.roads:
+                    self.addRecords((record,), ())
+            elif kind == "B":
+                if (self._findBuilding(record) if record.id is None else self.buildings.get(record.id)) is None:
+                    self.addRecords((), (record,))
+            elif kind == "D":
+                building = self._findBuilding(record) if record.id is None else self.buildings.get(record.id)
+                if building is not None:
+                    building.destroy()
+
+
+class CitizenView(NamedTuple):
+    """Immutable published state of citizen."""
+
+    x: float
+    y: float
+
+    def draw(self, painter: QPainter, x: int, y: int) -> None:
+        painter.drawImage(QPointF((self.x - self.y) * ISOMETRIC_WIDTH - 22 - x,
+                                  (self.x + self.y) * ISOMETRIC_HEIGHT1 - 53 - y), getImage("human"))
 
 
 class Citizen:
-    """Citizen of building. He walks."""
+    """Citizen of building. He walks.
+        Citizen is changed only by tick, others use CitizenView published by Town.publishCitizens."""
 
     def __init__(self, building: Building):
         self.building = building
-        self.x = building.x + len(building.blocks) + .5
-        self.y = building.y + len(building.blocks[0]) + .5
-        self._addToMap()
+        self.positions = building.town.citizen_positions
+        self.id = self.positions.append(building.x + len(building.blocks) + .5,
+                                        building.y + len(building.blocks[0]) + .5)
+        building.town.citizens.append(self)
+        building.town.aggregates.addCitizen(self.x, self.y)
 
-    def _addToMap(self) -> None:
-        insort(self.building.town.chunks[int(self.x // 16)][int(self.y // 16)].citizens[int(self.x % 16)][
-            int(self.y % 16)], self)
+    @property
+    def x(self) -> float:
+        return self.positions.data[self.id * 2]
 
-    def _delFromOldPosition(self) -> None:
-        pos = self.building.town.chunks[int(self.x // 16)][int(self.y // 16)].citizens[int(self.x % 16)][
-            int(self.y % 16)]
-        pos.pop(bisect(pos, self) - 1)
+    @x.setter
+    def x(self, value: float) -> None:
+        self.positions.data[self.id * 2] = value
 
-    def __gt__(self, other) -> bool:
-        return (self.y, self.x) > (other.y, other.x)
+    @property
+    def y(self) -> float:
+        return self.positions.data[self.id * 2 + 1]
 
-    def draw(self, painter: QPainter, x: int, y: int) -> None:
-        painter.drawImage((self.x - self.y) * ISOMETRIC_WIDTH - 22 - x,
-                          (self.x + self.y) * ISOMETRIC_HEIGHT1 - 53 - y, getImage("human"))
+    @y.setter
+    def y(self, value: float) -> None:
+        self.positions.data[self.id * 2 + 1] = value
+
+    def isOnMap(self) -> bool:
+        return 0 <= self.x < 256 and 0 <= self.y < 256
 
     def step(self):
         """Citizens walks!"""
 
-        self._delFromOldPosition()
-        self.x += randint(0, 1) * .2
-        self.y += randint(0, 1) * .2
-        self._addToMap()
+        dx, dy = citizenStep(self.building.town.seed, self.id, self.building.town.ticks)
+        self.x += dx
+        self.y += dy
+
+    def view(self) -> CitizenView:
+        return CitizenView(self.x, self.y)
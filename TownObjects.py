@@ -1,22 +1,30 @@
 from json import load
-from random import choice
-from typing import Any, Dict, List, Optional, Set, Tuple
+from random import Random, choice
+from threading import Lock, Thread
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
 from PyQt5.Qt import QSize
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPainter, QPixmap
+from PyQt5.QtCore import QPointF, Qt
+from PyQt5.QtGui import QImage, QPainter, QPixmap
 
-from resources_manager import getImage, getJSON
+from profiling import startup
+from resources_manager import ImageRef, getCompiled, getImage, getJSON, mirroredName
+from terrain import GROUND_NAMES
 
 ISOMETRIC_WIDTH = 64    # |
 ISOMETRIC_HEIGHT1 = 32  # | textures parameters
 ISOMETRIC_HEIGHT2 = 79  # |
 
-BLOCKS_DATA = getJSON("blocks")
-GROUNDS_DATA = getJSON("grounds")
-BUILDING_TYPES_DATA = getJSON("building_types")
-ROAD_TYPES_DATA = getJSON('roads_types')
-GROUPS_DATA = getJSON("buildings_groups")
+SIDES = ("NORTH", "WEST", "SOUTH", "EAST")
+# faces of blocks are added by prefetch thread while they are read by others, see loadedTextures
+_faces_lock = Lock()
+
+with startup.phase("game data"):
+    BLOCKS_DATA = getJSON("blocks")
+    GROUNDS_DATA = getJSON("grounds")
+    BUILDING_TYPES_DATA = getJSON("building_types")
+    ROAD_TYPES_DATA = getJSON('roads_types')
+    GROUPS_DATA = getJSON("buildings_groups")
 
 
 def matrixHeight(matrix: Tuple[Tuple[Any]]) -> int:
@@ -29,30 +37,35 @@ def matrix3DHeight(matrix: Tuple[Tuple[Tuple[Any]]]) -> int:
     return max(max(len(data_ij) for data_ij in data_i) for data_i in matrix)
 
 
+def turnMatrix(blocks: Tuple[Tuple[Any]], angle: int) -> Tuple[Tuple[Any]]:
+    """Turn matrix of Blocks on changed angle (in degrees)"""
+
+    # blocks is a matrix, so its height is the length of blocks[0]
+    height = len(blocks[0])
+
+    if angle == 0:
+        return blocks
+    elif angle == 90:
+        return tuple(tuple(blocks[-j - 1][i] for j in range(len(blocks))) for i in range(height))
+    elif angle == 180:
+        return tuple(tuple(blocks[-i - 1][-j - 1] for j in range(height))
+                     for i in range(len(blocks)))
+    else:
+        return tuple(tuple(blocks[j][-i - 1] for j in range(len(blocks))) for i in range(height))
+
+
 class Block:
-    """Store data of block."""
+    """Store data of block. Images of faces are loaded on first use."""
 
     def __init__(self, name: str):
         self.name = name
 
-        sides = ("NORTH", "WEST", "SOUTH", "EAST")
-        self.variants = {
-            variant: {
-                angle * 90: (
-                    getImage(f"blocks/{BLOCKS_DATA[name][variant].get(sides[(4 - angle) % 4], 'NULL')}_left", True),
-                    getImage(f"blocks/{BLOCKS_DATA[name][variant].get(sides[(5 - angle) % 4], 'NULL')}_right", True),
-                    getImage(
-                        f"blocks/{BLOCKS_DATA[name][variant].get(sides[(6 - angle) % 4], 'NULL')}_right_back", True),
-                    getImage(f"blocks/{BLOCKS_DATA[name][variant].get(sides[(7 - angle) % 4], 'NULL')}_left_back", True)
-                )
-                for angle in range(4)
-            }
-            for variant in BLOCKS_DATA[name]
-        }
+        # {variant: {angle: images of faces}}, see faces
+        self.variants = {variant: {} for variant in BLOCKS_DATA[name]}
 
         self.empty = {
             variant:
-                tuple(sides.index(side) * 90 for side in BLOCKS_DATA[name][variant].get('empty', []))
+                tuple(SIDES.index(side) * 90 for side in BLOCKS_DATA[name][variant].get('empty', []))
             for variant in BLOCKS_DATA[name]
         }
 
@@ -62,15 +75,33 @@ class Block:
     def __str__(self):
         return f"Block {self.name}"
 
+    def faces(self, variant: str, angle: int) -> Tuple[QImage, QImage, QImage, QImage]:
+        """Left, right, right back and left back faces of variant turned on angle."""
+
+        faces = self.variants[variant].get(angle)
+        if faces is None:
+            data = BLOCKS_DATA[self.name][variant]
+            turn = angle // 90
+            faces = (
+                ImageRef(f"blocks/{data.get(SIDES[(4 - turn) % 4], 'NULL')}_left", True),
+                ImageRef(f"blocks/{data.get(SIDES[(5 - turn) % 4], 'NULL')}_right", True),
+                ImageRef(f"blocks/{data.get(SIDES[(6 - turn) % 4], 'NULL')}_right_back", True),
+                ImageRef(f"blocks/{data.get(SIDES[(7 - turn) % 4], 'NULL')}_left_back", True)
+            )
+            with _faces_lock:
+                self.variants[variant][angle] = faces
+        left, right, right_back, left_back = faces
+        return left(), right(), right_back(), left_back()
+
     def draw(self, x: int, y: int, angle: int, painter: QPainter, variant: str) -> None:
         if variant not in self.variants:
             raise AttributeError(f"Block called {self.name} has not variant {variant}.")
 
-        painter.drawImage(x - ISOMETRIC_WIDTH, y - ISOMETRIC_HEIGHT2 -
-                          ISOMETRIC_HEIGHT1, self.variants[variant][angle][3])
-        painter.drawImage(x, y - ISOMETRIC_HEIGHT2 - ISOMETRIC_HEIGHT1, self.variants[variant][angle][2])
-        painter.drawImage(x - ISOMETRIC_WIDTH, y - ISOMETRIC_HEIGHT2, self.variants[variant][angle][0])
-        painter.drawImage(x, y - ISOMETRIC_HEIGHT2, self.variants[variant][angle][1])
+        faces = self.faces(variant, angle)
+        painter.drawImage(x - ISOMETRIC_WIDTH, y - ISOMETRIC_HEIGHT2 - ISOMETRIC_HEIGHT1, faces[3])
+        painter.drawImage(x, y - ISOMETRIC_HEIGHT2 - ISOMETRIC_HEIGHT1, faces[2])
+        painter.drawImage(x - ISOMETRIC_WIDTH, y - ISOMETRIC_HEIGHT2, faces[0])
+        painter.drawImage(x, y - ISOMETRIC_HEIGHT2, faces[1])
 
     def placesThatMustBeEmpty(self, angle: int, x: int, y: int, variant: str) -> Set[Tuple[int, int]]:
         answer = set()
@@ -99,14 +130,19 @@ class BlocksManager:
         raise AttributeError(f'Block "{item}" does not exist.')
 
 
-Blocks = BlocksManager()  # it have to be here because BuildingsTypesManager uses it
+with startup.phase("blocks manager"):
+    Blocks = BlocksManager()  # it have to be here because BuildingsTypesManager uses it
 
 
 class Ground:
     """Store data of ground."""
 
     def __init__(self, data: Dict[str, str]):
-        self.texture = getImage(data['texture'])
+        self._texture = ImageRef(data['texture'])
+
+    @property
+    def texture(self) -> QImage:
+        return self._texture()
 
     def draw(self, x: float, y: float, painter: QPainter) -> None:
         painter.drawImage(x - ISOMETRIC_WIDTH, y, self.texture)
@@ -114,9 +150,10 @@ class Ground:
 
 class GroundsManager:
     """Store all grounds.
-        Use Grounds.ground_name to get Ground(ground_name)."""
+        Use Grounds.ground_name to get Ground(ground_name) and Grounds.by_id[ground_id] to get ground of terrain id."""
 
     grounds = {name: Ground(GROUNDS_DATA[name]) for name in GROUNDS_DATA}
+    by_id = tuple(map(grounds.__getitem__, GROUND_NAMES))
 
     def __getattr__(self, item) -> Ground:
         if item in self.grounds:
@@ -129,61 +166,47 @@ class BuildingGroups:
     distances = {group: GROUPS_DATA[group]['max_dist'] for group in GROUPS_DATA}
 
 
+def compileBuildingType(
+        blocks: Dict[str, List[List[List[str]]]]
+) -> Dict[str, List[List[List[Tuple[str, List[str]]]]]]:
+    """Replace every block of building type data by pair of block name and its possible variants.
+        Block is written as "name" (any variant), "name!variant;..." (all variants except written)
+        or "name:variant;..." (only written variants)."""
+
+    def compileBlock(data: str) -> Tuple[str, List[str]]:
+        if "!" in data:
+            name, excluded = data.split("!")
+            return name, [variant for variant in BLOCKS_DATA[name] if variant not in excluded.split(";")]
+        elif ":" in data:
+            name, variants = data.split(":")
+            return name, variants.split(";")
+        return data, list(BLOCKS_DATA[data])
+
+    return {
+        variant: [[[compileBlock(data) for data in blocks_xy] for blocks_xy in blocks_x] for blocks_x in blocks[variant]]
+        for variant in blocks
+    }
+
+
 class BuildingType:
     """Store information about some building type."""
 
-    def __init__(self, blocks: Dict[str, List[List[List[str]]]], group: str):
+    def __init__(self, blocks: Dict[str, List[List[List[Tuple[str, List[str]]]]]], group: str):
+        """blocks are compiled by compileBuildingType."""
+
         self.group = group
-        ##################################################################################
         self.blocks = {}
         self.possible_variants = {}
 
         for variant in blocks:
-            self.blocks[variant] = []
-            self.possible_variants[variant] = []
-
-            for x in range(len(blocks[variant])):
-                self.blocks[variant] += [[]]
-                self.possible_variants[variant] += [[]]
-
-                for y in range(len(blocks[variant][x])):
-                    self.blocks[variant][x] += [[]]
-                    self.possible_variants[variant][x] += [[]]
-
-                    for z in range(len(blocks[variant][x][y])):
-                        self.blocks[variant][x][y] += [None]
-                        self.possible_variants[variant][x][y] += [None]
-
-                        data = blocks[variant][x][y][z]
-                        if "!" in data:
-                            data = data.split("!")
-                            self.possible_variants[variant][x][y][z] = tuple(
-                                set(Blocks.__getattr__(data[0]).variants).difference(
-                                    set(data[1].split(";"))
-                                )
-                            )
-                        elif ":" in data:
-                            data = data.split(":")
-                            self.possible_variants[variant][x][y][z] = tuple(
-                                data[1].split(";")
-                            )
-                        else:
-                            data = [data]
-                            self.possible_variants[variant][x][y][z] = tuple(
-                                Blocks.__getattr__(data[0]).variants
-                            )
-
-                        self.blocks[variant][x][y][z] = Blocks.__getattr__(data[0])
-
-                    self.blocks[variant][x][y] = tuple(self.blocks[variant][x][y])
-                    self.possible_variants[variant][x][y] = tuple(
-                        self.possible_variants[variant][x][y]
-                    )
-
-                self.blocks[variant][x] = tuple(self.blocks[variant][x])
-                self.possible_variants[variant][x] = tuple(
-                    self.possible_variants[variant][x]
-                )
+            self.blocks[variant] = tuple(
+                tuple(tuple(Blocks.__getattr__(block) for block, _ in blocks_xy) for blocks_xy in blocks_x)
+                for blocks_x in blocks[variant]
+            )
+            self.possible_variants[variant] = tuple(
+                tuple(tuple(tuple(variants) for _, variants in blocks_xy) for blocks_xy in blocks_x)
+                for blocks_x in blocks[variant]
+            )
 
             height = matrixHeight(self.blocks[variant])
             # convert blocks to rectangular matrix
@@ -195,17 +218,40 @@ class BuildingType:
                 blocks_y + ((None,),) * (height - len(blocks_y))
                 for blocks_y in self.possible_variants[variant]
             )
-        #######################################################################
-        self.default_variant, self.default_blocks = self.generateVariant()
+        self._rotated_blocks = {}
+        self._block_positions = {}
+        self.default_variant, self.default_blocks = self.generateVariant(Random(0))  # the same in every session
+
+    def rotatedBlocks(self, variant: str, angle: int) -> Tuple[Tuple[Tuple[Optional[Block]]]]:
+        """Blocks of variant turned on angle. Turned matrices are cached."""
+
+        if (variant, angle) not in self._rotated_blocks:
+            self._rotated_blocks[variant, angle] = turnMatrix(self.blocks[variant], angle)
+        return self._rotated_blocks[variant, angle]
+
+    def blockPositions(self, variant: str, angle: int) -> Tuple[Tuple[int, int, int]]:
+        """Positions of not empty blocks of variant turned on angle, going x by x, y by y, z by z."""
+
+        if (variant, angle) not in self._block_positions:
+            blocks = self.rotatedBlocks(variant, angle)
+            self._block_positions[variant, angle] = tuple(
+                (x, y, z)
+                for x in range(len(blocks)) for y in range(len(blocks[x])) for z in range(len(blocks[x][y]))
+                if blocks[x][y][z] is not None
+            )
+        return self._block_positions[variant, angle]
+
+    def generateVariant(self, rnd: Random = None) -> Tuple[Any, Tuple[Tuple[Tuple[Optional[Any]]]]]:
+        """Random variant of building type and variants of its blocks. Global random is used if rnd is None."""
 
-    def generateVariant(self) -> Tuple[Any, Tuple[Tuple[Tuple[Optional[Any]]]]]:
-        btype_variant = choice(list(self.blocks))
+        choose = choice if rnd is None else rnd.choice
+        btype_variant = choose(list(self.blocks))
         return (
             btype_variant,
             tuple(
                 tuple(
                     tuple(
-                        choice(self.possible_variants[btype_variant][x][y][z])
+                        choose(self.possible_variants[btype_variant][x][y][z])
                         if self.blocks[btype_variant][x][y][z]
                         else None
                         for z in range(len(self.blocks[btype_variant][x][y]))
@@ -242,22 +288,32 @@ class BuildingType:
         pixmap = QPixmap(some_size)
         pixmap.fill(Qt.transparent)
         painter = QPainter(pixmap)
-        painter.drawPixmap((some_size.width() - pix.width()) / 2, (some_size.height() - pix.height()) / 2, pix)
+        painter.drawPixmap(QPointF((some_size.width() - pix.width()) / 2, (some_size.height() - pix.height()) / 2), pix)
         painter.end()
         return pixmap
 
 
+with startup.phase("compiled building types"):
+    BUILDING_TYPES_COMPILED = getCompiled("building_types", lambda: {
+        name: compileBuildingType(BUILDING_TYPES_DATA[name]["blocks"]) for name in BUILDING_TYPES_DATA
+    })
+
+
 class BuildingTypeManager:
     """Store all BuildingTypes.
        Use BuildingTypes.bt_name to get BuildingType called 'bt_name'.
        Use BuildingType.getByNumber(num) to get BuildingType with number 'num'."""
 
     building_types = {
-        item: BuildingType(BUILDING_TYPES_DATA[item]["blocks"], BUILDING_TYPES_DATA[item].get('group', 'default'))
+        item: BuildingType(BUILDING_TYPES_COMPILED[item], BUILDING_TYPES_DATA[item].get('group', 'default'))
         for item in BUILDING_TYPES_DATA
     }
 
     sorted_names = sorted(building_types)
+    names = {building_type: name for name, building_type in building_types.items()}
+    # the longest side of building of any type and variant, building covers cells x..x + max_size - 1 at most
+    max_size = max(max(len(blocks), matrixHeight(blocks))
+                   for building_type in building_types.values() for blocks in building_type.blocks.values())
 
     def getByNumber(self, number: int) -> BuildingType:
         return self.__getattr__(self.sorted_names[number])
@@ -272,18 +328,22 @@ class BuildingTypeManager:
 class RoadType:
     def __init__(self, name: str):
         self.name = name
-        self.textures = {'center': getImage(f'{name}_center'),
-                         'right-up': getImage(f'{name}_part').mirrored(False, True),
-                         'right-down': getImage(f'{name}_part').mirrored(True, True),
-                         'left-up': getImage(f'{name}_part'),
-                         'left-down': getImage(f'{name}_part').mirrored(True, False)}
+        # mirrored parts are cached as separate images
+        self._textures = {'center': ImageRef(f'{self.name}_center'),
+                          'right-up': ImageRef(mirroredName(f'{self.name}_part', False, True)),
+                          'right-down': ImageRef(mirroredName(f'{self.name}_part', True, True)),
+                          'left-up': ImageRef(f'{self.name}_part'),
+                          'left-down': ImageRef(mirroredName(f'{self.name}_part', True, False))}
+
+    @property
+    def textures(self) -> Dict[str, QImage]:
+        return {part: texture() for part, texture in self._textures.items()}
 
     def drawDefault(self, size: QSize) -> QPixmap:
         pix = QPixmap(size)
         pix.fill(Qt.transparent)
         painter = QPainter(pix)
-        painter.drawImage(size.width() / 2 - ISOMETRIC_WIDTH / 2,
-                          size.height() / 2 - ISOMETRIC_HEIGHT1 / 2,
+        painter.drawImage(QPointF(size.width() / 2 - ISOMETRIC_WIDTH / 2, size.height() / 2 - ISOMETRIC_HEIGHT1 / 2),
                           self.textures['center'])
         painter.end()
         return pix
@@ -297,6 +357,7 @@ class RoadTypesManager:
     }
 
     sorted_names = sorted(road_types)
+    names = {road_type: name for name, road_type in road_types.items()}
 
     def __getattr__(self, item: str):
         if item not in self.road_types:
@@ -312,7 +373,11 @@ class Mask:
     """Mask for ground."""
 
     def __init__(self, name: str):
-        self.image = getImage(name)
+        self._image = ImageRef(name)
+
+    @property
+    def image(self) -> QImage:
+        return self._image()
 
     def draw(self, x: float, y: float, painter: QPainter) -> None:
         painter.drawImage(x - ISOMETRIC_WIDTH, y,  self.image)
@@ -327,7 +392,47 @@ class MasksManager:
         return self.masks[item]
 
 
-RoadTypes = RoadTypesManager()
-Masks = MasksManager()
-BuildingTypes = BuildingTypeManager()
-Grounds = GroundsManager()
+with startup.phase("managers"):
+    RoadTypes = RoadTypesManager()
+    Masks = MasksManager()
+    BuildingTypes = BuildingTypeManager()
+    Grounds = GroundsManager()
+
+
+def loadedTextures() -> Iterator[QImage]:
+    """Textures of blocks, grounds, road types and masks which are in memory now."""
+
+    refs = []
+    with _faces_lock:
+        for block in BlocksManager.blocks.values():
+            for angles in block.variants.values():
+                for faces in angles.values():
+                    refs.extend(faces)
+    refs.extend(ground._texture for ground in GroundsManager.grounds.values())
+    for road_type in RoadTypesManager.road_types.values():
+        refs.extend(road_type._textures.values())
+    refs.extend(mask._image for mask in MasksManager.masks.values())
+    for ref in refs:
+        image = ref.loaded()
+        if image is not None:
+            yield image
+
+
+def prefetchTextures() -> Thread:
+    """Load all textures in background thread, so they are ready before they are drawn."""
+
+    def prefetch():
+        for block in BlocksManager.blocks.values():
+            for variant in block.variants:
+                for angle in (0, 90, 180, 270):
+                    block.faces(variant, angle)
+        for ground in GroundsManager.grounds.values():
+            ground.texture
+        for road_type in RoadTypesManager.road_types.values():
+            road_type.textures
+        for mask in MasksManager.masks.values():
+            mask.image
+
+    thread = Thread(target=prefetch, name="prefetch", daemon=True)
+    thread.start()
+    return thread
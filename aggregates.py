@@ -0,0 +1,172 @@
+"""Statistics of town which are changed with town instead of being recounted.
+    Town reports every added or removed building and road and every citizen which is added or changes chunk,
+    every change costs O(1). If checking is on, statistics are compared with a full recount after every tick."""
+import os
+from collections import Counter
+from threading import Lock
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+CHECK_AGGREGATES_ENV = "MEDIEVAL_RISE_CHECK_AGGREGATES"  # "1" turns checking on
+CHUNKS = 16  # chunks in a row of the map
+
+
+def chunkOf(x: float, y: float) -> Optional[Tuple[int, int]]:
+    """Chunk containing position x, y, None if it's out of town."""
+
+    if 0 <= x < CHUNKS * 16 and 0 <= y < CHUNKS * 16:
+        return int(x // 16), int(y // 16)
+    return None
+
+
+class ChunkSummary(NamedTuple):
+    buildings: int  # buildings with origin on chunk
+    roads: int
+    citizens: int
+
+
+class TownAggregates:
+    """Counters of buildings by types, roads by types and citizens, in the whole town and on every chunk.
+        It can be changed by thread streaming chunks and by tick thread, queries don't lock it."""
+
+    def __init__(self):
+        self.buildings = 0
+        self.roads = 0
+        self.citizens = 0  # citizens on map
+        self.building_types: Counter = Counter()  # {name of building type: count}
+        self.road_types: Counter = Counter()  # {name of road type: count}
+        self._chunk_buildings = [[0] * CHUNKS for _ in range(CHUNKS)]
+        self._chunk_roads = [[0] * CHUNKS for _ in range(CHUNKS)]
+        self._chunk_citizens = [[0] * CHUNKS for _ in range(CHUNKS)]
+        self.checking = os.environ.get(CHECK_AGGREGATES_ENV) == "1"
+        self._lock = Lock()
+
+    @staticmethod
+    def _buildingChunk(x: int, y: int) -> Tuple[int, int]:
+        return min(max(x // 16, 0), CHUNKS - 1), min(max(y // 16, 0), CHUNKS - 1)
+
+    def addBuilding(self, x: int, y: int, building_type: str) -> None:
+        chunk_x, chunk_y = self._buildingChunk(x, y)
+        with self._lock:
+            self.buildings += 1
+            self.building_types[building_type] += 1
+            self._chunk_buildings[chunk_x][chunk_y] += 1
+
+    def addBuildings(self, buildings: Iterable[Tuple[int, int, str]]) -> None:
+        """Add buildings given as (x, y, building_type) by one change."""
+
+        buildings = list(buildings)
+        types = Counter(building_type for _, _, building_type in buildings)
+        chunks = Counter((x // 16, y // 16) for x, y, _ in buildings)
+        with self._lock:
+            self.buildings += len(buildings)
+            self.building_types.update(types)
+            for (chunk_x, chunk_y), count in chunks.items():
+                self._chunk_buildings[min(max(chunk_x, 0), CHUNKS - 1)][min(max(chunk_y, 0), CHUNKS - 1)] += count
+
+    def removeBuilding(self, x: int, y: int, building_type: str) -> None:
+        chunk_x, chunk_y = self._buildingChunk(x, y)
+        with self._lock:
+            self.buildings -= 1
+            self.building_types[building_type] -= 1
+            if not self.building_types[building_type]:
+                del self.building_types[building_type]
+            self._chunk_buildings[chunk_x][chunk_y] -= 1
+
+    def addRoad(self, x: int, y: int, road_type: str) -> None:
+        with self._lock:
+            self.roads += 1
+            self.road_types[road_type] += 1
+            self._chunk_roads[x // 16][y // 16] += 1
+
+    def addRoads(self, roads: Iterable[Tuple[int, int, str]]) -> None:
+        """Add roads given as (x, y, road_type) by one change."""
+
+        roads = list(roads)
+        types = Counter(road_type for _, _, road_type in roads)
+        chunks = Counter((x // 16, y // 16) for x, y, _ in roads)
+        with self._lock:
+            self.roads += len(roads)
+            self.road_types.update(types)
+            for (chunk_x, chunk_y), count in chunks.items():
+                self._chunk_roads[chunk_x][chunk_y] += count
+
+    def addCitizen(self, x: float, y: float) -> None:
+        self.moveCitizen(None, None, x, y)
+
+    def moveCitizen(self, old_x: Optional[float], old_y: Optional[float], x: float, y: float) -> None:
+        """Citizen is moved from old_x, old_y to x, y. Old position is None for a new citizen."""
+
+        if old_x is not None and old_x // 16 == x // 16 and old_y // 16 == y // 16:
+            return  # the same chunk, edges of town are edges of chunks
+        old = chunkOf(old_x, old_y) if old_x is not None else None
+        new = chunkOf(x, y)
+        if old == new:
+            return
+        with self._lock:
+            if old is not None:
+                self.citizens -= 1
+                self._chunk_citizens[old[0]][old[1]] -= 1
+            if new is not None:
+                self.citizens += 1
+                self._chunk_citizens[new[0]][new[1]] += 1
+
+    def chunk(self, chunk_x: int, chunk_y: int) -> ChunkSummary:
+        return ChunkSummary(self._chunk_buildings[chunk_x][chunk_y], self._chunk_roads[chunk_x][chunk_y],
+                            self._chunk_citizens[chunk_x][chunk_y])
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "buildings": self.buildings,
+            "roads": self.roads,
+            "citizens": self.citizens,
+            "building_types": dict(self.building_types),
+            "road_types": dict(self.road_types),
+            "chunks": {f"{x},{y}": self.chunk(x, y)._asdict() for x in range(CHUNKS) for y in range(CHUNKS)
+                       if any(self.chunk(x, y))},
+        }
+
+    @classmethod
+    def recount(cls, town) -> 'TownAggregates':
+        """Statistics of town counted by scan of all cells of chunks and all citizens."""
+
+        from TownObjects import BuildingTypes, RoadTypes  # Town imports this module
+
+        aggregates = cls()
+        buildings = {}
+        for chunks in town.chunks:
+            for chunk in chunks:
+                for i in range(16):
+                    for j in range(16):
+                        road = chunk.roads[i][j]
+                        if road is not None:
+                            aggregates.addRoad(road.x, road.y, RoadTypes.names[road.road_type])
+                        for building in chunk.blocks[i][j]:
+                            if building is not None:
+                                buildings[id(building)] = building
+        for building in buildings.values():
+            aggregates.addBuilding(building.x, building.y, BuildingTypes.names[building.building_type])
+        for citizen in town.citizens:
+            aggregates.addCitizen(citizen.x, citizen.y)
+        return aggregates
+
+    def differences(self, town) -> List[str]:
+        """Differences from a full recount of town."""
+
+        recount = self.recount(town)
+        differences = [
+            f"{name} {getattr(self, name)}, recounted {getattr(recount, name)}"
+            for name in ("buildings", "roads", "citizens", "building_types", "road_types")
+            if getattr(self, name) != getattr(recount, name)
+        ]
+        differences += [
+            f"chunk ({x}, {y}) {self.chunk(x, y)}, recounted {recount.chunk(x, y)}"
+            for x in range(CHUNKS) for y in range(CHUNKS) if self.chunk(x, y) != recount.chunk(x, y)
+        ]
+        return differences
+
+    def check(self, town) -> None:
+        """Raise RuntimeError if statistics differ from a full recount of town."""
+
+        differences = self.differences(town)
+        if differences:
+            raise RuntimeError(f"Aggregates differ from town: {'; '.join(differences)}.")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Build assets.pack: decoded images, game data and compiled tables in one file.
+    Usage: python asset_pack.py [PACK_FILE]"""
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+from PyQt5.Qt import QImage
+
+from resources_manager import PACK_FILE_NAME, PACK_HEADER, PACK_MAGIC, closePack, wd
+
+# compiled tables and their source files
+COMPILED_SOURCES = {
+    "building_types": ("data/building_types.json", "data/blocks.json"),
+}
+
+
+def _sources(*sources: str) -> Dict[str, float]:
+    return {source: os.path.getmtime(os.path.join(wd, source)) for source in sources}
+
+
+def _compiled(name: str) -> Any:
+    # TownObjects reads compiled tables on import, it's imported after buildPack closed the old pack,
+    # so tables are compiled from sources and not copied from the old pack
+    import TownObjects
+
+    if name == "building_types":
+        return {
+            building_type: TownObjects.compileBuildingType(TownObjects.BUILDING_TYPES_DATA[building_type]["blocks"])
+            for building_type in TownObjects.BUILDING_TYPES_DATA
+        }
+    raise ValueError(f'Compiled table "{name}" does not exist.')
+
+
+def buildPack(file_name: str) -> None:
+    """Build pack from source files. Modules imported before it (TownObjects) keep data read from the old pack."""
+
+    closePack()
+    index = {"images": {}, "data": {}, "compiled": {}}
+    blobs: List[bytes] = []
+    offset = 0
+
+    def addBlob(section: str, name: str, blob: bytes, entry: Dict[str, Any]) -> None:
+        nonlocal offset
+        entry.update(offset=offset, length=len(blob))
+        index[section][name] = entry
+        blobs.append(blob)
+        offset += len(blob)
+
+    assets = os.path.join(wd, "assets")
+    for directory, _, files in os.walk(assets):
+        for file in sorted(files):
+            if file.endswith(".png"):
+                path = os.path.join(directory, file)
+                image = QImage(path)
+                if image.isNull():
+                    continue
+                if image.colorCount():  # only pixels are packed, so image mustn't need its color table
+                    image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+                name = os.path.relpath(path, assets)[:-len(".png")].replace(os.sep, "/")
+                addBlob("images", name, image.constBits().asstring(image.sizeInBytes()), {
+                    "width": image.width(),
+                    "height": image.height(),
+                    "bytes_per_line": image.bytesPerLine(),
+                    "format": int(image.format()),
+                    "sources": _sources(os.path.relpath(path, wd)),
+                })
+
+    for file in sorted(os.listdir(os.path.join(wd, "data"))):
+        if file.endswith(".json"):
+            source = f"data/{file}"
+            with open(os.path.join(wd, source)) as f:
+                data = json.load(f)
+            addBlob("data", file[:-len(".json")], json.dumps(data, separators=(",", ":")).encode(),
+                    {"sources": _sources(source)})
+
+    for name, sources in COMPILED_SOURCES.items():
+        addBlob("compiled", name, json.dumps(_compiled(name), separators=(",", ":")).encode(),
+                {"sources": _sources(*sources)})
+
+    index_data = json.dumps(index, separators=(",", ":")).encode()
+    with open(file_name + ".tmp", "wb") as file:
+        file.write(PACK_HEADER.pack(PACK_MAGIC, len(index_data)))
+        file.write(index_data)
+        for blob in blobs:
+            file.write(blob)
+    os.replace(file_name + ".tmp", file_name)
+
+
+if __name__ == "__main__":
+    buildPack(sys.argv[1] if len(sys.argv) > 1 else os.path.join(wd, PACK_FILE_NAME))
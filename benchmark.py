@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Benchmarks of drawing, simulation, building, saving and terrain generation of synthetic towns.
+    benchmark.py run [-o RESULTS]                   measure and write results as JSON
+    benchmark.py compare BASE RESULTS [--threshold]  fail if some metric is slower than in BASE"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+from random import Random
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # it have to be set before Qt is loaded
+
+from PyQt5.QtCore import PYQT_VERSION_STR, QPoint, QPointF, QSize
+from PyQt5.QtGui import QGuiApplication, QImage, QPainter
+
+import Town
+from picking import IdBuffer
+from terrain import chunkGrounds, generateGrounds
+from town_generator import generateTown
+
+
+def timings(func: Callable[[], Any], repeats: int, setup: Callable[[], Any] = None) -> Dict[str, float]:
+    """Median and minimal time of func. setup is called before every call and isn't measured."""
+
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "repeats": repeats}
+
+
+def benchmarkDraw(town: Town.Town, size: QSize, repeats: int) -> Dict[str, float]:
+    image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+
+    def draw():
+        painter = QPainter(image)
+        town.draw(painter, size, .6)
+        painter.end()
+
+    return timings(draw, repeats)
+
+
+def benchmarkPicking(town: Town.Town, size: QSize, repeats: int, seed: int) -> Dict[str, Dict[str, float]]:
+    """Render of id buffer and picks on random pixels."""
+
+    rnd = Random(seed)
+    buffer = IdBuffer(town)
+    metrics = {"id_buffer": timings(lambda: buffer.render(size), repeats)}
+    point = QPoint()
+    metrics["pick"] = timings(lambda: buffer.pick(point, size), repeats * 10,
+                              lambda: point.setX(rnd.randrange(size.width())) or point.setY(rnd.randrange(size.height())))
+    return metrics
+
+
+def benchmarkBuilding(town: Town.Town, repeats: int, seed: int) -> Dict[str, Dict[str, float]]:
+    """Masks of every group and placement checks of projecting buildings on random places."""
+
+    metrics = {}
+    rnd = Random(seed)
+    groups = {}
+    for i, name in enumerate(Town.BuildingTypes.sorted_names):
+        groups.setdefault(Town.BuildingTypes.building_types[name].group, i)
+
+    for group, number in sorted(groups.items()):
+        town.chosen_btype = number
+        project = Town.ProjectedBuilding(town)
+        metrics[f"mask.{group}"] = timings(lambda: town.setBuildingMaskForGroup(project), repeats,
+                                           lambda: town.markChanged(0, 0, 255, 255))
+        # masks around one building which is built or destroyed
+        metrics[f"mask_update.{group}"] = timings(
+            lambda: town.setBuildingMaskForGroup(project), repeats,
+            lambda: town.markChanged(*2 * (rnd.randrange(8, 248), rnd.randrange(8, 248)))
+        )
+        metrics[f"build_check.{group}"] = timings(
+            project.canBuild, repeats * 10,
+            lambda: project.addToMap(QPointF(rnd.randrange(8, 248), rnd.randrange(8, 248)))
+        )
+        project.destroy()
+    return metrics
+
+
+def benchmarkSaving(town: Town.Town, repeats: int) -> Dict[str, Dict[str, float]]:
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "save.dat")
+        metrics = {"save": timings(lambda: town.save(file_name=file_name), repeats)}
+        metrics["load"] = timings(lambda: Town.Town().load(file_name), repeats)
+    return metrics
+
+
+def benchmarkTerrain(repeats: int, seed: int) -> Dict[str, Dict[str, float]]:
+    """Generation of ground of one chunk and of 1024 by 1024 cells."""
+
+    return {
+        "terrain.chunk": timings(lambda: chunkGrounds(seed, 7, 7), repeats * 10),
+        "terrain.1024": timings(lambda: generateGrounds(seed, 0, 0, 1024, 1024), repeats),
+    }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    size = QSize(*map(int, args.size.split("x")))
+    if args.per_group is not None:
+        groups = {Town.BuildingTypes.building_types[name].group: args.per_group
+                  for name in Town.BuildingTypes.sorted_names}
+    else:
+        groups = None
+
+    start = perf_counter()
+    town = generateTown(args.buildings, args.roads, args.citizens, args.seed, groups)
+    elapsed = perf_counter() - start
+    metrics = {"generate": {"median": elapsed, "min": elapsed, "repeats": 1}}
+    town.waitTerrain()
+
+    metrics["draw"] = benchmarkDraw(town, size, args.repeats)
+    metrics["tick"] = timings(lambda: town.tick(size), args.repeats)
+    metrics.update(benchmarkPicking(town, size, args.repeats, args.seed))
+    metrics.update(benchmarkBuilding(town, args.repeats, args.seed))
+    metrics.update(benchmarkSaving(town, max(1, args.repeats // 4)))
+    metrics.update(benchmarkTerrain(max(1, args.repeats // 4), args.seed))
+
+    return {
+        "config": {
+            "buildings": len(town.buildings),
+            "groups": groups,
+            "roads": len(town.roads),
+            "road_density": args.roads,
+            "citizens": len(town.citizens),
+            "seed": args.seed,
+            "size": args.size,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "pyqt": PYQT_VERSION_STR,
+            "platform": platform.platform(),
+        },
+        "metrics": metrics,
+    }
+
+
+def compare(base: Dict[str, Any], results: Dict[str, Any], threshold: float, statistic: str = "median") -> List[str]:
+    """Print comparison of results with base by statistic of time.
+        Return names of metrics which are slower by more than threshold."""
+
+    if base["config"] != results["config"]:
+        print("warning: results were measured with different configuration")
+
+    regressions = []
+    print(f"{'metric':28} {'base, ms':>10} {'new, ms':>10} {'change':>8}")
+    for name in sorted(base["metrics"].keys() & results["metrics"].keys()):
+        old = base["metrics"][name][statistic]
+        new = results["metrics"][name][statistic]
+        change = new / old - 1 if old else 0
+        mark = ""
+        if change > threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:28} {old * 1000:10.3f} {new * 1000:10.3f} {change:+8.1%}{mark}")
+    return regressions
+
+
+def parseArguments(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Medieval Rise benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("-o", "--output", metavar="FILE", help="write results to JSON file")
+    town = run_parser.add_mutually_exclusive_group()
+    town.add_argument("--per-group", type=int, help="buildings of every group in generated town")
+    town.add_argument("--buildings", type=int, default=1000,
+                      help="buildings of random types in generated town (default: %(default)s)")
+    run_parser.add_argument("--roads", type=float, default=.5,
+                            help="part of street cells with road (default: %(default)s)")
+    run_parser.add_argument("--citizens", type=int, default=1000,
+                            help="citizens in generated town (default: %(default)s)")
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of generated town (default: %(default)s)")
+    run_parser.add_argument("--repeats", type=int, default=20, help="repeats of every metric (default: %(default)s)")
+    run_parser.add_argument("--size", default="1920x1080", help="screen size WIDTHxHEIGHT (default: %(default)s)")
+
+    compare_parser = commands.add_parser("compare", help="compare results with base ones")
+    compare_parser.add_argument("base", help="JSON file with base results")
+    compare_parser.add_argument("results", help="JSON file with new results")
+    compare_parser.add_argument("--threshold", type=float, default=.1,
+                                help="allowed slowdown of metric, .1 is 10%% (default: %(default)s)")
+    compare_parser.add_argument("--statistic", choices=("median", "min"), default="median",
+                                help="compared time of metrics, min is more stable on busy machines "
+                                     "(default: %(default)s)")
+    return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+    args = parseArguments(args)
+
+    if args.command == "compare":
+        with open(args.base) as file:
+            base = json.load(file)
+        with open(args.results) as file:
+            results = json.load(file)
+        regressions = compare(base, results, args.threshold, args.statistic)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        return 0
+
+    app = QGuiApplication(sys.argv[:1])
+    results = run(args)
+    del app
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    for name, metric in results["metrics"].items():
+        print(f"{name:28} {metric['median'] * 1000:10.3f} ms (min {metric['min'] * 1000:.3f} ms)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+"""Tests run on the offscreen Qt platform from the directory of the game, where data and assets are."""
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+app = QApplication.instance() or QApplication([])
@@ -0,0 +1,13 @@
+"""Hash of integers which is the same in every process and session, unlike hash(). It's used instead of random
+    numbers generators where value must depend only on its arguments, for example in simulation and terrain."""
+
+MASK64 = (1 << 64) - 1
+
+
+def splitMix64(value: int) -> int:
+    """SplitMix64 finalizer."""
+
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Run town simulation and rendering without window and print throughput."""
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # it have to be set before Qt is loaded
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QGuiApplication, QImage, QPainter
+
+import Town
+from memory_report import writeReport
+from profiling import frameProfiler, profileSession, trace
+from replay import replaySession
+from town_generator import generateTown
+
+
+def parseArguments(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Medieval Rise headless simulation and benchmark.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--load", metavar="FILE", help="load town from save file")
+    source.add_argument("--replay", metavar="FILE",
+                        help="replay session recorded by main.py --record and print time of its commands, "
+                             "then run --ticks and --frames on the town")
+    source.add_argument("--synthetic", metavar="BUILDINGS", type=int, default=500,
+                        help="generate town with changed count of buildings (default: %(default)s)")
+    parser.add_argument("--roads", type=float, default=.5, help="part of street cells with road (default: %(default)s)")
+    parser.add_argument("--citizens", type=int, default=1000, help="citizens in generated town (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of generated town (default: %(default)s)")
+    parser.add_argument("--ticks", type=int, default=100, help="ticks to run (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=0, help="frames to render (default: %(default)s)")
+    parser.add_argument("--size", default="1920x1080", help="screen size WIDTHxHEIGHT (default: %(default)s)")
+    parser.add_argument("--regions", type=int, default=0,
+                        help="simulate citizens in worker processes, one per region of chunks")
+    parser.add_argument("--frame-stats", action="store_true",
+                        help="print counters of frame profiler as JSON")
+    parser.add_argument("--trace", metavar="FILE", help="write spans of ticks and frames in Chrome trace-event format")
+    parser.add_argument("--cprofile", metavar="FILE", help="profile ticks and frames with cProfile and dump pstats")
+    parser.add_argument("--memory", metavar="FILE",
+                        help="write memory report of town after run, run it with -X tracemalloc for allocations")
+    parser.add_argument("--check-aggregates", action="store_true",
+                        help="compare statistics of town with a full recount after every tick")
+    return parser.parse_args(args)
+
+
+def makeTown(args: argparse.Namespace) -> Town.Town:
+    if args.load is not None:
+        town = Town.Town()
+        town.load(args.load)
+        return town
+    return generateTown(args.synthetic, args.roads, args.citizens, args.seed)
+
+
+def runTicks(town: Town.Town, ticks: int, size: QSize) -> float:
+    """Run ticks of town. Return elapsed time."""
+
+    start = perf_counter()
+    for _ in range(ticks):
+        town.tick(size)
+    return perf_counter() - start
+
+
+def renderFrames(town: Town.Town, frames: int, size: QSize) -> float:
+    """Render frames of town into image. Return elapsed time."""
+
+    image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+    start = perf_counter()
+    for _ in range(frames):
+        frame_start = perf_counter()
+        painter = QPainter(image)
+        town.draw(painter, size, .6)
+        painter.end()
+        if frameProfiler.enabled:
+            frameProfiler.endFrame(perf_counter() - frame_start)
+    return perf_counter() - start
+
+
+def printReplay(stats) -> None:
+    print(f"{'command':16} {'count':>7} {'total, s':>9} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'max, ms':>9}")
+    for command, stat in sorted(stats.items()):
+        print(f"{command:16} {stat['count']:7} {stat['total']:9.3f} {stat['p50'] * 1000:9.3f} "
+              f"{stat['p95'] * 1000:9.3f} {stat['p99'] * 1000:9.3f} {stat['max'] * 1000:9.3f}")
+
+
+def printThroughput(name: str, count: int, elapsed: float) -> None:
+    if count:
+        print(f"{name}: {count} in {elapsed:.3f} s ({count / elapsed:.1f} {name}/s, "
+              f"{elapsed / count * 1000:.2f} ms per one)")
+
+
+def main(args=None) -> None:
+    args = parseArguments(args)
+    size = QSize(*map(int, args.size.split("x")))
+    app = QGuiApplication(sys.argv[:1])
+    frameProfiler.enabled = args.frame_stats
+    if args.trace is not None:
+        trace.start()
+    if args.cprofile is not None:
+        profileSession.start(args.cprofile)
+
+    start = perf_counter()
+    if args.replay is not None:
+        town, stats = profileSession.runcall(replaySession, args.replay)
+        printReplay(stats)
+    else:
+        town = profileSession.runcall(makeTown, args)
+    town.waitTerrain()  # frames are rendered with ground of all chunks
+    print(f"town: {len(town.buildings)} buildings, {len(town.roads)} roads, {len(town.citizens)} citizens "
+          f"ready in {perf_counter() - start:.3f} s")
+    if args.check_aggregates:
+        town.aggregates.checking = True
+        town.aggregates.check(town)
+
+    if args.regions:
+        town.startRegionSimulation(args.regions)
+    try:
+        printThroughput("ticks", args.ticks, profileSession.runcall(runTicks, town, args.ticks, size))
+    finally:
+        town.stopRegionSimulation()
+    printThroughput("frames", args.frames, profileSession.runcall(renderFrames, town, args.frames, size))
+    if args.frame_stats:
+        print(json.dumps(frameProfiler.counters(), indent=2))
+    if args.cprofile is not None:
+        profileSession.stop()
+        print(f"profile: {args.cprofile}")
+    if args.trace is not None:
+        print(f"trace: {trace.stop(args.trace)} spans in {args.trace}")
+    if args.memory is not None:
+        writeReport(town, args.memory)
+        print(f"memory: {args.memory}")
+    if args.check_aggregates:
+        print(f"aggregates: match recount after {town.ticks} ticks")
+    del app
+
+
+if __name__ == "__main__":
+    main()
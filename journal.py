@@ -0,0 +1,157 @@
+import os
+from threading import Event, Lock, Thread
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from save_format import BuildingRecord, RoadRecord
+
+# The first line of journal is its version, every next line is one operation:
+#   V version                                                      version of journal
+#   B id x y angle building_type btype_variant block_variant...   building is built
+#   D id x y angle building_type                                   building is destroyed
+#   R x y road_type                                                road is built
+# Journals of version 1 have no version line and no ids of buildings.
+
+JOURNAL_VERSION = 2
+
+
+def journalFileName(save_file_name: str) -> str:
+    return save_file_name + ".journal"
+
+
+def _buildLine(record: BuildingRecord) -> str:
+    return f"B {record.id} {record.x} {record.y} {record.angle} {record.building_type} {record.btype_variant} " + \
+        " ".join(record.blocks_variants)
+
+
+def _destroyLine(record: BuildingRecord) -> str:
+    return f"D {record.id} {record.x} {record.y} {record.angle} {record.building_type}"
+
+
+def _roadLine(record: RoadRecord) -> str:
+    return f"R {record.x} {record.y} {record.road_type}"
+
+
+def journalVersion(file_name: str) -> Optional[int]:
+    """Version of journal, None if it doesn't exist or is empty."""
+
+    try:
+        with open(file_name) as file:
+            data = file.readline().split()
+    except FileNotFoundError:
+        return None
+    if not data:
+        return None
+    return int(data[1]) if data[0] == "V" else 1
+
+
+def readJournal(file_name: str) -> Iterator[Tuple[str, object]]:
+    """Operations from journal as pairs (kind, record). Broken last line of crashed session is skipped."""
+
+    try:
+        with open(file_name) as file:
+            lines = file.read().split("\n")
+    except FileNotFoundError:
+        return
+
+    ids = lines[0].split()[:1] == ["V"]
+    for line in lines[ids:-1]:  # the last one is empty or wasn't finished
+        data = line.split()
+        if data[0] in ("B", "D"):
+            building_id = int(data.pop(1)) if ids else None
+            if data[0] == "B":
+                yield "B", BuildingRecord(int(data[1]), int(data[2]), int(data[3]), data[4], data[5],
+                                          tuple(data[6:]), building_id)
+            else:
+                yield "D", BuildingRecord(int(data[1]), int(data[2]), int(data[3]), data[4], "", (), building_id)
+        elif data[0] == "R":
+            yield "R", RoadRecord(int(data[1]), int(data[2]), data[3])
+
+
+class Journal:
+    """Append-only journal of town changes made after the last snapshot."""
+
+    def __init__(self, save_file_name: str):
+        self.save_file_name = save_file_name
+        self.file_name = journalFileName(save_file_name)
+        self.rotated_file_name = self.file_name + ".old"
+        self._lock = Lock()
+        self._file = self._open()
+
+    def _open(self):
+        file = open(self.file_name, "a")
+        if not file.tell():
+            file.write(f"V {JOURNAL_VERSION}\n")
+            file.flush()
+        return file
+
+    def _write(self, line: str) -> None:
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def build(self, record: BuildingRecord) -> None:
+        self._write(_buildLine(record))
+
+    def destroy(self, record: BuildingRecord) -> None:
+        self._write(_destroyLine(record))
+
+    def road(self, record: RoadRecord) -> None:
+        self._write(_roadLine(record))
+
+    def changes(self, destroyed: Iterable[BuildingRecord], roads: Iterable[RoadRecord],
+                buildings: Iterable[BuildingRecord]) -> None:
+        """Write changes made together by one write, in the order they are applied."""
+
+        lines = [*map(_destroyLine, destroyed), *map(_roadLine, roads), *map(_buildLine, buildings)]
+        if lines:
+            self._write("\n".join(lines))
+
+    def rotate(self) -> None:
+        """Start new journal. The old one is kept until removeRotated.
+            If journal rotated by session which crashed before saving wasn't removed, the old one is added to it,
+            so changes which aren't saved aren't lost by the next crash."""
+
+        with self._lock:
+            self._file.close()
+            if os.path.exists(self.rotated_file_name):
+                with open(self.rotated_file_name) as file:
+                    rotated = file.read()
+                with open(self.file_name) as file:
+                    journal = file.read()
+                # broken last line of crashed session and version line of journal are dropped
+                rotated = rotated[:rotated.rfind("\n") + 1]
+                journal = journal[journal.find("\n") + 1:journal.rfind("\n") + 1]
+                with open(self.rotated_file_name + ".tmp", "w") as file:
+                    file.write(rotated + journal)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(self.rotated_file_name + ".tmp", self.rotated_file_name)
+                os.remove(self.file_name)
+            else:
+                os.replace(self.file_name, self.rotated_file_name)
+            self._file = self._open()
+
+    def removeRotated(self) -> None:
+        if os.path.exists(self.rotated_file_name):
+            os.remove(self.rotated_file_name)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class JournalCompactor(Thread):
+    """Thread periodically compacting journal into a full snapshot."""
+
+    def __init__(self, interval: float, compact: Callable[[], None]):
+        super().__init__(name="journal", daemon=True)
+        self.stopped = Event()
+        self.interval = interval
+        self.compact = compact
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.compact()
+
+    def cancel(self):
+        self.stopped.set()
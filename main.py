@@ -1,30 +1,51 @@
 #!/usr/bin/env python3
+import argparse
 import math
+import sys
+import time
+import tracemalloc
 from enum import Enum
 from threading import Event, Thread
 from types import FunctionType
 
-from PyQt5.QtCore import QPoint, QSize, Qt, QRect
+from profiling import (PROFILE_SECONDS, STARTUP_PROFILE_FILE, captureFileName, frameProfiler, profileSession,
+                       startup, trace, traced)
+
+# arguments are parsed after imports, but imports have to be traced too
+if any(arg.split("=")[0] == "--profile-startup" for arg in sys.argv[1:]):
+    startup.start()
+startup.begin("imports")
+
+from PyQt5.QtCore import QPoint, QPointF, QSize, Qt, QRect
 from PyQt5.QtGui import QCloseEvent, QKeyEvent, QMouseEvent, QPainter, QPaintEvent, QPixmap, QWheelEvent, QCursor, \
     QColor, QFont, QIcon
 from PyQt5.QtWidgets import QApplication, QMainWindow
 
 import Town
+from memory_report import memoryProviders, writeReport
+from picking import IdBuffer
+from replay import SessionRecorder
 from resources_manager import getImage
+from TownObjects import prefetchTextures
+
+startup.end()
+
+MIN_AREA_DRAG = 2  # cells by which selection must be dragged to destroy or copy area, shorter drag is a click
 
 
 class Interval(Thread):
-    """Periodical thread."""
+    """Periodical thread. Calls of func are profiled while profileSession is active."""
 
-    def __init__(self, interval: float, func: FunctionType):
-        Thread.__init__(self)
+    def __init__(self, interval: float, func: FunctionType, name: str = None):
+        Thread.__init__(self, name=name)
         self.stopped = Event()
         self.interval = interval
         self.func = func
 
     def run(self):
         while not self.stopped.wait(self.interval):
-            self.func()
+            profileSession.runcall(self.func)
+        profileSession.collect()
 
     def cancel(self):
         self.stopped.set()
@@ -72,22 +93,55 @@ class Frame(QMainWindow):
         self.scrollAmount = 0
         self.menu_mode = 1
         self.menuAnimation = 0
-        self.destroy_pos = None
+        self.id_buffer = IdBuffer(town)  # it finds building under cursor in Destroy mode
+        memoryProviders["id_buffer"] = self.id_buffer.sizeInBytes
         self.blinkAnimation = 0
-
-        self.draw_thread = Interval(1 / 60, self.update)
-        self.town_tick_thread = Interval(1 / 20, lambda: town.tick(self.size()))
+        self.save_thread = None
+        self.save_progress = None  # done part of running save
+        self.saved_time = None  # time when the last save was finished
+        self.memory_snapshot = None  # the last memory report is compared with it
+        self.recorder = None  # SessionRecorder of commands if session is recorded
+        self.projected_cell = None  # cell of projecting object in the last recorded move
+        self.selection = None  # AreaSelection dragged in Destroy mode
+        self.district = None  # District copied by dragging with Ctrl in Destroy mode, Ctrl+V pastes it
+
+        self.draw_thread = Interval(1 / 60, self.update, "draw")
+        self.town_tick_thread = Interval(1 / 20, self.tick, "tick")
         self.town_tick_thread.start()
         self.draw_thread.start()
 
+    def record(self, command: str, *args) -> None:
+        """Record command of session if it's recorded, see replay."""
+
+        if self.recorder is not None:
+            self.recorder.record(command, *args)
+
+    def startRecording(self, file_name: str) -> None:
+        self.recorder = SessionRecorder(file_name, self.town)  # it saves projecting building or road too
+        self.projected_cell = None
+
+    def stopRecording(self) -> None:
+        self.recorder.close()
+        self.recorder = None
+
+    def tick(self) -> None:
+        size = self.size()
+        self.record("tick", size.width(), size.height())
+        self.town.tick(size)
+
     def setMode(self, mode):
         self.setCursor(self.default_cursor)
         if self.mode == Modes.TownBuilder:
+            self.record("cancel")
             self.town.chosen_building.destroy()
             self.town.chosen_building = None
         elif self.mode == Modes.TownRoadBuilder:
+            self.record("cancel")
             self.town.projecting_road.destroy()
             self.town.projecting_road = None
+        elif self.mode == Modes.Destroy and self.selection is not None:
+            self.selection.destroy()
+            self.selection = None
         if mode == Modes.Instructions:
             if self.mode == Modes.Instructions:
                 self.setMode(self.last_mode)
@@ -97,19 +151,78 @@ class Frame(QMainWindow):
                 self.last_mode = self.mode
         elif mode not in (Modes.Town, Modes.Pause):
             self.setCursor(transparentCursor())
+            self.projected_cell = None
             if mode == Modes.TownBuilder:
+                self.record("choose_building", self.town.chosen_btype)
                 self.town.chosen_building = Town.ProjectedBuilding(self.town)
             elif mode == Modes.TownRoadBuilder:
+                self.record("choose_road", self.town.chosen_btype)
                 self.town.projecting_road = Town.ProjectedRoad(self.town)
         self.mode = mode
 
     def closeEvent(self, event: QCloseEvent) -> None:
+        if self.recorder is not None:
+            self.stopRecording()
+        if trace.capturing:
+            self.toggleTrace()
+        if profileSession.active:
+            profileSession.stop()  # threads add their stats when they are finished
         self.draw_thread.cancel()
         self.town_tick_thread.cancel()
-        self.town.save()
+        self.town_tick_thread.join()
+        if self.save_thread is not None:
+            self.save_thread.join()
+        self.town.stopRegionSimulation()
+        self.town.stopJournal()
+
+    def cursorIso(self) -> QPointF:
+        """Isometric position of cursor in town."""
+
+        cursor_pos = (self.cursor().pos() - self.frameGeometry().bottomRight() + QPoint(
+            self.width(),
+            self.height()
+        ) / 2) * self.town.cam_z + QPoint(self.town.cam_x, self.town.cam_y)
+        return Town.isometric(cursor_pos.x(), cursor_pos.y())
 
     def mousePressEvent(self, event: QMouseEvent) -> None:
         self.last_button = event.button()
+        if self.last_button == Qt.LeftButton and self.mode == Modes.TownRoadBuilder:
+            self.record("start_path")
+            self.town.projecting_road.startPath()
+        elif self.last_button == Qt.LeftButton and self.mode == Modes.Destroy:
+            self.selection = Town.AreaSelection(self.town, self.cursorIso())
+
+    def releaseSelection(self, event: QMouseEvent) -> None:
+        """Destroy buildings in dragged area, copy it if Ctrl is held, or destroy building under cursor on click.
+            Drag shorter than MIN_AREA_DRAG cells is a click, so area isn't destroyed by shaking of mouse."""
+
+        selection, self.selection = self.selection, None
+        if selection is not None:
+            selection.destroy()
+        if selection is not None and max(abs(selection.x - selection.start[0]),
+                                         abs(selection.y - selection.start[1])) >= MIN_AREA_DRAG:
+            if event.modifiers() & Qt.ControlModifier:
+                self.record("copy_area", *selection.area())
+                self.district = self.town.copyDistrict(*selection.area())
+            else:
+                self.record("destroy_area", *selection.area())
+                self.town.destroyArea(*selection.area())
+                self.setMode(Modes.Town)
+            return
+
+        build = self.id_buffer.pick(event.pos(), self.size())
+        if isinstance(build, Town.Building):
+            self.record("destroy", build.id)
+            build.destroy()
+            self.setMode(Modes.Town)
+
+    def pasteDistrict(self) -> None:
+        """Paste copied district with corner under cursor."""
+
+        iso = self.cursorIso()
+        x, y = round(iso.x()), round(iso.y())
+        self.record("paste", x, y)
+        self.town.pasteDistrict(self.district, x, y)
 
     def wheelEvent(self, event: QWheelEvent) -> None:
         if Town.isPointInRect(event.pos(), (QPoint(0, self.height() * .8), QSize(self.width(), self.height() * .2))):
@@ -134,14 +247,15 @@ class Frame(QMainWindow):
                     self.scrollAmount = 0
 
         elif self.mode != Modes.Instructions:
-            self.town.scaleByEvent(event)
+            delta = -event.angleDelta().y() / (self.town.scale * 480)
+            self.record("zoom", delta)
+            self.town.zoom(delta)
 
     def mouseMoveEvent(self, event: QMouseEvent) -> None:
         delta = event.pos() - self.last_pos
 
-        if self.last_button == Qt.LeftButton and self.mode == Modes.TownRoadBuilder:
-            self.town.projecting_road.build()
-        elif self.last_button == Qt.RightButton and self.mode != Modes.Instructions:
+        if self.last_button == Qt.RightButton and self.mode != Modes.Instructions:
+            self.record("translate", delta.x(), delta.y())
             self.town.translate(delta)
 
         self.last_pos = event.pos()
@@ -180,15 +294,14 @@ class Frame(QMainWindow):
                             self.setMode(Modes(self.menu_mode))
                             break
             elif self.mode == Modes.TownBuilder:
+                self.record("build")
                 if self.town.chosen_building.build():
                     self.setMode(Modes.Town)
             elif self.mode == Modes.TownRoadBuilder:
+                self.record("build")
                 self.town.projecting_road.build()
             elif self.mode == Modes.Destroy:
-                build = self.town.getBuilding(int(self.destroy_pos.x()), int(self.destroy_pos.y()))
-                if build:
-                    build.destroy()
-                    self.setMode(Modes.Town)
+                self.releaseSelection(event)
             elif self.mode == Modes.Pause:
                 if Town.isPointInRect(event.pos(), (
                         QPoint(self.width() * .41, self.height() * .4),
@@ -203,18 +316,84 @@ class Frame(QMainWindow):
 
         self.last_button = Qt.NoButton
 
+    def saveTown(self) -> None:
+        """Save town without freezing the window."""
+
+        if self.save_thread is not None and self.save_thread.is_alive():
+            return
+
+        def progress(value: float) -> None:
+            self.save_progress = value
+
+        def done() -> None:
+            self.save_progress = None
+            self.saved_time = time.monotonic()
+
+        self.save_progress = 0
+        self.save_thread = self.town.saveInBackground(progress, done)
+
+    @staticmethod
+    def toggleTrace() -> None:
+        """Start capture of trace or stop it and write it to file."""
+
+        if trace.capturing:
+            trace.stop(captureFileName("trace", "json"))
+        else:
+            trace.start()
+
+    def writeMemoryReport(self) -> None:
+        """Write memory report with changes since the previous one. The first report starts tracemalloc."""
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.id_buffer.clear()  # it refers to objects of the last render, they may be destroyed since it
+        self.memory_snapshot = writeReport(self.town, captureFileName("memory", "json"), self.memory_snapshot)
+
+    @staticmethod
+    def startProfileSession() -> None:
+        if not profileSession.active:
+            profileSession.start(captureFileName("profile", "pstats"), PROFILE_SECONDS)
+
     def keyReleaseEvent(self, event: QKeyEvent) -> None:
         event_key = event.key()
 
         if event_key == Qt.Key_I:
             self.setMode(Modes.Instructions)
 
+        if event_key == Qt.Key_S and event.modifiers() & Qt.ControlModifier:
+            self.saveTown()
+
+        if event_key == Qt.Key_V and event.modifiers() & Qt.ControlModifier:
+            if self.mode == Modes.Town and self.district is not None:
+                self.pasteDistrict()
+
+        if event_key == Qt.Key_F3:
+            frameProfiler.reset()
+            frameProfiler.enabled = not frameProfiler.enabled
+
+        if event_key == Qt.Key_F4:
+            self.toggleTrace()
+
+        if event_key == Qt.Key_F5:
+            self.startProfileSession()
+
+        if event_key == Qt.Key_F6:
+            self.writeMemoryReport()
+
+        if event_key == Qt.Key_F7:
+            if self.recorder is None:
+                self.startRecording(captureFileName("session", "jsonl"))
+            else:
+                self.stopRecording()
+
         if event_key == Qt.Key_Right:
             if self.mode == Modes.TownBuilder:
+                self.record("turn", 90)
                 self.town.chosen_building.turn(90)
 
         if event_key == Qt.Key_Left:
             if self.mode == Modes.TownBuilder:
+                self.record("turn", -90)
                 self.town.chosen_building.turn(-90)
 
         if event_key == Qt.Key_Escape:
@@ -322,29 +501,72 @@ class Frame(QMainWindow):
         self.drawButton(painter, cursor, rect, pix, resize=False)
         return rect
 
+    def drawProfiler(self, painter: QPainter) -> None:
+        """Overlay with counters of frameProfiler."""
+
+        counters = frameProfiler.counters()
+        lines = [
+            f"{name:10} p50 {counters[name]['p50'] * 1000:6.2f}  p95 {counters[name]['p95'] * 1000:6.2f}  "
+            f"p99 {counters[name]['p99'] * 1000:6.2f} ms"
+            for name in ("frame", "tick")
+        ]
+        for phase, phase_counters in counters["phases"].items():
+            lines.append(f"{phase:10} {phase_counters['time'] * 1000:6.2f} ms {phase_counters['calls']:7} calls")
+        aggregates = self.town.aggregates
+        lines.append(f"{'town':10} {aggregates.buildings} buildings {aggregates.roads} roads "
+                     f"{aggregates.citizens} citizens")
+
+        painter.setOpacity(1)
+        painter.setFont(QFont("monospace", max(8, self.width() // 160)))
+        metrics = painter.fontMetrics()
+        rect = QRect(0, 0, max(metrics.width(line) for line in lines) + 20, metrics.height() * len(lines) + 20)
+        rect.moveTopRight(QPoint(self.width() - 10, 10))
+        painter.fillRect(rect, QColor(0, 0, 0, 160))
+        painter.setPen(Qt.white)
+        for i, line in enumerate(lines):
+            painter.drawText(rect.x() + 10, rect.y() + 10 + metrics.ascent() + metrics.height() * i, line)
+
+    @traced("Frame.paintEvent")
+    @profileSession.profiled
     def paintEvent(self, event: QPaintEvent) -> None:
+        startup.begin("paintEvent")
+        frame_start = time.perf_counter()
         painter = QPainter(self)
 
-        cursor_pos = (self.cursor().pos() - self.frameGeometry().bottomRight() + QPoint(
-            self.width(),
-            self.height()
-        ) / 2) * self.town.cam_z + QPoint(self.town.cam_x, self.town.cam_y)
+        startup.begin("Town.draw")
+        if self.mode == Modes.TownRoadBuilder:
+            shape = "rectangle" if QApplication.keyboardModifiers() & Qt.ShiftModifier else "line"
+            if shape != self.town.projecting_road.shape:
+                self.record("path_shape", shape)
+                self.town.projecting_road.setShape(shape)
+
+        if self.mode in (Modes.TownBuilder, Modes.TownRoadBuilder):
+            iso = self.cursorIso()
+            if self.recorder is not None and self.projected_cell != (round(iso.x()), round(iso.y())):
+                self.projected_cell = (round(iso.x()), round(iso.y()))
+                self.record("move", iso.x(), iso.y())
+            (self.town.chosen_building or self.town.projecting_road).addToMap(iso)
+        elif self.selection is not None:
+            self.selection.addToMap(self.cursorIso())
 
         if self.mode == Modes.TownRoadBuilder:
-            self.town.projecting_road.addToMap(Town.isometric(cursor_pos.x(), cursor_pos.y()))
-            self.town.draw(painter, self.size(), .8, .4)
+            opacities = (.8, .4)
         else:
-            if self.mode == Modes.TownBuilder:
-                self.town.chosen_building.addToMap(Town.isometric(cursor_pos.x(), cursor_pos.y()))
-            self.town.draw(painter, self.size(), math.sin(math.radians(self.blinkAnimation)) * .2 + .6)
+            opacities = (math.sin(math.radians(self.blinkAnimation)) * .2 + .6, 1)
             self.blinkAnimation += 4
+        self.record("draw", self.width(), self.height(), *opacities)
+        self.town.draw(painter, self.size(), *opacities)
+        startup.end()
+        hud_start = time.perf_counter()
 
         cursor = QPoint(
             self.cursor().pos().x() - self.pos().x(),
             self.cursor().pos().y() + self.height() - self.frameSize().height() - self.pos().y()
         )
         if self.mode == Modes.Destroy:
-            self.destroy_pos = (Town.isometric(cursor_pos.x(), cursor_pos.y()))
+            hovered = self.id_buffer.pick(cursor, self.size())
+            if isinstance(hovered, Town.Building):
+                self.id_buffer.highlight(painter, hovered, QColor(255, 40, 40, 90))
             painter.drawImage(QRect(cursor - QPoint(48, 48), QSize(96, 96)), getImage("destroy"))
         self.drawMenu(painter, QRect(0, self.height() * .8 + self.menuAnimation, self.width(), self.height() * .2 + 1))
         if self.mode in (Modes.Town, Modes.Pause) or self.mode == Modes.Instructions and self.last_mode == Modes.Town:
@@ -357,6 +579,7 @@ class Frame(QMainWindow):
             types = Town.BuildingTypes
         elif self.menu_mode == 2:
             types = Town.RoadTypes
+        startup.begin("menu thumbnails")
         for i in range(len(types.sorted_names)):
             self.drawButton(painter, cursor, QRect(
                 self.height() * (3 * i + 1) / 15 - self.scrollAmount - 4,
@@ -364,6 +587,7 @@ class Frame(QMainWindow):
                 self.height() * .2,
                 self.height() * .2
             ), types.getByNumber(i).drawDefault(QSize(self.height() * .2 - 6, self.height() * .2 - 10)))
+        startup.end()
         self.drawButton(
             painter,
             cursor,
@@ -383,6 +607,20 @@ class Frame(QMainWindow):
             QPixmap.fromImage(getImage("destroy"))
         )
 
+        save_progress = self.save_progress
+        if save_progress is not None or self.saved_time is not None and time.monotonic() - self.saved_time < 2:
+            painter.setPen(Qt.white)
+            painter.setFont(QFont("arial", self.width() // 100))
+            painter.drawText(self.width() * .01, self.height() * .03,
+                             "Сохранено." if save_progress is None else f"Сохранение... {int(save_progress * 100)}%")
+
+        captures = [text for text, running in (("Запись трассировки... (F4)", trace.capturing),
+                                               ("Профилирование...", profileSession.active)) if running]
+        if captures:
+            painter.setPen(Qt.white)
+            painter.setFont(QFont("arial", self.width() // 100))
+            painter.drawText(self.width() * .01, self.height() * .06, "  ".join(captures))
+
         if self.mode in (Modes.Instructions, Modes.Pause):
             painter.fillRect(self.rect(), QColor(0, 0, 0, 128))  # darken everything else
             self.drawMenu(
@@ -448,12 +686,42 @@ class Frame(QMainWindow):
                     resize=False
                 )
 
+        if frameProfiler.enabled:
+            frameProfiler.lap("HUD", hud_start)
+            frameProfiler.endFrame(time.perf_counter() - frame_start)
+            self.drawProfiler(painter)
+
+        startup.finish()  # the first frame is drawn
+
 
 if __name__ == "__main__":
-    app = QApplication([])
-    town = Town.Town()
-    town.load()
-    frame = Frame(town)
+    parser = argparse.ArgumentParser(description="Medieval Rise")
+    parser.add_argument("--regions", type=int, default=0,
+                        help="simulate citizens in worker processes, one per region of chunks")
+    parser.add_argument("--profile-startup", metavar="FILE", nargs="?", const=STARTUP_PROFILE_FILE,
+                        help="write time and allocations of startup phases to JSON file (default: %(const)s)")
+    parser.add_argument("--record", metavar="FILE", help="record session to replay it by headless.py --replay")
+    args, qt_args = parser.parse_known_args()
+    if args.profile_startup is not None:
+        startup.file_name = args.profile_startup
+
+    with startup.phase("QApplication"):
+        app = QApplication(qt_args)
+    with startup.phase("Town()"):
+        town = Town.Town()
+    with startup.phase("Town.load"):
+        town.load(stream=True)
+    with startup.phase("journal"):
+        town.startJournal()
+    if args.regions:
+        with startup.phase("region simulation"):
+            town.startRegionSimulation(args.regions)
+    with startup.phase("Frame()"):
+        frame = Frame(town)
+    if args.record is not None:
+        frame.startRecording(args.record)
+    startup.begin("first frame")
     frame.setMaximumSize(app.screens()[0].size())
     frame.showMaximized()
+    prefetchTextures()
     app.exec_()
@@ -0,0 +1,162 @@
+"""Memory used by town by subsystems and objects which are alive after destroy."""
+import gc
+import json
+import sys
+import tracemalloc
+import weakref
+from collections import Counter
+from threading import Lock
+from types import ModuleType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+
+from PyQt5.QtGui import QImage
+
+from resources_manager import imageResources
+from TownObjects import Block, BuildingType, Ground, Mask, RoadType, loadedTextures
+
+TOP_ALLOCATIONS = 10  # lines of tracemalloc statistics in report
+TRACKED_MODULES = ("Town", "TownObjects")  # live instances of classes from these modules are counted
+
+# Other subsystems (for example caches of HUD) add functions returning their size in bytes here.
+memoryProviders: Dict[str, Callable[[], int]] = {}
+
+_destroyed: Dict[int, weakref.ref] = {}
+_destroyed_lock = Lock()
+
+
+def trackDestroyed(obj: Any) -> None:
+    """Remember destroyed object to report it if it's still alive, which means it leaks."""
+
+    key = id(obj)
+
+    def forget(_):
+        with _destroyed_lock:
+            _destroyed.pop(key, None)
+
+    with _destroyed_lock:
+        _destroyed[key] = weakref.ref(obj, forget)
+
+
+def aliveDestroyed() -> List[Any]:
+    """Destroyed objects which are still referenced."""
+
+    gc.collect()
+    with _destroyed_lock:
+        refs = list(_destroyed.values())
+    return [obj for obj in (ref() for ref in refs) if obj is not None]
+
+
+def deepSize(obj: Any, seen: Set[int], stop: tuple = ()) -> int:
+    """Size of obj and objects which it refers to, except instances of stop and objects in seen."""
+
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or item is not obj and isinstance(item, stop):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__") and not isinstance(item, type):
+            stack.append(item.__dict__)
+    return size
+
+
+def textureSizes() -> Dict[str, int]:
+    """Bytes of pixels of loaded textures. Texture evicted from cache still uses memory if it's referred."""
+
+    cached = {image.cacheKey(): image.sizeInBytes() for image in imageResources.images().values()}
+    referred = {image.cacheKey(): image.sizeInBytes() for image in loadedTextures() if not image.isNull()}
+    outside = {key: size for key, size in referred.items() if key not in cached}
+    return {
+        "bytes": sum(cached.values()) + sum(outside.values()),
+        "images": len(cached) + len(outside),
+        "cache_bytes": sum(cached.values()),
+        "outside_cache_bytes": sum(outside.values()),
+    }
+
+
+class MemorySnapshot(NamedTuple):
+    subsystems: Dict[str, int]  # bytes
+    textures: Dict[str, int]
+    objects: Dict[str, int]  # live instances of classes from TRACKED_MODULES
+    leaked: List[str]  # destroyed objects which are still alive
+    traced: Optional[tracemalloc.Snapshot]  # if tracemalloc is tracing
+
+    def report(self) -> Dict[str, Any]:
+        report = {
+            "subsystems": self.subsystems,
+            "total": sum(self.subsystems.values()),
+            "textures": self.textures,
+            "objects": self.objects,
+            "leaked": self.leaked,
+        }
+        if self.traced is not None:
+            report["traced_bytes"] = sum(stat.size for stat in self.traced.statistics("filename"))
+            report["top_allocations"] = [str(stat) for stat in self.traced.statistics("lineno")[:TOP_ALLOCATIONS]]
+        return report
+
+    def diff(self, old: 'MemorySnapshot') -> Dict[str, Any]:
+        """Changes since old snapshot."""
+
+        diff = {
+            "subsystems": {name: size - old.subsystems.get(name, 0) for name, size in self.subsystems.items()},
+            "objects": {
+                name: self.objects.get(name, 0) - old.objects.get(name, 0)
+                for name in self.objects.keys() | old.objects.keys()
+                if self.objects.get(name, 0) != old.objects.get(name, 0)
+            },
+            "new_leaked": [item for item in self.leaked if item not in old.leaked],
+        }
+        if self.traced is not None and old.traced is not None:
+            diff["top_allocations"] = [
+                str(stat) for stat in self.traced.compare_to(old.traced, "lineno")[:TOP_ALLOCATIONS]
+            ]
+        return diff
+
+
+def takeSnapshot(town) -> MemorySnapshot:
+    """Memory used by town subsystems. Every object is counted once, in the first subsystem referring to it."""
+
+    import Town  # Town imports this module
+
+    shared = (Town.Town, BuildingType, Block, Ground, Mask, RoadType, QImage, type, ModuleType)
+    seen = set()
+    subsystems = {
+        "chunks": deepSize(town.chunks, seen, shared + (Town.Building, Town.ProjectedBuilding, Town.Road)),
+        "buildings": deepSize(town.buildings, seen, shared),
+        "roads": deepSize(town.roads, seen, shared),
+        "citizens": deepSize((town.citizens, town.citizens_view), seen, shared),
+    }
+    textures = textureSizes()
+    subsystems["textures"] = textures["bytes"] + deepSize(imageResources, seen, (QImage,))
+    subsystems["mask_images"] = sum(chunk.maskImageSize() for chunks in town.chunks for chunk in chunks)
+    for name, provider in memoryProviders.items():
+        subsystems[name] = provider()
+
+    objects = Counter(type(obj).__qualname__ for obj in gc.get_objects() if type(obj).__module__ in TRACKED_MODULES)
+    leaked = [f"{type(obj).__qualname__} at {hex(id(obj))}" for obj in aliveDestroyed()]
+    traced = None
+    if tracemalloc.is_tracing():
+        traced = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+    return MemorySnapshot(subsystems, textures, dict(objects), leaked, traced)
+
+
+def writeReport(town, file_name: str, previous: MemorySnapshot = None) -> MemorySnapshot:
+    """Write report of memory used by town, with changes since previous snapshot. Return the new snapshot."""
+
+    snapshot = takeSnapshot(town)
+    report = snapshot.report()
+    if previous is not None:
+        report["diff"] = snapshot.diff(previous)
+    with open(file_name, "w") as file:
+        json.dump(report, file, indent=2)
+    return snapshot
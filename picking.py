@@ -0,0 +1,173 @@
+"""Offscreen buffer of ids of town objects on screen. Object under a pixel is found by one read of the buffer."""
+from collections import OrderedDict
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from PyQt5.QtCore import QPoint, QPointF, QSize, Qt
+from PyQt5.QtGui import QBitmap, QColor, QImage, QPainter
+
+import Town
+from profiling import frameProfiler, traced
+from TownObjects import ISOMETRIC_HEIGHT1, ISOMETRIC_HEIGHT2, ISOMETRIC_WIDTH
+
+STENCILS_LIMIT = 4096  # cached stencils, they are 1 bit per pixel
+
+_stencils = OrderedDict()  # {cacheKey of image: stencil}
+
+
+def stencil(image: QImage) -> QBitmap:
+    """Pixels of image which are opaque at least by half.
+        Stencil is cached by image, so texture which is loaded to image cache again gets a new stencil."""
+
+    key = image.cacheKey()
+    bitmap = _stencils.get(key)
+    if bitmap is None:
+        bitmap = _stencils[key] = QBitmap.fromImage(image.createAlphaMask(Qt.ThresholdAlphaDither))
+        if len(_stencils) > STENCILS_LIMIT:
+            _stencils.popitem(last=False)
+    else:
+        _stencils.move_to_end(key)
+    return bitmap
+
+
+class StencilPainter:
+    """Painter for draw methods of town objects. It draws stencils of images in color of id of the current object."""
+
+    def __init__(self, painter: QPainter):
+        self.painter = painter
+        painter.setBackgroundMode(Qt.TransparentMode)
+
+    def setId(self, object_id: int) -> None:
+        self.painter.setPen(QColor(object_id))
+
+    def drawImage(self, *args: Union[QPointF, int, QImage]) -> None:
+        """Arguments are position and image or x, y and image as in QPainter.drawImage."""
+
+        *position, image = args
+        if not image.isNull():
+            self.painter.drawPixmap(QPointF(*position), stencil(image))
+
+
+PickedObject = Union['Town.Building', 'Town.Road', 'Town.CitizenView']
+
+
+class IdBuffer:
+    """Image where every pixel is id of building, road or citizen drawn on it.
+        Buffer is rendered again on pick only if camera, screen size, buildings or roads are changed since the last
+        render, and citizens are changed if they are picked too."""
+
+    def __init__(self, town: 'Town.Town', citizens: bool = False):
+        self.town = town
+        self.citizens = citizens
+        self.renders = 0
+        self._image = None
+        self._objects: List[Optional[PickedObject]] = [None]  # object of id, 0 is empty pixel
+        self._ids: Dict[int, int] = {}  # {id(object): its id in buffer}
+        self._key = None
+        self._highlight = None  # (number of render, id, mask) of the last highlighted object
+
+    def _currentKey(self, size: QSize) -> Tuple[Any, ...]:
+        town = self.town
+        return (town.cam_x, town.cam_y, town.cam_z, size.width(), size.height(), town.revision,
+                id(town.citizens_view) if self.citizens else None)
+
+    @traced("IdBuffer.render")
+    def render(self, size: QSize) -> None:
+        """Draw ids of objects the same way as Town.draw draws them."""
+
+        start = perf_counter()
+        town = self.town
+        if self._image is None or self._image.size() != size:
+            self._image = QImage(size, QImage.Format_RGB32)
+        self._image.fill(0)
+        self._objects = [None]
+        self._ids = {}
+
+        x = int(town.cam_x - (town.cam_z * size.width()) / 2)
+        y = int(town.cam_y - (town.cam_z * size.height()) / 2)
+        citizens = town.citizens_view if self.citizens else {}
+        painter = QPainter(self._image)
+        painter.scale(town.scale, town.scale)
+        stencil_painter = StencilPainter(painter)
+        for chunks in town.chunks:
+            for chunk in chunks:
+                if chunk.loaded and town.isChunkVisible(chunk, size):
+                    self._renderChunk(chunk, stencil_painter, x, y, citizens.get((chunk.x // 16, chunk.y // 16)))
+        painter.end()
+
+        self._key = self._currentKey(size)
+        self.renders += 1
+        if frameProfiler.enabled:
+            frameProfiler.lap("IdBuffer.render", start, len(self._objects) - 1)
+
+    def _setObject(self, painter: StencilPainter, obj: PickedObject) -> None:
+        """Draw the next images as obj."""
+
+        object_id = self._ids.get(id(obj))
+        if object_id is None:
+            object_id = self._ids[id(obj)] = len(self._objects)
+            self._objects.append(obj)
+        painter.setId(object_id)
+
+    def _renderChunk(self, chunk: 'Town.Chunk', painter: StencilPainter, x: int, y: int, citizens) -> None:
+        # the same order as in Chunk.draw: roads, then citizens and blocks cell by cell
+        for i in range(16):
+            for j in range(16):
+                road = chunk.roads[i][j]
+                if road is not None:
+                    self._setObject(painter, road)
+                    road.draw(painter, x, y)
+
+        for i in range(16):
+            for j in range(16):
+                if citizens is not None and (i, j) in citizens:
+                    for citizen in citizens[(i, j)]:
+                        self._setObject(painter, citizen)
+                        citizen.draw(painter, x, y)
+
+                for z in range(5):
+                    building = chunk.blocks[i][j][z]
+                    if building is not None:
+                        self._setObject(painter, building)
+                        block, angle, variant = building.getBlock(i + chunk.x, j + chunk.y, z)
+                        block.draw((chunk.x + i - chunk.y - j) * ISOMETRIC_WIDTH - x,
+                                   (chunk.x + chunk.y + i + j) * ISOMETRIC_HEIGHT1 - z * ISOMETRIC_HEIGHT2 - y,
+                                   angle, painter, variant)
+
+    def pick(self, point: QPoint, size: QSize) -> Optional[PickedObject]:
+        """Object drawn on point of screen with size."""
+
+        if self._key != self._currentKey(size):
+            self.render(size)
+        if not self._image.rect().contains(point):
+            return None
+        object_id = self._image.pixel(point) & 0xffffff
+        return self._objects[object_id] if object_id < len(self._objects) else None
+
+    def clear(self) -> None:
+        """Forget objects of the last render, buffer is rendered again by the next pick.
+            Destroyed objects aren't kept alive by the buffer, so they aren't reported as leaked."""
+
+        self._objects = [None]
+        self._ids = {}
+        self._key = None
+        self._highlight = None
+
+    def sizeInBytes(self) -> int:
+        return self._image.sizeInBytes() if self._image is not None else 0
+
+    def highlight(self, painter: QPainter, obj: PickedObject, color: QColor) -> None:
+        """Fill visible pixels of obj by color. Buffer have to be rendered for the current frame by pick."""
+
+        object_id = self._ids.get(id(obj))
+        if object_id is None or self._objects[object_id] is not obj:
+            return
+        if self._highlight is None or self._highlight[:2] != (self.renders, object_id):
+            mask = QBitmap.fromImage(self._image.createMaskFromColor(QColor(object_id).rgb(), Qt.MaskOutColor))
+            self._highlight = (self.renders, object_id, mask)
+        mask = self._highlight[2]
+        painter.save()
+        painter.setPen(color)
+        painter.setBackgroundMode(Qt.TransparentMode)
+        painter.drawPixmap(0, 0, mask)
+        painter.restore()
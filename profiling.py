@@ -0,0 +1,344 @@
+import cProfile
+import gc
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+STARTUP_PROFILE_ENV = "MEDIEVAL_RISE_PROFILE_STARTUP"  # "1" or file name of report
+STARTUP_PROFILE_FILE = "startup_profile.json"
+PROFILER_HISTORY = 300  # frames and ticks which percentiles are computed for
+PROFILE_SECONDS = 10  # duration of cProfile session started by hotkey
+
+
+class StartupTracer:
+    """Wall time and allocations of startup phases until the first frame.
+        Phases can be nested, every phase is reported with its parent. It does nothing until it's started.
+        Allocated memory is reported too if tracemalloc is tracing (python -X tracemalloc)."""
+
+    def __init__(self):
+        self.file_name = None
+        self.phases: List[Dict[str, Any]] = []
+        self._opened: List[Dict[str, Any]] = []
+        self._start = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.file_name is not None
+
+    def start(self, file_name: str = STARTUP_PROFILE_FILE) -> None:
+        self.file_name = file_name
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def _counters() -> Dict[str, int]:
+        counters = {
+            "allocated_blocks": sys.getallocatedblocks(),
+            "gc_collections": sum(generation["collections"] for generation in gc.get_stats()),
+        }
+        if tracemalloc.is_tracing():
+            counters["traced_bytes"] = tracemalloc.get_traced_memory()[0]
+        return counters
+
+    def begin(self, name: str) -> None:
+        if self.enabled:
+            self._opened.append({
+                "name": name,
+                "parent": self._opened[-1]["name"] if self._opened else None,
+                "start": time.perf_counter() - self._start,
+                **self._counters(),
+            })
+
+    def end(self) -> None:
+        if self.enabled and self._opened:
+            phase = self._opened.pop()
+            phase["duration"] = time.perf_counter() - self._start - phase["start"]
+            for counter, value in self._counters().items():
+                phase[counter] = value - phase.get(counter, 0)
+            self.phases.append(phase)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time_to_first_frame": time.perf_counter() - self._start,
+            "allocated_blocks": sys.getallocatedblocks(),
+            "phases": sorted(self.phases, key=lambda phase: phase["start"]),
+        }
+
+    def finish(self) -> None:
+        """Close all phases and write report. Tracer is stopped."""
+
+        if not self.enabled:
+            return
+        while self._opened:
+            self.end()
+        with open(self.file_name, "w") as file:
+            json.dump(self.report(), file, indent=2)
+        self.file_name = None
+
+
+def _startupProfileFile() -> Optional[str]:
+    value = os.environ.get(STARTUP_PROFILE_ENV)
+    if not value:
+        return None
+    return STARTUP_PROFILE_FILE if value == "1" else value
+
+
+startup = StartupTracer()
+if _startupProfileFile() is not None:  # environment is checked on import to trace imports too
+    startup.start(_startupProfileFile())
+
+
+def percentiles(values: Iterable[float], points: Iterable[int] = (50, 95, 99)) -> Dict[str, float]:
+    """Nearest-rank percentiles of values as {"p50": ...}. They are 0 if there are no values."""
+
+    values = sorted(values)
+    return {
+        f"p{point}": values[max(0, -(-len(values) * point // 100) - 1)] if values else 0
+        for point in points
+    }
+
+
+class FrameProfiler:
+    """Time and draw calls of drawing phases and rolling percentiles of frame and tick times.
+        Phases are added by draw methods only while profiler is enabled, the frame is finished by endFrame."""
+
+    def __init__(self, history: int = PROFILER_HISTORY):
+        self.enabled = False
+        self.frame_times = deque(maxlen=history)
+        self.tick_times = deque(maxlen=history)
+        self.last_frame: Dict[str, Dict[str, float]] = {}  # phases of the last finished frame
+        self.last_tick: Dict[str, float] = {}
+        self._phases: Dict[str, List[float]] = {}  # phases of the current frame, {phase: [time, calls]}
+        self._lock = Lock()
+
+    def add(self, phase: str, elapsed: float, calls: int = 0) -> None:
+        counters = self._phases.setdefault(phase, [0, 0])
+        counters[0] += elapsed
+        counters[1] += calls
+
+    def lap(self, phase: str, start: float, calls: int = 0) -> float:
+        """Add time since start to phase. Return current time, which is start of the next phase."""
+
+        now = time.perf_counter()
+        self.add(phase, now - start, calls)
+        return now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.lap(name, start)
+
+    def endFrame(self, elapsed: float) -> None:
+        """Finish frame which was drawn in elapsed seconds."""
+
+        phases = self._phases
+        self._phases = {}
+        with self._lock:
+            self.frame_times.append(elapsed)
+            self.last_frame = {
+                phase: {"time": phase_time, "calls": calls} for phase, (phase_time, calls) in phases.items()
+            }
+
+    def addTick(self, elapsed: float, citizens: int) -> None:
+        with self._lock:
+            self.tick_times.append(elapsed)
+            self.last_tick = {"time": elapsed, "citizens": citizens}
+
+    def counters(self) -> Dict[str, Any]:
+        """All counters, times are in seconds."""
+
+        with self._lock:
+            return {
+                "frame": {"count": len(self.frame_times), **percentiles(self.frame_times)},
+                "tick": {"count": len(self.tick_times), **percentiles(self.tick_times)},
+                "phases": dict(self.last_frame),
+                "last_tick": dict(self.last_tick),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.frame_times.clear()
+            self.tick_times.clear()
+            self.last_frame = {}
+            self.last_tick = {}
+            self._phases = {}
+
+
+frameProfiler = FrameProfiler()
+
+
+def captureFileName(kind: str, extension: str) -> str:
+    """Name of file for capture started now, like trace-20240101-120000.json."""
+
+    return f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+
+
+class TraceRecorder:
+    """Spans of functions decorated by traced in Chrome trace-event format (chrome://tracing, Perfetto).
+        Spans are recorded only between start and stop, they are tagged with thread ids and names."""
+
+    def __init__(self):
+        self.capturing = False
+        self._events: List[Dict[str, Any]] = []
+        self._threads: Dict[int, str] = {}
+        self._lock = Lock()
+        self._start = 0
+
+    def start(self) -> None:
+        with self._lock:
+            self._events = []
+            self._threads = {}
+            self._start = time.perf_counter()
+            self.capturing = True
+
+    def add(self, name: str, start: float, end: float) -> None:
+        thread = threading.current_thread()
+        with self._lock:
+            if self.capturing:
+                self._threads.setdefault(thread.ident, thread.name)
+                self._events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self._start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": thread.ident,
+                })
+
+    def stop(self, file_name: str) -> int:
+        """Stop capture and write it to file_name. Return count of spans."""
+
+        with self._lock:
+            self.capturing = False
+            events, threads = self._events, self._threads
+            self._events, self._threads = [], {}
+
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        with open(file_name, "w") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+        return len(events)
+
+
+trace = TraceRecorder()
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """Decorator recording calls of function as spans called name while trace is capturing."""
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not trace.capturing:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(name, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+
+class ProfileSession:
+    """cProfile session for some seconds. Calls made by runcall are profiled by a profiler of their thread.
+        When session is over, every thread adds its stats at its next runcall and pstats file is rewritten."""
+
+    def __init__(self):
+        self.file_name = None
+        self._deadline = None
+        self._session = 0  # number of the current session, profilers of old ones are dropped
+        self._stats = None
+        self._local = threading.local()
+        self._lock = Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._deadline is not None and time.perf_counter() < self._deadline
+
+    def start(self, file_name: str, seconds: float = None) -> None:
+        """Profile calls for seconds or until stop."""
+
+        with self._lock:
+            self.file_name = file_name
+            self._stats = None
+            self._session += 1
+            self._deadline = time.perf_counter() + (float("inf") if seconds is None else seconds)
+
+    def stop(self) -> None:
+        self._deadline = time.perf_counter()
+        self.collect()
+
+    def collect(self) -> None:
+        """Add stats of profiler of this thread to file if session is over.
+            Thread which stops calling runcall should call it at last."""
+
+        local = self._local
+        profile = getattr(local, "profile", None)
+        if profile is None or getattr(local, "running", False) or self.active and local.session == self._session:
+            return
+        local.profile = None
+        if local.session != self._session:
+            return
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._stats.dump_stats(self.file_name)
+
+    def runcall(self, func: Callable, *args, **kwargs) -> Any:
+        self.collect()
+        local = self._local
+        if not self.active or getattr(local, "running", False):
+            return func(*args, **kwargs)
+
+        if getattr(local, "profile", None) is None:
+            local.profile = cProfile.Profile()
+            local.session = self._session
+        try:
+            local.profile.enable()
+        except ValueError:  # since Python 3.12 only one thread can be profiled at once
+            return func(*args, **kwargs)
+        local.running = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.profile.disable()
+            local.running = False
+
+    def profiled(self, func: Callable) -> Callable:
+        """Decorator profiling calls of function while session is active."""
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.runcall(func, *args, **kwargs)
+        return wrapper
+
+
+profileSession = ProfileSession()
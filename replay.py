@@ -0,0 +1,208 @@
+"""Recording of game sessions as high-level commands and their replay against Town without window.
+    Session is JSON lines: the first one is the town at start of recording with states of its random streams and
+    projecting building or road, others are [time, command, *args]:
+        translate dx dy                    camera is moved
+        zoom delta                         camera is zoomed
+        choose_building btype              player starts projecting building type number btype
+        choose_road btype                  player starts projecting road type number btype
+        cancel                             projecting building or road is removed
+        move iso_x iso_y                   projecting building or road is moved to isometric position
+        turn delta_angle                   projecting building is turned
+        start_path                         path of projecting roads is started on the current cell
+        path_shape shape                   shape of path of projecting roads is changed
+        build                              projecting building or roads are built
+        destroy id                         building with id is destroyed
+        destroy_area x1 y1 x2 y2           buildings in rectangle are destroyed
+        copy_area x1 y1 x2 y2              district in rectangle is copied
+        paste x y                          copied district is pasted with corner on cell x, y
+        tick width height                  game tick with screen size
+        draw width height projecting_opacity builded_opacity    frame is drawn"""
+import json
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from PyQt5.QtCore import QPoint, QPointF, QSize
+from PyQt5.QtGui import QImage, QPainter
+
+import Town
+from profiling import percentiles
+from save_format import BuildingRecord, RoadRecord
+
+SESSION_FORMAT = 4  # buildings are addressed by ids since 3, random streams and projecting one are saved since 4
+
+
+def _projecting(town: Town.Town) -> Optional[list]:
+    """Projecting building or road of town as JSON list, see _restoreProjecting."""
+
+    if town.chosen_building is not None:
+        building = town.chosen_building
+        return ["building", town.chosen_btype, building.x, building.y, *building.variant()]
+    if town.projecting_road is not None:
+        road = town.projecting_road
+        return ["road", town.chosen_btype, road.x, road.y, road.start, road.shape]
+    return None
+
+
+def _restoreProjecting(town: Town.Town, projecting: Optional[list]) -> None:
+    if projecting is None:
+        return
+    kind, town.chosen_btype, x, y, *state = projecting
+    if kind == "building":
+        btype_variant, blocks_variants, angle = state
+        town.chosen_building = Town.ProjectedBuilding(town)
+        town.chosen_building.setVariant(btype_variant, tuple(tuple(map(tuple, variants_x))
+                                                             for variants_x in blocks_variants), angle)
+        town.chosen_building.addToMap(QPointF(x, y))
+    else:
+        start, shape = state
+        road = town.projecting_road = Town.ProjectedRoad(town)
+        if start is not None:
+            road.addToMap(QPointF(*start))
+            road.startPath()
+        road.setShape(shape)
+        road.addToMap(QPointF(x, y))
+
+
+class SessionRecorder:
+    """Writer of session commands. It can be used from several threads."""
+
+    def __init__(self, file_name: str, town: Town.Town):
+        self.file_name = file_name
+        self._lock = Lock()
+        self._file = open(file_name, "w")
+        self._start = perf_counter()
+
+        snapshot = town.snapshot()
+        self._file.write(json.dumps({
+            "format": SESSION_FORMAT,
+            "seed": snapshot.seed,
+            "ticks": town.ticks,
+            "camera": [snapshot.cam_x, snapshot.cam_y, snapshot.cam_z],
+            "roads": [road.record() for road in snapshot.roads],
+            "buildings": [building.record() for building in snapshot.buildings],
+            # building of citizen is used only to get town, so citizen of destroyed building is given another one
+            "citizens": [[citizen.building.id, citizen.x, citizen.y] for citizen in town.citizens],
+            "projecting": _projecting(town),
+            "random": town.randomStates(),
+        }) + "\n")
+
+    def record(self, command: str, *args: Any) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(json.dumps([round(perf_counter() - self._start, 4), command, *args]) + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def readSession(file_name: str) -> Tuple[Town.Town, List[list]]:
+    """Town at start of session and commands of session."""
+
+    with open(file_name) as file:
+        header = json.loads(file.readline())
+        if header["format"] != SESSION_FORMAT:
+            raise ValueError(f"Session format {header['format']} is not supported.")
+        commands = [json.loads(line) for line in file if line.strip()]
+
+    town = Town.Town(header["seed"])
+    town.ticks = header["ticks"]
+    town.cam_x, town.cam_y, town.cam_z = header["camera"]
+    town.scale = 1 / town.cam_z
+    town.addRecords((RoadRecord(*road) for road in header["roads"]),
+                    (BuildingRecord(x, y, angle, building_type, btype_variant, tuple(blocks_variants), building_id)
+                     for x, y, angle, building_type, btype_variant, blocks_variants, building_id
+                     in header["buildings"]))
+    for building_id, x, y in header["citizens"]:
+        citizen = Town.Citizen(town.buildings.get(building_id) or next(iter(town.buildings)))
+        town.aggregates.moveCitizen(citizen.x, citizen.y, x, y)
+        citizen.x, citizen.y = x, y
+    town.publishCitizens()
+    _restoreProjecting(town, header["projecting"])
+    town.setRandomStates(header["random"])  # after projecting building is given its recorded variant
+    return town, commands
+
+
+class SessionPlayer:
+    """Executor of session commands on town, the same way as Frame does."""
+
+    def __init__(self, town: Town.Town):
+        self.town = town
+        self.district = None
+        self._image = None
+
+    def _project(self):
+        return self.town.chosen_building if self.town.chosen_building is not None else self.town.projecting_road
+
+    def cancel(self) -> None:
+        if self.town.chosen_building is not None:
+            self.town.chosen_building.destroy()
+            self.town.chosen_building = None
+        if self.town.projecting_road is not None:
+            self.town.projecting_road.destroy()
+            self.town.projecting_road = None
+
+    def apply(self, command: str, *args: Any) -> None:
+        town = self.town
+        if command == "translate":
+            town.translate(QPoint(*args))
+        elif command == "zoom":
+            town.zoom(*args)
+        elif command == "choose_building":
+            self.cancel()
+            town.chosen_btype = args[0]
+            town.chosen_building = Town.ProjectedBuilding(town)
+        elif command == "choose_road":
+            self.cancel()
+            town.chosen_btype = args[0]
+            town.projecting_road = Town.ProjectedRoad(town)
+        elif command == "cancel":
+            self.cancel()
+        elif command == "move":
+            self._project().addToMap(QPointF(*args))
+        elif command == "turn":
+            town.chosen_building.turn(*args)
+        elif command == "start_path":
+            town.projecting_road.startPath()
+        elif command == "path_shape":
+            town.projecting_road.setShape(*args)
+        elif command == "build":
+            self._project().build()
+        elif command == "destroy":
+            town.buildings.get(*args).destroy()
+        elif command == "destroy_area":
+            town.destroyArea(*args)
+        elif command == "copy_area":
+            self.district = town.copyDistrict(*args)
+        elif command == "paste":
+            town.pasteDistrict(self.district, *args)
+        elif command == "tick":
+            town.tick(QSize(*args))
+        elif command == "draw":
+            width, height, projecting_opacity, builded_opacity = args
+            if self._image is None or self._image.size() != QSize(width, height):
+                self._image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+            painter = QPainter(self._image)
+            town.draw(painter, QSize(width, height), projecting_opacity, builded_opacity)
+            painter.end()
+        else:
+            raise ValueError(f'Command "{command}" does not exist.')
+
+
+def replaySession(file_name: str) -> Tuple[Town.Town, Dict[str, Dict[str, float]]]:
+    """Replay session as fast as possible. Return town after session and statistics of time of every command."""
+
+    town, commands = readSession(file_name)
+    player = SessionPlayer(town)
+    times = {}
+    for _, command, *args in commands:
+        start = perf_counter()
+        player.apply(command, *args)
+        times.setdefault(command, []).append(perf_counter() - start)
+    player.cancel()
+
+    return town, {
+        command: {"count": len(values), "total": sum(values), "max": max(values), **percentiles(values)}
+        for command, values in times.items()
+    }
@@ -1,11 +1,92 @@
 import json
+import mmap
 import os
 import sys
+import weakref
+from collections import OrderedDict
+from struct import Struct
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
 
 from PyQt5.Qt import QImage
 
 
-imageResources = {}
+NULL_IMAGE = QImage()
+
+
+class ImageCache:
+    """Thread-safe LRU cache of images limited by memory budget in bytes.
+        Missing images are cached too, as None."""
+
+    MISSING_SIZE = 64  # bytes which are counted for missing image
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._images = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeOf(image: Optional[QImage]) -> int:
+        return ImageCache.MISSING_SIZE if image is None else image.sizeInBytes()
+
+    def get(self, name: str, load: Callable[[str], Optional[QImage]]) -> Optional[QImage]:
+        """Image called name. load is called to get image which isn't in cache."""
+
+        with self._lock:
+            if name in self._images:
+                self.hits += 1
+                self._images.move_to_end(name)
+                return self._images[name]
+            self.misses += 1
+
+        image = load(name)  # it's slow, so other threads aren't blocked
+        with self._lock:
+            if name not in self._images:
+                self._images[name] = image
+                self._size += self._sizeOf(image)
+                while self._size > self.budget and len(self._images) > 1:
+                    _, evicted = self._images.popitem(last=False)
+                    self._size -= self._sizeOf(evicted)
+                    self.evictions += 1
+            return self._images[name]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._images.clear()
+            self._size = 0
+
+    def images(self) -> Dict[str, QImage]:
+        """Cached images which exist."""
+
+        with self._lock:
+            return {name: image for name, image in self._images.items() if image is not None}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "images": sum(image is not None for image in self._images.values()),
+                "missing": sum(image is None for image in self._images.values()),
+                "bytes": self._size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._images
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._images)
+
+
+imageResources = ImageCache(int(os.environ.get("MEDIEVAL_RISE_IMAGE_CACHE_MB", 256)) * 1024 * 1024)
 
 try:
     wd = sys._MEIPASS
@@ -13,23 +94,151 @@ except AttributeError:
     wd = os.getcwd()
 
 
+PACK_FILE_NAME = "assets.pack"
+PACK_MAGIC = b"MRPACK\r\n"
+PACK_HEADER = Struct("<8sI")  # magic, length of index
+
+
+class AssetPack:
+    """Memory-mapped pack of decoded images and compiled game data, see asset_pack.py.
+        Entry of pack isn't used if some of its source files is newer than it."""
+
+    def __init__(self, file_name: str):
+        with open(file_name, 'rb') as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = PACK_HEADER.unpack_from(self._data)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{file_name} is not an asset pack.")
+        self._index = json.loads(self._data[PACK_HEADER.size:PACK_HEADER.size + index_length])
+        self._blobs = PACK_HEADER.size + index_length
+
+    def _blob(self, section: str, name: str) -> Optional[Dict[str, Any]]:
+        """Entry of fresh blob called name in section."""
+
+        entry = self._index[section].get(name)
+        if entry is None:
+            return None
+        for source, mtime in entry["sources"].items():
+            path = os.path.join(wd, source)
+            if os.path.exists(path) and os.path.getmtime(path) > mtime:
+                return None
+        return entry
+
+    def _bytes(self, entry: Dict[str, Any]) -> bytes:
+        return self._data[self._blobs + entry["offset"]:self._blobs + entry["offset"] + entry["length"]]
+
+    def image(self, name: str) -> Optional[QImage]:
+        entry = self._blob("images", name)
+        if entry is None:
+            return None
+        # copy, so image doesn't refer to temporary bytes
+        return QImage(self._bytes(entry), entry["width"], entry["height"], entry["bytes_per_line"],
+                      QImage.Format(entry["format"])).copy()
+
+    def data(self, section: str, name: str) -> Optional[Any]:
+        entry = self._blob(section, name)
+        return None if entry is None else json.loads(self._bytes(entry))
+
+    def close(self) -> None:
+        self._data.close()
+
+
+def _openPack() -> Optional[AssetPack]:
+    try:
+        return AssetPack(os.path.join(wd, PACK_FILE_NAME))
+    except (OSError, ValueError):
+        return None
+
+
+assetPack = _openPack()
+
+
+def closePack() -> None:
+    """Stop using asset pack, resources are loaded from their files. It's called before the pack is built again."""
+
+    global assetPack
+    if assetPack is not None:
+        assetPack.close()
+        assetPack = None
+
+
+def mirroredName(name: str, horizontal: bool, vertical: bool) -> str:
+    """Name of image called name which is mirrored, it's cached as a separate image."""
+
+    return f"{name}|mirrored{int(horizontal)}{int(vertical)}"
+
+
+def _loadImage(name: str) -> Optional[QImage]:
+    if "|mirrored" in name:
+        name, directions = name.split("|mirrored")
+        resource = _loadImage(name)
+        return None if resource is None else resource.mirrored(directions[0] == "1", directions[1] == "1")
+
+    if assetPack is not None:
+        resource = assetPack.image(name)
+        if resource is not None:
+            return resource
+
+    resource = QImage(os.path.join(wd, "assets", name + ".png"))
+    return None if resource.isNull() else resource
+
+
 def getImage(name: str, get_null: bool = False) -> QImage:
     """PNG image called name in assets."""
 
-    if name in imageResources:
-        return imageResources[name]
-    else:
-        resource = QImage(os.path.join(wd, "assets", name + ".png"))
-        if resource.isNull():
-            if not get_null:
-                raise ValueError(f"Resource {name}.png doesn't exist")
-        else:
-            imageResources[name] = resource
-        return resource
+    resource = imageResources.get(name, _loadImage)
+    if resource is None:
+        if not get_null:
+            raise ValueError(f"Resource {name}.png doesn't exist")
+        return NULL_IMAGE
+    return resource
 
 
 def getJSON(name: str) -> dict:
     """Converted JSON file called name in data."""
 
+    if assetPack is not None:
+        data = assetPack.data("data", name)
+        if data is not None:
+            return data
+
     with open(os.path.join(wd, "data", name + ".json")) as f:
         return json.load(f)
+
+
+def getCompiled(name: str, compile: Callable[[], Any]) -> Any:
+    """Compiled game data called name from asset pack. If pack hasn't fresh one, it's compiled by compile."""
+
+    if assetPack is not None:
+        data = assetPack.data("compiled", name)
+        if data is not None:
+            return data
+    return compile()
+
+
+class ImageRef:
+    """Image called name which is got by calling it. Only weak reference to image is kept, so image evicted from
+        cache is freed after it's drawn and it's got from cache again. Objects drawn with images keep them by it."""
+
+    __slots__ = ("name", "_get_null", "_ref")
+
+    def __init__(self, name: str, get_null: bool = False):
+        self.name = name
+        self._get_null = get_null
+        self._ref = _deadRef
+
+    def __call__(self) -> QImage:
+        image = self._ref()
+        if image is None:
+            image = getImage(self.name, self._get_null)
+            self._ref = weakref.ref(image)
+        return image
+
+    def loaded(self) -> Optional[QImage]:
+        """Image if it's in memory now."""
+
+        return self._ref()
+
+
+def _deadRef() -> None:
+    return None
@@ -0,0 +1,289 @@
+import mmap
+from struct import Struct
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+# Binary save layout, all numbers are little-endian:
+#   header       HEADER
+#   strings      town name, then tables of road types, building types, building variants and block variants
+#   chunk index  CHUNKS * CHUNKS records INDEX, chunks go x by x
+#   chunks       for every chunk: ROAD records, BUILDING records, REFERENCE records to block variants
+# Every string is u16 length and UTF-8 bytes, every table is u16 count of strings and strings.
+
+MAGIC = b"MRTOWN\r\n"
+FORMAT_VERSION = 2  # buildings have ids since 2
+CHUNKS = 16  # chunks in a row of the map
+
+HEADER = Struct("<8sHHqdddI")  # magic, format version, town version, seed, cam_x, cam_y, cam_z, next building id
+INDEX = Struct("<IHHI")  # chunk offset, roads, buildings, block variants references
+ROAD = Struct("<BH")  # cell (x % 16 * 16 + y % 16), road type
+# x and y of building are signed, building may stick out of the top or left edge of the map
+BUILDING = Struct("<IhhBHHH")  # id, x, y, angle // 90, building type, building variant, block variants count
+HEADER_V1 = Struct("<8sHHqddd")  # headers and buildings of format 1 have no ids
+BUILDING_V1 = Struct("<hhBHHH")
+REFERENCE = Struct("<H")  # block variant
+LENGTH = Struct("<H")
+
+
+class SaveHeader(NamedTuple):
+    version: int
+    name: str
+    cam_x: float
+    cam_y: float
+    cam_z: float
+    seed: int
+    next_building_id: int = 0  # ids less than it are used by buildings of town
+
+
+class RoadRecord(NamedTuple):
+    x: int
+    y: int
+    road_type: str
+
+
+class BuildingRecord(NamedTuple):
+    """Saved building. blocks_variants are variants of not empty blocks going x by x, y by y, z by z."""
+
+    x: int
+    y: int
+    angle: int
+    building_type: str
+    btype_variant: str
+    blocks_variants: Tuple[str]
+    id: Optional[int] = None  # id of building in town, new building is given a new id
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def id(self, string: str) -> int:
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+
+def _encodeString(string: str) -> bytes:
+    data = string.encode()
+    return LENGTH.pack(len(data)) + data
+
+
+def buildingChunk(building: BuildingRecord) -> Tuple[int, int]:
+    """Chunk which building is saved in, it's the chunk of its corner cell moved inside the map."""
+
+    return min(max(building.x, 0), 255) // 16, min(max(building.y, 0), 255) // 16
+
+
+def isBinarySave(file_name: str) -> bool:
+    with open(file_name, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def writeSave(file: BinaryIO, header: SaveHeader, roads: List[RoadRecord],
+              buildings: List[BuildingRecord]) -> None:
+    """Write town in binary format."""
+
+    road_types, building_types, btype_variants, block_variants = (_StringTable() for _ in range(4))
+    chunks = [[(bytearray(), bytearray(), bytearray(), [0, 0, 0]) for _ in range(CHUNKS)] for _ in range(CHUNKS)]
+
+    for road in roads:
+        roads_data, _, _, counts = chunks[road.x // 16][road.y // 16]
+        roads_data += ROAD.pack(road.x % 16 * 16 + road.y % 16, road_types.id(road.road_type))
+        counts[0] += 1
+
+    for building in buildings:
+        chunk_x, chunk_y = buildingChunk(building)
+        _, buildings_data, references, counts = chunks[chunk_x][chunk_y]
+        buildings_data += BUILDING.pack(building.id, building.x, building.y, building.angle // 90,
+                                        building_types.id(building.building_type),
+                                        btype_variants.id(building.btype_variant), len(building.blocks_variants))
+        for variant in building.blocks_variants:
+            references += REFERENCE.pack(block_variants.id(variant))
+        counts[1] += 1
+        counts[2] += len(building.blocks_variants)
+
+    strings = bytearray(_encodeString(header.name))
+    for table in (road_types, building_types, btype_variants, block_variants):
+        strings += LENGTH.pack(len(table.strings))
+        for string in table.strings:
+            strings += _encodeString(string)
+
+    index = bytearray()
+    offset = HEADER.size + len(strings) + INDEX.size * CHUNKS * CHUNKS
+    for chunks_x in chunks:
+        for roads_data, buildings_data, references, counts in chunks_x:
+            index += INDEX.pack(offset, *counts)
+            offset += len(roads_data) + len(buildings_data) + len(references)
+
+    file.write(HEADER.pack(MAGIC, FORMAT_VERSION, header.version, header.seed,
+                           header.cam_x, header.cam_y, header.cam_z, header.next_building_id))
+    file.write(strings)
+    file.write(index)
+    for chunks_x in chunks:
+        for roads_data, buildings_data, references, _ in chunks_x:
+            file.write(roads_data)
+            file.write(buildings_data)
+            file.write(references)
+
+
+class SaveFile:
+    """Memory-mapped binary save. Chunks are decoded only when they are asked."""
+
+    def __init__(self, file_name: str):
+        with open(file_name, 'rb') as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version = HEADER_V1.unpack_from(self._data)[:2]
+        if magic != MAGIC:
+            raise ValueError(f"{file_name} is not a binary save.")
+        if format_version == 1:
+            header, self._building = HEADER_V1, BUILDING_V1
+            next_building_id = None  # it's known after index is read
+        elif format_version == FORMAT_VERSION:
+            header, self._building = HEADER, BUILDING
+            next_building_id = HEADER.unpack_from(self._data)[-1]
+        else:
+            raise ValueError(f"Save format version {format_version} is not supported.")
+        _, _, version, seed, cam_x, cam_y, cam_z = header.unpack_from(self._data)[:7]
+
+        offset = header.size
+        name, offset = self._readString(offset)
+
+        self._tables = []
+        for _ in range(4):
+            count, = LENGTH.unpack_from(self._data, offset)
+            offset += LENGTH.size
+            table = []
+            for _ in range(count):
+                string, offset = self._readString(offset)
+                table.append(string)
+            self._tables.append(table)
+
+        self._index = [
+            [INDEX.unpack_from(self._data, offset + INDEX.size * (x * CHUNKS + y)) for y in range(CHUNKS)]
+            for x in range(CHUNKS)
+        ]
+
+        # buildings of format 1 are given ids in order of file, so any order of reading chunks gives the same ids
+        self._first_ids = [[0] * CHUNKS for _ in range(CHUNKS)]
+        if next_building_id is None:
+            next_building_id = 0
+            for x in range(CHUNKS):
+                for y in range(CHUNKS):
+                    self._first_ids[x][y] = next_building_id
+                    next_building_id += self._index[x][y][2]
+        self.header = SaveHeader(version, name, cam_x, cam_y, cam_z, seed, next_building_id)
+
+    def _readString(self, offset: int) -> Tuple[str, int]:
+        length, = LENGTH.unpack_from(self._data, offset)
+        offset += LENGTH.size
+        return str(self._data[offset:offset + length], 'utf-8'), offset + length
+
+    def chunks(self) -> Iterator[Tuple[int, int]]:
+        """Positions of chunks which aren't empty."""
+
+        for x in range(CHUNKS):
+            for y in range(CHUNKS):
+                if self._index[x][y][1] or self._index[x][y][2]:
+                    yield x, y
+
+    def roads(self, chunk_x: int, chunk_y: int) -> List[RoadRecord]:
+        offset, roads, _, _ = self._index[chunk_x][chunk_y]
+        road_types = self._tables[0]
+        return [
+            RoadRecord(chunk_x * 16 + cell // 16, chunk_y * 16 + cell % 16, road_types[road_type])
+            for cell, road_type in ROAD.iter_unpack(self._data[offset:offset + ROAD.size * roads])
+        ]
+
+    def buildings(self, chunk_x: int, chunk_y: int) -> List[BuildingRecord]:
+        offset, roads, buildings, references = self._index[chunk_x][chunk_y]
+        _, building_types, btype_variants, block_variants = self._tables
+        offset += ROAD.size * roads
+        references_offset = offset + self._building.size * buildings
+        variants = [
+            block_variants[variant]
+            for variant, in REFERENCE.iter_unpack(
+                self._data[references_offset:references_offset + REFERENCE.size * references]
+            )
+        ]
+
+        answer = []
+        first = 0
+        for data in self._building.iter_unpack(self._data[offset:references_offset]):
+            if len(data) == 6:
+                data = (self._first_ids[chunk_x][chunk_y] + len(answer), *data)
+            building_id, x, y, angle, building_type, btype_variant, count = data
+            answer.append(BuildingRecord(x, y, angle * 90, building_types[building_type],
+                                         btype_variants[btype_variant], tuple(variants[first:first + count]),
+                                         building_id))
+            first += count
+        return answer
+
+    def close(self) -> None:
+        self._data.close()
+
+    def __enter__(self) -> 'SaveFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def readTextSave(file: TextIO) -> Tuple[SaveHeader, List[RoadRecord], List[BuildingRecord]]:
+    """Town data saved in the old text format."""
+
+    version = int(file.readline()[:-1])
+    town_data = file.readline().split()
+    cam_x, cam_y, cam_z = map(float, town_data[1:4])
+    header = SaveHeader(version, town_data[0], cam_x, cam_y, cam_z, int(town_data[4]) if len(town_data) > 4 else 0)
+
+    roads_data = file.readline().split()
+    roads = [
+        RoadRecord(int(roads_data[i]), int(roads_data[i + 1]), roads_data[i + 2])
+        for i in range(0, len(roads_data), 3)
+    ]
+    buildings = []
+    for building_data in file.readlines():
+        data = building_data.split()
+        if data:
+            buildings.append(BuildingRecord(int(data[0]), int(data[1]), int(data[2]) * 90, data[3], data[4],
+                                            tuple(data[5:])))
+    return header, roads, buildings
+
+
+def convertTextSave(text_file_name: str, binary_file_name: str) -> None:
+    """Convert save in the old text format to binary one."""
+
+    with open(text_file_name) as file:
+        header, roads, buildings = readTextSave(file)
+    buildings = [building._replace(id=building_id) for building_id, building in enumerate(buildings)]
+    with open(binary_file_name, 'wb') as file:
+        writeSave(file, header._replace(next_building_id=len(buildings)), roads, buildings)
+
+
+def readSave(file_name: str) -> Tuple[SaveHeader, Dict[Tuple[int, int], Tuple[List[RoadRecord],
+                                                                           List[BuildingRecord]]]]:
+    """Town data by chunks from save in any format."""
+
+    if isBinarySave(file_name):
+        with SaveFile(file_name) as save:
+            return save.header, {chunk: (save.roads(*chunk), save.buildings(*chunk)) for chunk in save.chunks()}
+
+    with open(file_name) as file:
+        header, roads, buildings = readTextSave(file)
+    chunks = {}
+    for road in roads:
+        chunks.setdefault((road.x // 16, road.y // 16), ([], []))[0].append(road)
+    for building in buildings:
+        chunks.setdefault(buildingChunk(building), ([], []))[1].append(building)
+    return header, chunks
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} TEXT_SAVE BINARY_SAVE")
+        sys.exit(1)
+    convertTextSave(sys.argv[1], sys.argv[2])
@@ -0,0 +1,179 @@
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple
+
+from hashing import splitMix64
+
+STEP = .2  # length of one citizen's step along an axis
+
+
+def citizenStep(seed: int, citizen_id: int, tick: int) -> Tuple[float, float]:
+    """Step of citizen with changed id on changed tick.
+        It depends only on arguments, so any process computes the same step."""
+
+    value = splitMix64(splitMix64(splitMix64(seed) ^ citizen_id) ^ tick)
+    return (value & 1) * STEP, (value >> 1 & 1) * STEP
+
+
+_attached = {}  # shared memory attached by worker process
+
+
+def _attach(memory_name: str) -> SharedMemory:
+    """Shared memory called memory_name."""
+
+    if memory_name not in _attached:
+        for memory in _attached.values():
+            memory.close()
+        _attached.clear()
+        # spawned workers share resource tracker of the main process, which unlinks the memory
+        _attached[memory_name] = SharedMemory(memory_name)
+    return _attached[memory_name]
+
+
+def _stepRegion(memory_name: str, current: int, count: int, start: int, end: int, chunks: bytes, seed: int,
+                tick: int) -> Tuple[int, List[Tuple[float, float, float, float]]]:
+    """Step citizens of region with chunk x in [start, end) on chunks which are set in bytes chunks
+        (chunk x, y is at index x * 16 + y). Positions of count citizens are read from half current of shared
+        memory and written to the other half, see CitizenPositions. Citizens out of town belong to the nearest region.
+        Return count of stepped citizens and moves of citizens which went to another chunk as (old x, old y, x, y)."""
+
+    data = _attach(memory_name).buf.cast('d')
+    try:
+        size = len(data) // 2
+        source = data[current * size:(current + 1) * size]
+        target = data[(1 - current) * size:(2 - current) * size]
+        stepped = 0
+        moves = []
+        low = start * 16 if start else float("-inf")
+        high = end * 16 if end < 16 else float("inf")
+        for i in range(0, count * 2, 2):
+            x, y = source[i], source[i + 1]
+            if low <= x < high:
+                if 0 <= x < 256 and 0 <= y < 256 and chunks[int(x // 16) * 16 + int(y // 16)]:
+                    dx, dy = citizenStep(seed, i // 2, tick)
+                    if (x + dx) // 16 != x // 16 or (y + dy) // 16 != y // 16:
+                        moves.append((x, y, x + dx, y + dy))
+                    x += dx
+                    y += dy
+                    stepped += 1
+                target[i] = x
+                target[i + 1] = y
+        source.release()
+        target.release()
+        return stepped, moves
+    finally:
+        data.release()
+
+
+class CitizenPositions:
+    """Positions of citizens, x and y of citizen with id i are doubles 2 * i and 2 * i + 1 of data.
+        While citizens are simulated by worker processes, shared memory has two halves: workers read positions
+        from the current half and write them to the other one, then halves are swapped. So every citizen is written
+        once by tick, even if it goes to another region, and nothing is copied by the main process."""
+
+    def __init__(self):
+        self.count = 0
+        self.current = 0  # index of half of shared memory which is data
+        self._memory = None
+        self._halves = ()
+        self._buffer = bytearray(16 * 8)
+        self.data = memoryview(self._buffer).cast('d')
+
+    @property
+    def memory_name(self) -> str:
+        return self._memory.name
+
+    def append(self, x: float, y: float) -> int:
+        """Add position of the new citizen, return its id."""
+
+        if (self.count + 1) * 2 > len(self.data):
+            self._resize(len(self.data) * 2, self._memory is not None)
+        self.data[self.count * 2] = x
+        self.data[self.count * 2 + 1] = y
+        self.count += 1
+        return self.count - 1
+
+    def swap(self) -> None:
+        """Make the other half of shared memory current, workers have written positions to it."""
+
+        self.current = 1 - self.current
+        self.data = self._halves[self.current]
+
+    def share(self) -> None:
+        """Move positions to shared memory."""
+
+        if self._memory is None:
+            self._resize(len(self.data), True)
+
+    def unshare(self) -> None:
+        """Move positions back to memory of this process and free shared memory."""
+
+        if self._memory is not None:
+            self._resize(len(self.data), False)
+
+    def _resize(self, size: int, shared: bool) -> None:
+        """Move positions to new memory for size doubles."""
+
+        old, memory, halves = self.data, self._memory, self._halves
+        self.current = 0
+        if shared:
+            self._memory = SharedMemory(create=True, size=size * 2 * 8)
+            data = self._memory.buf.cast('d')
+            self._halves = (data[:size], data[size:])
+            data.release()
+            self.data = self._halves[0]
+        else:
+            self._memory = None
+            self._halves = ()
+            self._buffer = bytearray(size * 8)
+            self.data = memoryview(self._buffer).cast('d')
+        self.data[:self.count * 2] = old[:self.count * 2]
+        for view in halves or (old,):
+            view.release()
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+
+class RegionSimulation:
+    """Simulate citizens in worker processes.
+        Chunk grid is split on vertical strips of chunks (regions), every region is stepped by its own task.
+        Citizens move between regions only at tick boundaries.
+        Workers are spawned, not forked, because threads of town (terrain and streaming) may be running."""
+
+    def __init__(self, positions: CitizenPositions, regions: int = 4, processes: int = None):
+        if not (1 <= regions <= 16):
+            raise AttributeError(f"Regions count must be between 1 and 16, not {regions}.")
+
+        self.regions = regions
+        self.positions = positions
+        self.positions.share()
+        self._pool = get_context("spawn").Pool(processes or regions)
+
+    def region(self, x: float) -> int:
+        """Region containing global position x."""
+
+        return int(x // 16) * self.regions // 16
+
+    def step(self, chunks: bytes, seed: int, tick: int) -> Tuple[int, List[Tuple[float, float, float, float]]]:
+        """Step citizens on chunks which are set in bytes chunks (chunk x, y is at index x * 16 + y).
+            Return count of stepped citizens and moves of citizens which went to another chunk as
+            (old x, old y, x, y)."""
+
+        tasks = []
+        for region in range(self.regions):
+            # chunks x of region are the ones which have region(16 * x) == region
+            start = -(-region * 16 // self.regions)
+            end = -(-(region + 1) * 16 // self.regions)
+            tasks.append((self.positions.memory_name, self.positions.current, self.positions.count, start, end,
+                          chunks, seed, tick))
+        results = self._pool.starmap(_stepRegion, tasks)
+        self.positions.swap()
+        return sum(stepped for stepped, _ in results), [move for _, moves in results for move in moves]
+
+    def close(self) -> None:
+        """Stop worker processes and return positions to memory of this process."""
+
+        self._pool.close()
+        self._pool.join()
+        self.positions.unshare()
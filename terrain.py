@@ -0,0 +1,132 @@
+"""Procedural ground of town from seeded value noise.
+    Ground of a cell depends only on seed and position of the cell, so any part of map can be generated alone and
+    chunks generated one by one are the same as map generated at once. Area is computed by numpy as arrays, the same
+    noise is computed cell by cell if numpy isn't installed. Ground is stored as bytes of ground ids, see GROUND_NAMES."""
+from typing import Dict, List, Tuple
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, pure Python generation is slower
+    numpy = None
+
+from hashing import MASK64, splitMix64
+
+GROUND_NAMES = ("grass", "dirt", "water", "forest")  # name of ground with id of index, they are in grounds.json
+GRASS, DIRT, WATER, FOREST = range(len(GROUND_NAMES))
+
+# octaves of noise: (salt of layer, size of lattice cell in cells, weight)
+HEIGHT_OCTAVES = ((1, 64, .5), (2, 32, .25), (3, 16, .15), (4, 8, .1))
+MOISTURE_OCTAVES = ((5, 48, .6), (6, 16, .3), (7, 4, .1))
+WATER_LEVEL = .33   # height below it is water
+SHORE_LEVEL = .36   # height below it is dirt of shore
+FOREST_LEVEL = .57  # moisture above it is forest
+DRY_LEVEL = .33     # moisture below it is dirt
+
+if numpy is not None:
+    _MIX_CONSTANTS = tuple(map(numpy.uint64, (0x9E3779B97F4A7C15, 0xBF58476D1CE4E5B9, 0x94D049BB133111EB)))
+
+
+def _mixArray(values: 'numpy.ndarray') -> 'numpy.ndarray':
+    """SplitMix64 finalizer of every value of uint64 array, the same as hashing.splitMix64."""
+
+    add, multiply1, multiply2 = _MIX_CONSTANTS
+    values = values + add  # uint64 arrays wrap on overflow
+    values = (values ^ (values >> numpy.uint64(30))) * multiply1
+    values = (values ^ (values >> numpy.uint64(27))) * multiply2
+    return values ^ (values >> numpy.uint64(31))
+
+
+def _latticeValue(seed: int, salt: int, x: int, y: int) -> float:
+    """Random value in [0, 1) of lattice point x, y."""
+
+    return (splitMix64(splitMix64(splitMix64(seed ^ salt) ^ x) ^ y) >> 11) * 2.0 ** -53
+
+
+def _octaveArray(seed: int, salt: int, size: int, x: int, y: int, width: int, height: int) -> 'numpy.ndarray':
+    xs = numpy.arange(x, x + width)
+    ys = numpy.arange(y, y + height)
+    lattice_x, lattice_y = xs // size, ys // size
+    first_x, first_y = int(lattice_x[0]), int(lattice_y[0])
+
+    # values of all lattice points around the area, then they are interpolated for every cell
+    points_x = numpy.arange(first_x, int(lattice_x[-1]) + 2, dtype=numpy.uint64)
+    points_y = numpy.arange(first_y, int(lattice_y[-1]) + 2, dtype=numpy.uint64)
+    salted = numpy.uint64(splitMix64((seed ^ salt) & MASK64))
+    lattice = _mixArray(_mixArray(salted ^ points_x)[:, None] ^ points_y[None, :])
+    lattice = (lattice >> numpy.uint64(11)) * 2.0 ** -53
+
+    fx = (xs % size) / size
+    fy = (ys % size) / size
+    fx = (fx * fx * (3 - 2 * fx))[:, None]
+    fy = (fy * fy * (3 - 2 * fy))[None, :]
+    i = (lattice_x - first_x)[:, None]
+    j = (lattice_y - first_y)[None, :]
+    top = lattice[i, j] + (lattice[i + 1, j] - lattice[i, j]) * fx
+    bottom = lattice[i, j + 1] + (lattice[i + 1, j + 1] - lattice[i, j + 1]) * fx
+    return top + (bottom - top) * fy
+
+
+def _groundsArray(seed: int, x: int, y: int, width: int, height: int) -> bytes:
+    height_map = sum(_octaveArray(seed, salt, size, x, y, width, height) * weight
+                     for salt, size, weight in HEIGHT_OCTAVES)
+    moisture = sum(_octaveArray(seed, salt, size, x, y, width, height) * weight
+                   for salt, size, weight in MOISTURE_OCTAVES)
+    grounds = numpy.select(
+        (height_map < WATER_LEVEL, height_map < SHORE_LEVEL, moisture > FOREST_LEVEL, moisture < DRY_LEVEL),
+        (WATER, DIRT, FOREST, DIRT), GRASS
+    ).astype(numpy.uint8)
+    return grounds.tobytes()
+
+
+def _octaveValue(lattice: Dict[Tuple[int, int], float], seed: int, salt: int, size: int, x: int, y: int) -> float:
+    lattice_x, lattice_y = x // size, y // size
+    values = []
+    for point in ((lattice_x, lattice_y), (lattice_x + 1, lattice_y),
+                  (lattice_x, lattice_y + 1), (lattice_x + 1, lattice_y + 1)):
+        value = lattice.get(point)
+        if value is None:
+            value = lattice[point] = _latticeValue(seed, salt, *point)
+        values.append(value)
+    fx = (x % size) / size
+    fy = (y % size) / size
+    fx = fx * fx * (3 - 2 * fx)
+    fy = fy * fy * (3 - 2 * fy)
+    top = values[0] + (values[1] - values[0]) * fx
+    bottom = values[2] + (values[3] - values[2]) * fx
+    return top + (bottom - top) * fy
+
+
+def _groundsPython(seed: int, x: int, y: int, width: int, height: int) -> bytes:
+    lattices: List[Dict[Tuple[int, int], float]] = [{} for _ in HEIGHT_OCTAVES + MOISTURE_OCTAVES]
+    grounds = bytearray(width * height)
+    for i in range(width):
+        for j in range(height):
+            values = [_octaveValue(lattice, seed, salt, size, x + i, y + j) * weight
+                      for lattice, (salt, size, weight) in zip(lattices, HEIGHT_OCTAVES + MOISTURE_OCTAVES)]
+            # the same order of addition as sum of arrays
+            height_value = sum(values[:len(HEIGHT_OCTAVES)])
+            moisture = sum(values[len(HEIGHT_OCTAVES):])
+            if height_value < WATER_LEVEL:
+                grounds[i * height + j] = WATER
+            elif height_value < SHORE_LEVEL:
+                grounds[i * height + j] = DIRT
+            elif moisture > FOREST_LEVEL:
+                grounds[i * height + j] = FOREST
+            elif moisture < DRY_LEVEL:
+                grounds[i * height + j] = DIRT
+    return bytes(grounds)
+
+
+def generateGrounds(seed: int, x: int, y: int, width: int, height: int) -> bytes:
+    """Ground ids of cells of area with corner on cell x, y (x, y >= 0).
+        Id of cell x + i, y + j is at index i * height + j."""
+
+    if numpy is not None:
+        return _groundsArray(seed, x, y, width, height)
+    return _groundsPython(seed, x, y, width, height)
+
+
+def chunkGrounds(seed: int, chunk_x: int, chunk_y: int) -> bytes:
+    """Ground ids of chunk, id of cell i, j of chunk is at index i * 16 + j."""
+
+    return generateGrounds(seed, chunk_x * 16, chunk_y * 16, 16, 16)
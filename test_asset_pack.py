@@ -0,0 +1,39 @@
+import json
+import os
+
+from PyQt5.QtGui import QImage
+
+from asset_pack import buildPack
+from resources_manager import AssetPack, wd
+
+
+def test_pack_images_have_the_same_pixels(tmp_path):
+    # pixels are compared premultiplied, color of transparent pixel isn't drawn
+    file_name = str(tmp_path / "assets.pack")
+    buildPack(file_name)
+    pack = AssetPack(file_name)
+    assets = os.path.join(wd, "assets")
+    names = []
+    for directory, _, files in os.walk(assets):
+        names += [os.path.relpath(os.path.join(directory, file), assets)[:-len(".png")].replace(os.sep, "/")
+                  for file in files if file.endswith(".png")]
+    assert names
+    for name in names:
+        packed = pack.image(name)
+        assert packed is not None, name
+        source = QImage(os.path.join(assets, name + ".png")).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        packed = packed.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        assert packed.size() == source.size(), name
+        assert packed.constBits().asstring(packed.sizeInBytes()) == \
+            source.constBits().asstring(source.sizeInBytes()), name
+    pack.close()
+
+
+def test_pack_keeps_data(tmp_path):
+    file_name = str(tmp_path / "assets.pack")
+    buildPack(file_name)
+    pack = AssetPack(file_name)
+    with open(os.path.join(wd, "data", "blocks.json")) as file:
+        assert pack.data("data", "blocks") == json.load(file)
+    assert pack.data("compiled", "building_types")
+    pack.close()
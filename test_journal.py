@@ -0,0 +1,128 @@
+import os
+from random import Random
+
+import Town
+from journal import Journal, readJournal
+from save_format import BuildingRecord, RoadRecord
+
+
+def building(x: int, y: int) -> BuildingRecord:
+    building_type = Town.BuildingTypes.building_types["house"]
+    variant, blocks_variants = building_type.generateVariant(Random(x * 256 + y))
+    return BuildingRecord(x, y, 0, "house", variant, tuple(
+        blocks_variants[block_x][block_y][block_z]
+        for block_x, block_y, block_z in building_type.blockPositions(variant, 0)
+    ))
+
+
+def startedTown(file_name: str) -> Town.Town:
+    town = Town.Town(seed=1)
+    town.load(file_name)
+    town.startJournal(3600, file_name)
+    return town
+
+
+def crash(town: Town.Town) -> None:
+    """Stop journaling without saving, as if process was killed."""
+
+    town._compactor.cancel()
+    town.journal.close()
+
+
+def records(town: Town.Town):
+    return (sorted(road.record() for road in town.roads.values()),
+            sorted(building.record() for building in town.buildings))
+
+
+def test_save_and_journal_round_trip(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    town = startedTown(file_name)
+    with town.batch() as batch:
+        batch.addBuilding(building(10, 10))
+        batch.addRoad(RoadRecord(5, 5, "road"))
+    town.compactJournal()
+    with town.batch() as batch:
+        batch.addBuilding(building(30, 30))
+    town.buildings.get(0).destroy()
+    crash(town)
+
+    loaded = Town.Town(seed=1)
+    loaded.load(file_name)
+    assert records(loaded) == records(town)
+    assert [kind for kind, _ in readJournal(town.journal.file_name)] == ["B", "D"]
+
+
+def test_crash_between_rotate_and_save(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    town = startedTown(file_name)
+    with town.batch() as batch:
+        batch.addBuilding(building(10, 10))
+    town.journal.rotate()  # compaction which crashed before saving
+    crash(town)
+
+    town = startedTown(file_name)
+    with town.batch() as batch:
+        batch.addBuilding(building(30, 30))
+    town.journal.rotate()
+    crash(town)
+
+    loaded = Town.Town(seed=1)
+    loaded.load(file_name)
+    assert records(loaded) == records(town)
+    assert len(loaded.buildings) == 2
+
+
+def test_rotate_drops_broken_line(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    journal = Journal(file_name)
+    journal.road(RoadRecord(1, 1, "road"))
+    journal.rotate()
+    with open(journal.rotated_file_name, "a") as file:
+        file.write("R 2")  # line which wasn't finished
+    journal.road(RoadRecord(3, 3, "road"))
+    journal.rotate()
+    journal.close()
+    assert list(readJournal(journal.rotated_file_name)) == [("R", RoadRecord(1, 1, "road")),
+                                                           ("R", RoadRecord(3, 3, "road"))]
+    assert list(readJournal(journal.file_name)) == []
+    assert not os.path.exists(journal.rotated_file_name + ".tmp")
+
+
+def test_background_save_saves_town_of_its_call(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    town = startedTown(file_name)
+    with town.batch() as batch:
+        batch.addBuilding(building(10, 10))
+    saved = records(town)
+    thread = town.saveInBackground()
+    with town.batch() as batch:
+        batch.addBuilding(building(30, 30))
+    thread.join()
+    crash(town)
+
+    loaded = Town.Town(seed=1)
+    loaded.load(file_name)
+    assert records(loaded) == records(town)
+    os.remove(town.journal.file_name)
+    loaded = Town.Town(seed=1)
+    loaded.load(file_name)
+    assert records(loaded) == saved
+
+
+def test_older_snapshot_is_not_saved_over_newer(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    town = startedTown(file_name)
+    with town._save_lock:
+        older = town._saveSnapshot()
+        with town.batch() as batch:
+            batch.addBuilding(building(10, 10))
+        newer = town._saveSnapshot()
+    town._saveNumbered(*newer)
+    town._saveNumbered(*older)
+    crash(town)
+    assert not os.path.exists(town.journal.rotated_file_name)
+
+    os.remove(town.journal.file_name)
+    loaded = Town.Town(seed=1)
+    loaded.load(file_name)
+    assert records(loaded) == records(town)
@@ -0,0 +1,58 @@
+import gc
+import weakref
+
+from PyQt5.QtGui import QImage
+
+import resources_manager
+from resources_manager import ImageCache, getImage, imageResources, mirroredName
+from TownObjects import Grounds, RoadTypes, loadedTextures, prefetchTextures
+
+
+def image(size: int) -> QImage:
+    return QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+
+
+def test_eviction_lowers_tracked_bytes():
+    cache = ImageCache(3 * 64 * 64 * 4)
+    for number in range(3):
+        cache.get(str(number), lambda name: image(64))
+    assert cache.stats()["bytes"] == 3 * 64 * 64 * 4
+    assert len(cache) == 3
+
+    cache.get("big", lambda name: image(100))
+    stats = cache.stats()
+    assert stats["bytes"] <= cache.budget
+    assert stats["bytes"] == sum(image.sizeInBytes() for image in cache.images().values())
+    assert stats["evictions"] == 3
+    assert "0" not in cache and "big" in cache
+
+
+def test_evicted_textures_are_not_kept():
+    budget = imageResources.budget
+    imageResources.clear()
+    try:
+        texture = weakref.ref(Grounds.grass.texture)
+        imageResources.budget = 0  # every new image evicts others
+        getImage("human")
+        gc.collect()
+        assert texture() is None
+        assert not Grounds.grass.texture.isNull()
+    finally:
+        imageResources.budget = budget
+        imageResources.clear()
+
+
+def test_mirrored_textures():
+    road_type = RoadTypes.getByNumber(0)
+    part = getImage(f"{road_type.name}_part")
+    assert road_type.textures["right-down"] == part.mirrored(True, True)
+    assert mirroredName(f"{road_type.name}_part", True, True) in imageResources
+    assert resources_manager._loadImage(mirroredName("missing", True, False)) is None
+
+
+def test_loaded_textures_while_prefetching():
+    thread = prefetchTextures()
+    while thread.is_alive():
+        list(loadedTextures())  # faces which are added by prefetch don't break iterating
+    thread.join()
+    assert list(loadedTextures())
@@ -0,0 +1,102 @@
+import io
+from random import Random
+
+import pytest
+
+import Town
+from save_format import BuildingRecord, RoadRecord, SaveFile, SaveHeader, buildingChunk, readSave, writeSave
+from town_generator import generateTown
+
+HEADER = SaveHeader(3, "Test", 1.5, 2.5, 1.0, 42, 10)
+
+
+def building(x: int, y: int, building_id: int) -> BuildingRecord:
+    building_type = Town.BuildingTypes.building_types["house"]
+    variant, blocks_variants = building_type.generateVariant(Random(building_id))
+    return BuildingRecord(x, y, 0, "house", variant, tuple(
+        blocks_variants[block_x][block_y][block_z]
+        for block_x, block_y, block_z in building_type.blockPositions(variant, 0)
+    ), building_id)
+
+
+def townRecords(town: Town.Town):
+    return (sorted(road.record() for road in town.roads.values()),
+            sorted(building.record() for building in town.buildings))
+
+
+def test_binary_round_trip_of_edge_buildings(tmp_path):
+    roads = [RoadRecord(0, 0, "road"), RoadRecord(255, 255, "road"), RoadRecord(17, 200, "road")]
+    buildings = [building(-1, 10, 0), building(10, -2, 1), building(-3, -3, 2), building(250, 251, 3),
+                 building(100, 100, 4)]
+    file_name = str(tmp_path / "save.dat")
+    with open(file_name, "wb") as file:
+        writeSave(file, HEADER, roads, buildings)
+
+    with SaveFile(file_name) as save:
+        assert save.header == HEADER
+        chunks = list(save.chunks())
+        loaded_roads = [road for chunk in chunks for road in save.roads(*chunk)]
+        loaded_buildings = [record for chunk in chunks for record in save.buildings(*chunk)]
+        assert sorted(loaded_roads) == sorted(roads)
+        assert sorted(loaded_buildings, key=lambda record: record.id) == buildings
+        for record in buildings:
+            assert record in save.buildings(*buildingChunk(record))
+
+
+@pytest.mark.parametrize("x, y", [(0, 0), (-1, 10), (10, -1)])
+def test_text_save_chunks(tmp_path, x, y):
+    file_name = tmp_path / "save.txt"
+    record = building(x, y, None)
+    file_name.write_text(f"1\nTest 0 0 1 5\n0 0 road\n{x} {y} 0 house {record.btype_variant} "
+                         + " ".join(map(str, record.blocks_variants)) + "\n")
+    header, chunks = readSave(str(file_name))
+    assert chunks[buildingChunk(record)][1][0][:2] == (x, y)
+
+
+def test_town_save_load(tmp_path):
+    town = generateTown(200, .5, 0, 5)
+    town.chosen_btype = 0
+    project = Town.ProjectedBuilding(town)
+    project.x, project.y = -1, 10
+    if project.canBuild():
+        project.build()
+    file_name = str(tmp_path / "save.dat")
+    town.save(file_name=file_name)
+
+    loaded = Town.Town()
+    loaded.load(file_name)
+    assert townRecords(loaded) == townRecords(town)
+    assert loaded.seed == town.seed
+
+    streamed = Town.Town()
+    streamed.load(file_name, stream=True)
+    streamed.waitLoaded()
+    assert townRecords(streamed) == townRecords(town)
+    assert streamed.aggregates.report() == town.aggregates.report()
+
+
+def test_write_to_buffer():
+    data = io.BytesIO()
+    writeSave(data, HEADER, [], [building(-5, 3, 0)])
+    assert data.getvalue().startswith(b"MRTOWN")
+
+
+def test_streamed_chunks_update_masks(tmp_path):
+    file_name = str(tmp_path / "save.dat")
+    generateTown(1500, .5, 0, 7).save(file_name=file_name)
+    town = Town.Town()
+    town.chosen_btype = 0
+    project = Town.ProjectedBuilding(town)
+    with SaveFile(file_name) as save:
+        chunks = list(save.chunks())
+        town._unloaded_chunks = set(chunks)
+        for chunk in chunks:
+            town.setBuildingMaskForGroup(project)
+            town._loadChunk(save, *chunk)
+    town.setBuildingMaskForGroup(project)
+    masks = [[chunk.masks for chunk in column] for column in town.chunks]
+
+    town._masks_key = None
+    town.setBuildingMaskForGroup(project)
+    assert [[chunk.masks for chunk in column] for column in town.chunks] == masks
+    assert len({building.id for building in town.buildings}) == len(town.buildings)
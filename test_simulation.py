@@ -0,0 +1,39 @@
+import pytest
+from PyQt5.QtCore import QSize
+
+from profiling import frameProfiler
+from town_generator import generateTown
+
+SCREEN = QSize(3000, 2000)
+
+
+def simulate(regions: int, ticks: int = 5):
+    """Positions of citizens and counts of stepped citizens after ticks."""
+
+    town = generateTown(300, .5, 200, 1)
+    town.cam_x = 300  # part of town isn't visible, so its citizens aren't stepped
+    if regions:
+        town.startRegionSimulation(regions)
+    stepped = []
+    frameProfiler.enabled = True
+    try:
+        for _ in range(ticks):
+            town.tick(SCREEN)
+            stepped.append(frameProfiler.last_tick["citizens"])
+    finally:
+        frameProfiler.enabled = False
+        town.stopRegionSimulation()
+    return [(citizen.x, citizen.y) for citizen in town.citizens], stepped
+
+
+@pytest.fixture(scope="module")
+def in_thread():
+    return simulate(0)
+
+
+@pytest.mark.parametrize("regions", [1, 3])
+def test_regions_step_like_one_thread(in_thread, regions):
+    positions, stepped = simulate(regions)
+    assert positions == in_thread[0]
+    assert stepped == in_thread[1]
+    assert 0 < stepped[0] < 200
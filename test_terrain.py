@@ -0,0 +1,31 @@
+import pytest
+
+import terrain
+from hashing import splitMix64
+
+
+@pytest.mark.parametrize("seed, x, y, width, height", [
+    (0, 0, 0, 16, 16), (42, 48, 112, 40, 24), (2 ** 32 - 1, 240, 0, 16, 64), (123456789, 7, 201, 3, 55)
+])
+def test_numpy_and_python_grounds_are_equal(seed, x, y, width, height):
+    pytest.importorskip("numpy")
+    assert terrain._groundsArray(seed, x, y, width, height) == terrain._groundsPython(seed, x, y, width, height)
+
+
+def test_numpy_mix_is_split_mix():
+    numpy = pytest.importorskip("numpy")
+    values = [0, 1, 2 ** 63, 2 ** 64 - 1, 0x123456789abcdef]
+    assert terrain._mixArray(numpy.array(values, dtype=numpy.uint64)).tolist() == list(map(splitMix64, values))
+
+
+def test_chunks_are_parts_of_map():
+    grounds = terrain.generateGrounds(7, 0, 0, 64, 64)
+    for chunk_x in range(4):
+        for chunk_y in range(4):
+            chunk = terrain.chunkGrounds(7, chunk_x, chunk_y)
+            assert chunk == bytes(grounds[(chunk_x * 16 + i) * 64 + chunk_y * 16 + j]
+                                  for i in range(16) for j in range(16))
+
+
+def test_all_grounds_are_generated():
+    assert set(terrain.generateGrounds(3, 0, 0, 256, 256)) == set(range(len(terrain.GROUND_NAMES)))
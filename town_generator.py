@@ -0,0 +1,68 @@
+from random import Random
+from typing import Dict
+
+from Town import (ISOMETRIC_HEIGHT1, BuildingRecord, BuildingTypes, Citizen, RoadRecord, RoadTypes, Town,
+                  turnMatrix)
+
+STREET_STEP = 8  # distance between parallel streets
+
+
+def generateTown(buildings: int = 100, road_density: float = .5, citizens: int = 0, seed: int = None,
+                 groups: Dict[str, int] = None) -> Town:
+    """Synthetic town with streets on grid, buildings between them and walking citizens.
+        road_density is the part of street cells which have road.
+        groups is count of buildings of every group, {group: count}; buildings is ignored if it's given."""
+
+    town = Town(seed)
+    town.cam_y = 256 * ISOMETRIC_HEIGHT1  # look at the center of the map
+    rnd = Random(town.seed)
+
+    roads = []
+    for x in range(256):
+        for y in range(256):
+            if (x % STREET_STEP == 0 or y % STREET_STEP == 0) and rnd.random() < road_density:
+                roads.append(RoadRecord(x, y, RoadTypes.sorted_names[rnd.randrange(len(RoadTypes.sorted_names))]))
+    occupied = {(road.x, road.y) for road in roads}
+
+    names = None  # names of buildings which have to be built, they are random if it's None
+    if groups is not None:
+        names = []
+        for group, count in groups.items():
+            group_names = [name for name in BuildingTypes.sorted_names
+                           if BuildingTypes.building_types[name].group == group]
+            if not group_names and count:
+                raise ValueError(f'Group "{group}" has no building types.')
+            names += [rnd.choice(group_names) for _ in range(count)]
+        rnd.shuffle(names)
+        buildings = len(names)
+
+    places = [(x, y) for x in range(256) for y in range(256) if x % STREET_STEP and y % STREET_STEP]
+    rnd.shuffle(places)
+    records = []
+    for x, y in places:
+        if len(records) >= buildings:
+            break
+
+        name = rnd.choice(BuildingTypes.sorted_names) if names is None else names[len(records)]
+        building_type = BuildingTypes.building_types[name]
+        angle = rnd.choice((0, 90, 180, 270))
+        btype_variant, blocks_variants = building_type.generateVariant(rnd)
+        blocks = building_type.rotatedBlocks(btype_variant, angle)
+        blocks_variants = turnMatrix(blocks_variants, angle)
+        positions = building_type.blockPositions(btype_variant, angle)
+        cells = {(x + block_x, y + block_y) for block_x, block_y, _ in positions}
+        if x + len(blocks) <= 256 and y + len(blocks[0]) <= 256 and not cells & occupied:
+            occupied |= cells
+            records.append(BuildingRecord(x, y, angle, name, btype_variant, tuple(
+                blocks_variants[block_x][block_y][block_z] for block_x, block_y, block_z in positions
+            )))
+
+    town.addRecords(roads, records)
+
+    if town.buildings:
+        homes = list(town.buildings)
+        for _ in range(citizens):
+            Citizen(rnd.choice(homes))
+        town.publishCitizens()
+
+    return town